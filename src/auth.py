@@ -23,14 +23,11 @@ MIN_PASS_LEN = 6
 
 def verify_token(token):
     '''
-    Checks that the token given is in the TOKENS dictionary as described in server.py
+    Checks that the token given is in the TOKENS store as described in state.py
     Args: token (str)
     Return: (bool)
     '''
-    token_dict = get_tokens()
-    if token not in token_dict.keys():
-        return False
-    return True
+    return token in get_tokens()
 
 
 def generate_token(u_id):
@@ -49,11 +46,7 @@ def get_token(u_id):
     Args: u_id (int)
     Return: token (str, None)
     '''
-    tokens = get_tokens()
-    for token, logged_uid in tokens.items():
-        if logged_uid == u_id:
-            return token
-    return None
+    return get_tokens().token(u_id)
 
 
 def create_handle(name_first, name_last):
@@ -143,8 +136,8 @@ def auth_register(email, password, name_first, name_last):
     u_id = data.add_user(details)
 
     token = generate_token(u_id)
-    # Store the token-u_id pair in the temporary TOKEN dictionary
-    get_tokens()[token] = u_id
+    # Store the token-u_id pair in the temporary TOKEN store
+    get_tokens().add(token, u_id)
 
     # return u_id and token
     return {
@@ -185,7 +178,7 @@ def auth_login(email, password):
         raise InputError(description='User is already logged on')
 
     token = generate_token(u_id)
-    get_tokens()[token] = u_id
+    get_tokens().add(token, u_id)
     return {
         "u_id": u_id,
         "token": token
@@ -204,7 +197,7 @@ def auth_logout(token):
         return {'is_success': False}
 
     # remove the user's token
-    get_tokens().pop(token)
+    get_tokens().remove(token)
     return {'is_success': True}
 
 
@@ -240,15 +233,12 @@ def auth_passwordreset_reset(reset_code, new_password):
 
     data = get_store()
 
-    # Check if reset_code exists within dictionary and return the email key
-    # paired with that code
-    data.codes.code_exists(reset_code)
-    email = data.codes.find_email(reset_code)
+    # Remove the reset_code from the dictionary and return the email key
+    # paired with that code, raising an InputError if it is not valid
+    email = data.codes.redeem(reset_code)
 
-    # Retrieve user's id and set their new password
-    u_id = data.users.find_u_id(email[0])
-    data.users.set_password(u_id, new_password)
-    # Delete reset code from the dictionary
-    data.codes.delete(email[0])
+    # Retrieve user's id and set their new password, hashed before it is stored
+    u_id = data.users.find_u_id(email)
+    data.users.set_password(u_id, hashlib.sha256(new_password.encode()).hexdigest())
 
     return {}
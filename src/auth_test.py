@@ -7,8 +7,11 @@ Integration tests for auth functions
 #pylint: disable=redefined-outer-name
 #pylint: disable=singleton-comparison
 
+from time import time
+from hashlib import sha256
 import pytest
-from state import get_store
+import state
+from state import get_store, get_tokens, Sessions, SESSION_IDLE_TTL, RESET_CODE_TTL, Codes
 from auth import auth_register, auth_login, auth_logout, auth_passwordreset_request, auth_passwordreset_reset
 from channel import channel_join
 from channels import channels_create
@@ -315,6 +318,34 @@ def test_logout_join_fails():
         channel_join(user2["token"], ch_id)
 
 
+
+# An idle session expires and the user can log in again
+def test_session_expires():
+    workspace_reset()
+    user = auth_register('max.smith@gmail.com',
+                         'great_password101', 'Max', 'Smith')
+
+    assert get_tokens().sweep(time() + SESSION_IDLE_TTL + 1) == 1
+    with pytest.raises(AccessError):
+        channels_create(user["token"], "new-channel", True)
+
+    assert auth_login('max.smith@gmail.com',
+                      'great_password101')['token'] == user['token']
+
+
+# Saved sessions are still valid once loaded again
+def test_sessions_persist(tmp_path):
+    workspace_reset()
+    user = auth_register('max.smith@gmail.com',
+                         'great_password101', 'Max', 'Smith')
+    path = str(tmp_path / 'sessions.dat')
+
+    get_tokens().save(path)
+    sessions = Sessions.load(path)
+    assert user['token'] in sessions
+    assert sessions[user['token']] == user['u_id']
+
+
 def test_passwordreset_request():
     workspace_reset()
     auth_register('comp1531resetpass@gmail.com', 'password123', 'Max', 'Smith')
@@ -330,7 +361,7 @@ def test_reseting_password():
         'Max',
         'Smith')
     auth_logout(reg_dict['token'])
-    data.users.set_password(reg_dict['u_id'], 'wubbalubba')
+    data.users.set_password(reg_dict['u_id'], sha256(b'wubbalubba').hexdigest())
     auth_login('comp1531resetpass@gmail.com', 'wubbalubba')
 
 
@@ -358,9 +389,9 @@ def test_reseting_multiple_passwords():
         'password123',
         'Bob',
         'Smith')
-    data.users.set_password(reg_dict['u_id'], 'wubbalubba')
-    data.users.set_password(reg_dict2['u_id'], 'poorpassword')
-    data.users.set_password(reg_dict3['u_id'], 'great_password')
+    data.users.set_password(reg_dict['u_id'], sha256(b'wubbalubba').hexdigest())
+    data.users.set_password(reg_dict2['u_id'], sha256(b'poorpassword').hexdigest())
+    data.users.set_password(reg_dict3['u_id'], sha256(b'great_password').hexdigest())
 
     auth_logout(reg_dict['token'])
     auth_logout(reg_dict2['token'])
@@ -368,3 +399,27 @@ def test_reseting_multiple_passwords():
     auth_login('comp1531resetpass@gmail.com', 'wubbalubba')
     auth_login('comp2521resetpass@gmail.com', 'poorpassword')
     auth_login('comp3521resetpass@gmail.com', 'great_password')
+
+
+# A reset code changes the password once, and not at all after it expires
+def test_passwordreset_reset_code(monkeypatch):
+    workspace_reset()
+    monkeypatch.setattr(Codes, '_send_email', lambda self, email: None)
+    auth_logout(auth_register('comp1531resetpass@gmail.com', 'password123',
+                              'Max', 'Smith')['token'])
+    codes = get_store().codes
+
+    auth_passwordreset_request('comp1531resetpass@gmail.com')
+    reset_code = codes._codes_dict['comp1531resetpass@gmail.com']  # pylint: disable=protected-access
+    auth_passwordreset_reset(reset_code, 'wubbalubba')
+    auth_logout(auth_login('comp1531resetpass@gmail.com', 'wubbalubba')['token'])
+    with pytest.raises(InputError):
+        auth_passwordreset_reset(reset_code, 'poorpassword')
+
+    auth_passwordreset_request('comp1531resetpass@gmail.com')
+    reset_code = codes._codes_dict['comp1531resetpass@gmail.com']  # pylint: disable=protected-access
+    later = time() + RESET_CODE_TTL + 1
+    monkeypatch.setattr(state, 'time', lambda: later)
+    with pytest.raises(InputError):
+        auth_passwordreset_reset(reset_code, 'poorpassword')
+    auth_login('comp1531resetpass@gmail.com', 'wubbalubba')
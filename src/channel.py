@@ -3,6 +3,8 @@ This file contains all the implementations and data relevant to channel function
 '''
 #pylint: disable=trailing-whitespace
 
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import binascii
 from state import get_store, get_tokens
 from auth import verify_token
 from error import InputError, AccessError
@@ -81,21 +83,55 @@ def channel_details(token, channel_id):
     }
 
 
-def channel_messages(token, channel_id, start):
+def encode_cursor(message):
+    '''
+    Creates an opaque cursor pointing at a message
+    Args: message (dict): containing message_id and time_created
+    Return: cursor (str)
+    '''
+    anchor = f"{message['time_created']!r}:{message['message_id']}"
+    return urlsafe_b64encode(anchor.encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''
+    Reads back the (time_created, message_id) anchor of a cursor
+    Args: cursor (str)
+    Raises: InputError if the cursor was not created by encode_cursor
+    Return: (time_created (float), message_id (int))
+    '''
+    try:
+        time_created, message_id = urlsafe_b64decode(
+            cursor.encode()).decode().split(':')
+        return float(time_created), int(message_id)
+    except (ValueError, binascii.Error, UnicodeError):
+        raise InputError(description='Invalid cursor')
+
+
+def channel_messages(token, channel_id, start, before=None, after=None):
     '''
     Lists up to 50 messages within 'channel_id', beginning from the message indexed 'start'.
+    If a 'before' or 'after' cursor is given, lists up to 50 messages older or newer
+    than the message it points at instead; pages fetched by cursor do not shift
+    when new messages are sent.
     Args:
         token (str): of the user authorising this action
         channel_id (int): of the channel whose messages require displaying
         start (int): index of the first message to display
+        before (str): cursor from a previous call, to page towards older messages
+        after (str): cursor from a previous call, to page towards newer messages
     Raises:
         AccessError:
             if token invalid
             if authorised user does not hav permission to view the channel's messages
         InputError:
             if channel_id does not correspond to a valid channel
+            if both 'before' and 'after' are given, or either is not a valid cursor
     Return: List of 50 messages from channel with channel_id
-        starting from index 'start', if we reached the end of the list we set the 'end' index to -1
+        starting from index 'start', if we reached the end of the list we set the 'end' index to -1.
+        'before' is a cursor to the next older page (-1 if there are no older messages)
+        and 'after' is a cursor to the messages newer than this page.
+        When paging by cursor 'start' and 'end' are not included.
     '''
     # verify the user
     if verify_token(token) is False:
@@ -112,12 +148,32 @@ def channel_messages(token, channel_id, start):
     if not data.user_channel.is_member(u_id, channel_id):
         raise AccessError(
             description="You do not have permission to view this channel's messages")
-    # getting the messages of the channel
-    details = channel_id, start
-    messages, more = data.channel_messages(u_id, details)
+    if before is not None and after is not None:
+        raise InputError(description='Cannot page both before and after a cursor')
+
+    # getting the messages of the channel by index
+    if before is None and after is None:
+        details = channel_id, start
+        messages, more = data.channel_messages(u_id, details)
+        return {"messages": messages,
+                "start": start,
+                "end": -1 if not more else start + MESSAGE_BLOCK,
+                "before": encode_cursor(messages[-1]) if more else -1,
+                "after": encode_cursor(messages[0]) if messages else -1
+               }
+
+    # getting the messages of the channel by cursor
+    cursor = before if before is not None else after
+    details = channel_id, decode_cursor(cursor), before is not None
+    messages, more = data.channel_messages_from(u_id, details)
+    if messages:
+        newest = encode_cursor(messages[0])
+    else:
+        # nothing newer yet, so the caller can keep polling with the same cursor
+        newest = after if after is not None else -1
     return {"messages": messages,
-            "start": start,
-            "end": -1 if not more else start + MESSAGE_BLOCK
+            "before": encode_cursor(messages[-1]) if more and messages else -1,
+            "after": newest
            }
 
 
@@ -46,12 +46,15 @@ def messages():
     token = request.args.get('token')
     channel_id = request.args.get('channel_id')
     start = request.args.get('start')
+    before = request.args.get('before')
+    after = request.args.get('after')
 
-    if not token or not channel_id or start is None:
+    if not token or not channel_id or (start is None and not before and not after):
         raise RequestError(description="Missing data in request body")
 
-    to_send = channel.channel_messages(token,
-                                       int(channel_id), int(start))
+    to_send = channel.channel_messages(token, int(channel_id),
+                                       int(start) if start is not None else 0,
+                                       before=before or None, after=after or None)
 
     return json.dumps(to_send)
 
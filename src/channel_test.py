@@ -479,6 +479,65 @@ def test_channel_messages_unauthorized_user(reset, create_public_channel):
                          channel_id['channel_id'], 0)
 
 
+def test_channel_messages_before_cursor(reset, create_public_channel):
+    '''
+    Testing that paging with a 'before' cursor continues from the previous page
+    even if new messages were sent in between
+    '''
+    channel_id, owner_info = create_public_channel
+    # the first message of the channel was sent by hangman bot
+    for i in range(60):
+        message_send(owner_info['token'],
+                     channel_id['channel_id'], "message " + str(i))
+
+    first_page = channel_messages(
+        owner_info['token'], channel_id['channel_id'], 0)
+    # new messages would shift an index based second page
+    message_send(owner_info['token'], channel_id['channel_id'], "newest")
+    second_page = channel_messages(owner_info['token'], channel_id['channel_id'], 0,
+                                   before=first_page['before'])
+
+    assert first_page['messages'][-1]['message'] == "message 10"
+    assert second_page['messages'][0]['message'] == "message 9"
+    assert len(second_page['messages']) == 11
+    assert second_page['before'] == -1
+
+
+def test_channel_messages_after_cursor(reset, create_public_channel):
+    '''
+    Testing that an 'after' cursor returns only the messages sent after the page
+    '''
+    channel_id, owner_info = create_public_channel
+    message_send(owner_info['token'], channel_id['channel_id'], "old")
+    page = channel_messages(owner_info['token'], channel_id['channel_id'], 0)
+
+    # no new messages yet; the cursor is handed back for polling
+    newer = channel_messages(owner_info['token'], channel_id['channel_id'], 0,
+                             after=page['after'])
+    assert newer['messages'] == []
+    assert newer['after'] == page['after']
+
+    message_send(owner_info['token'], channel_id['channel_id'], "new 1")
+    message_send(owner_info['token'], channel_id['channel_id'], "new 2")
+    newer = channel_messages(owner_info['token'], channel_id['channel_id'], 0,
+                             after=page['after'])
+    assert [msg['message'] for msg in newer['messages']] == ["new 2", "new 1"]
+
+
+def test_channel_messages_invalid_cursor(reset, create_public_channel):
+    '''
+    Testing that an invalid cursor, or both cursors at once, raise an InputError
+    '''
+    channel_id, owner_info = create_public_channel
+    page = channel_messages(owner_info['token'], channel_id['channel_id'], 0)
+    with pytest.raises(InputError):
+        channel_messages(owner_info['token'], channel_id['channel_id'], 0,
+                         before="not a cursor")
+    with pytest.raises(InputError):
+        channel_messages(owner_info['token'], channel_id['channel_id'], 0,
+                         before=page['after'], after=page['after'])
+
+
 '''------------------testing channel_leave--------------------'''
 
 
@@ -903,3 +962,24 @@ def test_channel_removeowner_invalid_token(reset, create_public_channel):
     with pytest.raises(AccessError):
         channel_removeowner('I am not a valid token',
                             channel_id['channel_id'], owner_info['u_id'])
+
+
+def test_channel_messages_equal_times(reset, create_public_channel, monkeypatch):
+    '''
+    Testing that messages sent at the same time keep the order they were sent in,
+    both within a page and across a 'before' cursor
+    '''
+    channel_id, owner_info = create_public_channel
+    monkeypatch.setattr('message.time', lambda: 4000000000.0)
+    for i in range(60):
+        message_send(owner_info['token'],
+                     channel_id['channel_id'], "message " + str(i))
+
+    first_page = channel_messages(
+        owner_info['token'], channel_id['channel_id'], 0)
+    second_page = channel_messages(owner_info['token'], channel_id['channel_id'], 0,
+                                   before=first_page['before'])
+    texts = [msg['message'] for msg in first_page['messages'] + second_page['messages']]
+    # the hangman bot message was sent first, before the clock was frozen
+    assert texts[:-1] == ["message " + str(i) for i in range(60)]
+    assert second_page['before'] == -1
@@ -1,12 +1,16 @@
 '''
 This file contains implementation for channels functions
 '''
-from state import get_store, get_tokens
+from json import dumps
+from state import get_store, get_tokens, get_cache
 from auth import verify_token
 from error import InputError, AccessError
 from message import message_send
 from hangman import create_hbot
 
+# number of channels a search returns by default
+CHANNELS_SEARCH_LIMIT = 10
+
 
 def channels_list(token):
     '''
@@ -21,7 +25,7 @@ def channels_list(token):
     # get database
     data = get_store()
     # getting id of the user
-    # get_tokens() should return a dictionary where token key corresponds to
+    # get_tokens() should return a store where token key corresponds to
     # that user's id
     u_id = get_tokens()[token]
 
@@ -51,6 +55,72 @@ def channels_listall(token):
     }
 
 
+def channels_list_json(token):
+    '''
+    channels_list serialised as JSON. The response is cached until the user
+    joins or leaves a channel or a channel is added
+    Parameter: authorised token
+    Returns: JSON string of the channels the authorised user is part of
+    '''
+    # verify the user
+    if verify_token(token) is False:
+        raise AccessError(description='Invalid token')
+
+    data = get_store()
+    u_id = get_tokens()[token]
+
+    # read the versions before building, so a concurrent change leaves
+    # the response filed under the older version
+    version = data.channels.version(), data.user_channel.version(u_id)
+    response = get_cache().get(('list', u_id), version)
+    if response is None:
+        response = dumps({'channels': data.user_channels(u_id)})
+        get_cache().put(('list', u_id), version, response)
+    return response
+
+
+def channels_listall_json(token):
+    '''
+    channels_listall serialised as JSON. The response is cached until a channel is added
+    Parameter: token
+    Returns: JSON string of ALL channels in Slackr
+    '''
+    # verify the user
+    if verify_token(token) is False:
+        raise AccessError(description='Invalid token')
+
+    data = get_store()
+
+    version = data.channels.version()
+    response = get_cache().get(('listall',), version)
+    if response is None:
+        response = dumps({'channels': data.channels.all()})
+        get_cache().put(('listall',), version, response)
+    return response
+
+
+def channels_search(token, query_str, limit=CHANNELS_SEARCH_LIMIT):
+    '''
+    Finds the channels the user can see whose name contains query_str, ignoring case.
+    Names starting with query_str are listed first
+    Parameters: token, query_str, limit (maximum number of channels to return)
+    Returns: list of matching channels (and associated details)
+    '''
+    # verify the user
+    if verify_token(token) is False:
+        raise AccessError(description='Invalid token')
+
+    if limit < 1:
+        raise InputError(description='limit must be a positive number')
+
+    data = get_store()
+    u_id = get_tokens()[token]
+
+    return {
+        'channels': data.channel_search(u_id, query_str, limit)
+    }
+
+
 def channels_create(token, name, is_public):
     '''
     Input: token, name, is_public status
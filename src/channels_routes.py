@@ -4,7 +4,7 @@ This module contains all the routes for channels functionalities
 
 from json import dumps
 from flask import request, Blueprint
-from channels import channels_list, channels_listall, channels_create
+from channels import channels_list_json, channels_listall_json, channels_create, channels_search
 from error import RequestError
 CHANNELS = Blueprint('channels', __name__)
 
@@ -19,8 +19,7 @@ def c_list():
     if not token:
         raise RequestError(description="Missing data in request body")
 
-    response = channels_list(token)
-    return dumps(response)
+    return channels_list_json(token)
 
 
 @CHANNELS.route("/listall", methods=['GET'])
@@ -33,7 +32,25 @@ def listall():
     if not token:
         raise RequestError(description="Missing data in request body")
 
-    response = channels_listall(token)
+    return channels_listall_json(token)
+
+
+@CHANNELS.route("/search", methods=['GET'])
+def search():
+    '''
+    a route which calls channels_search
+    '''
+    token = request.args.get('token')
+    query_str = request.args.get('query_str')
+    limit = request.args.get('limit')
+
+    if not token or query_str is None:
+        raise RequestError(description="Missing data in request body")
+
+    if limit:
+        response = channels_search(token, query_str, int(limit))
+    else:
+        response = channels_search(token, query_str)
     return dumps(response)
 
 
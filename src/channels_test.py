@@ -2,10 +2,12 @@
 Tests for channels functionalities
 '''
 
+from json import loads
 import pytest
-from channel import channel_invite, channel_details
+from channel import channel_invite, channel_details, channel_leave
 from auth import auth_register
 from channels import channels_list, channels_listall, channels_create
+from channels import channels_list_json, channels_listall_json, channels_search
 from error import InputError, AccessError
 from other import workspace_reset
 
@@ -213,6 +215,52 @@ def test_channels_create_correct_details():  # pylint: disable=missing-function-
     }
 
 
+# testing that the cached JSON listings follow joins, leaves and new channels
+def test_channels_list_json_cache():  # pylint: disable=missing-function-docstring
+    workspace_reset()
+    user_ab = auth_register("alice@gmail.com", "password11", "Alice", "Bee")
+    user_cd = auth_register("charlie@gmail.com",
+                            "pw321ABC", "Charlie", "Dragon")
+    channel_id = channels_create(
+        user_ab['token'], 'public_test_1', True)['channel_id']
+
+    assert loads(channels_list_json(user_cd['token'])) == {'channels': []}
+    channel_invite(user_ab['token'], channel_id, user_cd['u_id'])
+    assert loads(channels_list_json(user_cd['token'])) == channels_list(
+        user_cd['token'])
+    channel_leave(user_cd['token'], channel_id)
+    assert loads(channels_list_json(user_cd['token'])) == {'channels': []}
+
+    assert loads(channels_listall_json(user_cd['token'])) == channels_listall(
+        user_cd['token'])
+    channels_create(user_cd['token'], 'public_test_2', True)
+    assert len(loads(channels_listall_json(user_cd['token']))['channels']) == 2
+
+
+# testing that channels_search matches by prefix then substring, and hides
+# private channels from non-members
+def test_channels_search():  # pylint: disable=missing-function-docstring
+    workspace_reset()
+    user_ab = auth_register("alice@gmail.com", "password11", "Alice", "Bee")
+    user_cd = auth_register("charlie@gmail.com",
+                            "pw321ABC", "Charlie", "Dragon")
+    general = channels_create(user_ab['token'], 'General', True)['channel_id']
+    channels_create(user_ab['token'], 'secret_general', False)
+    dev_general = channels_create(
+        user_cd['token'], 'dev_general', True)['channel_id']
+    channels_create(user_cd['token'], 'random', True)
+
+    found = channels_search(user_cd['token'], 'GENERAL')['channels']
+    assert found == [
+        {'channel_id': general, 'name': 'General'},
+        {'channel_id': dev_general, 'name': 'dev_general'},
+    ]
+    assert len(channels_search(user_ab['token'], 'general')['channels']) == 3
+    assert channels_search(user_ab['token'], 'ge')['channels'] == [
+        {'channel_id': general, 'name': 'General'}]
+    assert len(channels_search(user_ab['token'], 'general', 1)['channels']) == 1
+
+
 def test_channels_create_invalid_status():  # pylint: disable=missing-function-docstring
     '''
     Testing giving create an invalid is_public status
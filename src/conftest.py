@@ -0,0 +1,44 @@
+'''
+Lets the unit tests run against another storage backend than the default, e.g.
+    python3 -m pytest --backend sqlite
+'''
+import pytest  # pylint: disable=import-error
+import state
+
+
+def pytest_addoption(parser):
+    '''
+    Adds the --backend option
+    '''
+    parser.addoption('--backend', default='memory', choices=('memory', 'columnar', 'sqlite'),
+                     help='the storage backend the tests run against')
+
+
+def pytest_configure(config):
+    '''
+    Replaces the store with one of the chosen backend before any test runs
+    '''
+    backend = config.getoption('backend')
+    if backend == 'memory':
+        return
+    state.STORAGE_BACKEND = backend
+    if backend != 'sqlite':
+        # a fresh Database picks its message store from the backend,
+        # the sqlite one is opened in a temporary directory by state_files
+        state.get_store().reset()
+
+
+@pytest.fixture(autouse=True, scope='session')
+def state_files(tmp_path_factory):
+    '''
+    Writes the snapshots, the write-ahead log, the saved sessions and the SQLite
+    file of the tests to a temporary directory rather than the source tree
+    '''
+    directory = tmp_path_factory.mktemp('state')
+    state.DATABASE_FILE = str(directory / 'database.p')
+    state.WAL_FILE = str(directory / 'database.wal')
+    state.SNAPSHOT_DIR = str(directory / 'snapshot')
+    state.SESSIONS_FILE = str(directory / 'sessions.dat')
+    if state.STORAGE_BACKEND == 'sqlite':
+        state.SQLITE_FILE = str(directory / 'database.db')
+        state.initialize_store()
@@ -62,7 +62,7 @@ def create_hbot(ch_id):
         name_first, name_last)
     hbot_id = data.add_user(details)
     hbot_token = generate_token(hbot_id)
-    get_tokens()[hbot_token] = hbot_id
+    get_tokens().add(hbot_token, hbot_id, expires=False)
 
     # Add the Hangman Bot to the channel just created
     data.user_channel.add_link(hbot_id, ch_id, is_owner=True)
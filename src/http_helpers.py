@@ -471,6 +471,20 @@ def user_remove(token, u_id):
     urllib.request.urlopen(request)
 
 
+
+def snapshot_stats(token):
+    '''
+    HTTP request to view the statistics of the database snapshots
+    '''
+    query = urllib.parse.urlencode({
+        'token': token
+    })
+
+    payload = json.load(urllib.request.urlopen(
+        f"{urls.SNAPSHOT_STATS_URL}?{query}"))
+
+    return payload
+
 def users_all(token):
     '''
     HTTP request to access the profiles of all users
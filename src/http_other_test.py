@@ -6,11 +6,12 @@ HTTP tests for functions in other.py
 # pylint: disable=unused-import
 import json
 import urllib.request
+import urllib.parse
 from urllib.error import HTTPError
 import pytest
 import urls
 from http_helpers import (reset, register, login, logout,
-                          userpermission_change, user_remove, users_all,
+                          userpermission_change, user_remove, users_all, snapshot_stats,
                           search, channels_create, message_send,
                           channel_messages, channel_join, channel_details)
 
@@ -195,6 +196,29 @@ def test_users_all(reset):
     assert everyone[3]['u_id'] == h_id
 
 
+def test_users_all_not_modified(reset):
+    '''
+    A client holding the current ETag gets a 304 until the directory changes
+    '''
+    j_token = register("joshwang@gmail.com",
+                       "paris in the rain", "Josh", "Wang")[1]
+    query = urllib.parse.urlencode({'token': j_token})
+    response = urllib.request.urlopen(f"{urls.USERS_ALL_URL}?{query}")
+    etag = response.headers['ETag']
+    assert etag
+
+    request = urllib.request.Request(f"{urls.USERS_ALL_URL}?{query}",
+                                     headers={'If-None-Match': etag})
+    with pytest.raises(HTTPError) as error:
+        urllib.request.urlopen(request)
+    assert error.value.code == 304
+
+    register("kenli@gmail.com", "pianoforte", "Ken", "Li")
+    response = urllib.request.urlopen(request)
+    assert response.headers['ETag'] != etag
+    assert len(json.load(response)['users']) == 2
+
+
 def test_users_all_data_missing(reset):
     '''
     Invalid requesting missing some data
@@ -329,3 +353,26 @@ def test_search_invalid_token(reset):
     message_send(j_token, ch_id, "First message")
     with pytest.raises(HTTPError):
         search(j_token + 'x', 'First')
+
+
+def test_snapshot_stats(reset):
+    '''
+    The admin can see how the snapshots of the database are going
+    '''
+    j_token = register("joshwang@gmail.com",
+                       "paris in the rain", "Josh", "Wang")[1]
+    stats = snapshot_stats(j_token)['stats']
+    # the server snapshots the database unless it writes itself to disk
+    if stats is not None:
+        assert stats['snapshots'] >= 0
+        assert stats['pending_mutations'] >= 0
+
+
+def test_snapshot_stats_not_admin(reset):
+    '''
+    Invalid request from a member who is not an admin
+    '''
+    register("joshwang@gmail.com", "paris in the rain", "Josh", "Wang")
+    k_token = register("kenli@hotmail.com", "asd;fkljas;dfljklas;df", "Ken", "Li")[1]
+    with pytest.raises(HTTPError):
+        snapshot_stats(k_token)
@@ -0,0 +1,28 @@
+'''
+The message function tests, run again against a Database that keeps
+its messages in ColumnarMessages
+'''
+
+#pylint: disable=redefined-outer-name
+#pylint: disable=wildcard-import
+#pylint: disable=unused-wildcard-import
+
+import pytest  # pylint: disable=import-error
+import state
+from message_test import *
+
+
+@pytest.fixture(autouse=True)
+def columnar_backend():
+    '''
+    Switches the store to the columnar backend for each test, and back after it
+    '''
+    if state.STORAGE_BACKEND == 'sqlite':
+        pytest.skip('the sqlite backend does not keep messages in memory')
+    backend = state.STORAGE_BACKEND
+    state.STORAGE_BACKEND = 'columnar'
+    state.get_store().reset()
+    assert isinstance(state.get_store().messages, state.ColumnarMessages)
+    yield
+    state.STORAGE_BACKEND = backend
+    state.get_store().reset()
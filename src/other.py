@@ -4,15 +4,22 @@ that do not belong to a specific category
 '''
 #pylint: disable=trailing-whitespace
 
-import pickle
+import json
+import hashlib
+from itertools import islice
 from user import user_profile
 from standup import get_standup, get_lock
-from state import get_store, get_tokens
-from auth import verify_token, get_token
+from state import get_store, get_tokens, get_cache, get_scheduler, update_database
+from auth import verify_token
+from channel import encode_cursor, decode_cursor
 from error import InputError, AccessError
 
 SLACKR_OWNER = 1
 SLACKR_MEMBER = 2
+# number of users serialised per chunk of a streamed directory
+USERS_STREAM_BATCH = 500
+# number of users a prefix search returns by default
+USERS_SEARCH_LIMIT = 10
 
 
 def userpermission_change(token, u_id, permission_id):
@@ -104,48 +111,206 @@ def user_remove(token, u_id):
     data.user_channel.remove_link_by_user(u_id)
     # removing all the messages sent by that user
     data.remove_messages(u_id)
-    # remove the user the token store if he is logged on
-    token = get_token(u_id)
-    if token is not None:
-        get_tokens().pop(token)
+    # remove the user from the token store if he is logged on
+    get_tokens().remove_user(u_id)
 
 
-def users_all(token):
+
+def snapshot_stats(token):
     '''
-    Lists all users on the slackr
-    Args: token (str)
-    Raises: AccessError if token is invalid
+    Reports how the snapshots of the database are going, for the admins of the slackr
+
+    Args:
+        token (str): of an owner/admin of the slackr
+
+    Raises:
+        AccessError:
+            if token is invalid
+            if the user invoking this action is not an owner/admin of the slackr
+
+    Return:
+        Dictionary: the statistics of the snapshot scheduler under 'stats' -
+            {snapshots, last_duration, last_size, last_finished,
+             pending_mutations, pending_bytes}
+            or None if no scheduler is running, e.g. for a database on disk
+    '''
+    # verify the user
+    if verify_token(token) is False:
+        raise AccessError(description='Invalid token')
+
+    # verify the invoker is an admin
+    if not get_store().admins.is_admin(get_tokens()[token]):
+        raise AccessError(
+            description="You do not have permission to view snapshot statistics")
+
+    scheduler = get_scheduler()
+    return {
+        'stats': None if scheduler is None else scheduler.stats()
+    }
+
+def users_all(token, limit=None, after=None):
+    '''
+    Lists all users on the slackr, in u_id order
+    Args:
+        token (str)
+        limit (int): the maximum number of users to return, None for all of them
+        after (int): cursor from a previous page, to fetch the next page
+    Raises:
+        AccessError if token is invalid
+        InputError if limit is not positive or after is negative
     Returns: a dictionary containing a list of all users and their associated details -
         u_id, email, name_first, name_last, handle_str
+        and, when limit or after is given, a cursor to the next page under 'after',
+        -1 if there are no more users
     '''
 
     # verify the token is valid
     if verify_token(token) is False:
         raise AccessError(description="invalid token")
 
+    check_page(limit, after)
+
     # return a dictionary which contains one key, "users", which is itself a list of dictionaries
     # containing types u_id, email, name_first, name_last, handle_str
     data = get_store()
 
-    return {"users": data.users.all()}
+    if limit is None and after is None:
+        return {"users": data.users.all()}
+
+    # one extra user tells whether there is another page
+    users = list(islice(data.users.iter_users(after or 0),
+                        None if limit is None else limit + 1))
+    if limit is None or len(users) <= limit:
+        return {"users": users, "after": -1}
+    return {"users": users[:limit], "after": users[limit - 1]['u_id']}
+
+
+def check_page(limit, after):
+    '''
+    Checks the paging arguments of users_all
+    Raises: InputError if limit is not positive or after is negative
+    '''
+    if limit is not None and limit < 1:
+        raise InputError(description="limit must be a positive number")
+    if after is not None and after < 0:
+        raise InputError(description="Invalid cursor")
+
+
+def users_all_stream(token, limit=None, after=None):
+    '''
+    Lists users on the slackr as JSON, in chunks of USERS_STREAM_BATCH users,
+    so the whole directory is never serialised at once
+    Args: the same as users_all
+    Raises: the same as users_all
+    Returns: a generator of str chunks which together form the users_all response
+    '''
+    # checked before streaming starts so an invalid request still gets an error response
+    if verify_token(token) is False:
+        raise AccessError(description="invalid token")
+    check_page(limit, after)
+
+    directory = get_store().users.iter_users(after or 0)
+    users = directory if limit is None else islice(directory, limit)
+
+    def chunks():
+        '''
+        Serialises the users a batch at a time
+        '''
+        separator = ''
+        last_u_id = -1
+        try:
+            yield '{"users": ['
+            while True:
+                batch = list(islice(users, USERS_STREAM_BATCH))
+                if not batch:
+                    break
+                yield separator + ', '.join(map(json.dumps, batch))
+                separator = ', '
+                last_u_id = batch[-1]['u_id']
+            if limit is None and after is None:
+                yield ']}'
+                return
+            # a user left over tells whether there is another page
+            more = limit is not None and next(directory, None) is not None
+            yield '], "after": ' + str(last_u_id if more else -1) + '}'
+        finally:
+            # the chunks are read after the request's own teardown has run,
+            # so what they took of the database is handed back here
+            get_store().release()
+
+    return chunks()
+
+
+def users_all_json(token):
+    '''
+    users_all serialised as JSON, with a strong ETag for the payload. Both are
+    cached until the user directory changes
+    Args: token (str)
+    Raises: AccessError if token is invalid
+    Returns: a tuple of the JSON payload (str) and its quoted ETag (str)
+    '''
+    if verify_token(token) is False:
+        raise AccessError(description="invalid token")
+
+    data = get_store()
+
+    version = data.users.version()
+    response = get_cache().get(('users_all',), version)
+    if response is None:
+        payload = json.dumps({"users": data.users.all()})
+        # the digest rather than the version names the payload, since versions
+        # restart whenever the workspace is reset
+        etag = '"' + hashlib.sha256(payload.encode()).hexdigest()[:32] + '"'
+        response = payload, etag
+        get_cache().put(('users_all',), version, response)
+    return response
 
 
-def search(token, query_str):
+def users_search(token, prefix, limit=USERS_SEARCH_LIMIT):
+    '''
+    Finds the users whose handle, first or last name starts with prefix, ignoring case
+    Args:
+        token (str)
+        prefix (str): the start of the name to look for
+        limit (int): the maximum number of users to return
+    Raises:
+        AccessError if token is invalid
+        InputError if limit is not positive
+    Returns: a dictionary containing a list of the matching users and their details -
+        u_id, email, name_first, name_last, handle_str
+    '''
+    if verify_token(token) is False:
+        raise AccessError(description="invalid token")
+
+    if limit < 1:
+        raise InputError(description="limit must be a positive number")
+
+    data = get_store()
+    return {"users": data.users.search_prefix(prefix, limit)}
+
+
+def search(token, query_str, limit=None, before=None):
     '''
     Searches all channels which invoking user is part of
-    for messages containing the query string.
+    for messages containing the query string, newest first.
 
     Args:
         token (str): of the use authorising this action
+        query_str (str): the string to search for
+        limit (int): the maximum number of messages to return, None for all of them
+        before (str): cursor from a previous search, to fetch the next page
 
     Raises:
         AccessError: if token is invalid
-        InputError: if query_str is over 1000 char long
+        InputError: if query_str is over 1000 char long, if limit is not positive
+            or if before is not a valid cursor
 
     Returns:
         Dictionary: containing a list of message dictionaries containing
             information of each message that contains the query_str -
             {message_id, u_id, message, time_created, reacts, is_pinned}
+            and, when limit or before is given, a cursor to the next page under 'before',
+            -1 if there are no more results
     '''
     # verify the token is valid
     if verify_token(token) is False:
@@ -158,16 +323,33 @@ def search(token, query_str):
         raise InputError(
             description="query_str over 1000 characaters; too long")
 
+    if limit is not None and limit < 1:
+        raise InputError(description="limit must be a positive number")
+
+    # the cursor resumes the search from its message
+    cursor = decode_cursor(before) if before is not None else None
+
     # empty query_str returns an empty list
     if query_str == "":
+        messages = []
+    else:
+        # find all the channels the user is a part of and search for query_str in
+        # the messages; one extra message tells whether there is another page
+        messages = data.message_search(auth_u_id, query_str,
+                                       None if limit is None else limit + 1, cursor)
+
+    if limit is None and before is None:
         return {
-            'messages': []
+            'messages': messages
+        }
+    if limit is None or len(messages) <= limit:
+        return {
+            'messages': messages,
+            'before': -1
         }
-
-    # find all the channels the user is a part of and search for query_str in
-    # the messages
     return {
-        'messages': data.message_search(auth_u_id, query_str)
+        'messages': messages[:limit],
+        'before': encode_cursor(messages[limit - 1])
     }
 
 
@@ -175,8 +357,9 @@ def workspace_reset():
     '''
     Resets the workspace state. Assumes that the base state of database.p has a Database() instance.
     '''
-    # clear the tokens dictionary
+    # clear the tokens dictionary and the responses built from the old state
     get_tokens().clear()
+    get_cache().clear()
 
     # clear database.p
     data = get_store()
@@ -186,5 +369,9 @@ def workspace_reset():
         standups = get_standup()
         standups.clear()
 
-    with open("database.p", "wb") as database_file:
-        pickle.dump(data, database_file)
+    # a running scheduler snapshots the empty workspace straight away, otherwise it
+    # is snapshotted here, so that a restart does not load the old workspace back
+    if get_scheduler() is not None:
+        get_scheduler().request()
+    else:
+        update_database(background=False)
@@ -4,7 +4,7 @@ This module contains all the routes for miscellaneous functionalities
 
 import json
 import io
-from flask import request, Blueprint, send_file
+from flask import request, Blueprint, send_file, Response, stream_with_context
 from PIL import Image
 import other
 from error import RequestError
@@ -54,18 +54,64 @@ def user_remove():
     return json.dumps({})
 
 
+
+@OTHER.route('/admin/snapshot/stats', methods=['GET'])
+def snapshot_stats():
+    '''
+    A wrapper for other.snapshot_stats()
+    '''
+    token = request.args.get('token')
+    if not token:
+        raise RequestError(description='Missing data in request body')
+
+    return json.dumps(other.snapshot_stats(token))
+
 @OTHER.route('/users/all', methods=['GET'])
 def users_all():
     '''
     Wrapper for users_all
     '''
     token = request.args.get('token')
+    limit = request.args.get('limit')
+    after = request.args.get('after')
 
     if not token:
         raise RequestError(description="Missing data in request body")
 
-    every_user = other.users_all(token)
-    return json.dumps(every_user)
+    limit = int(limit) if limit else None
+    after = int(after) if after else None
+    if request.args.get('stream') == 'true':
+        # the request context, and the store it uses, stays open while the chunks are sent
+        return Response(stream_with_context(other.users_all_stream(token, limit, after)),
+                        mimetype='application/json')
+    if limit is not None or after is not None:
+        return json.dumps(other.users_all(token, limit, after))
+
+    payload, etag = other.users_all_json(token)
+    headers = {'ETag': etag}
+    # the client's copy is current, skip sending the directory again
+    if request.if_none_match.contains_weak(etag.strip('"')):
+        return '', 304, headers
+    return payload, 200, headers
+
+
+@OTHER.route('/users/search', methods=['GET'])
+def users_search():
+    '''
+    Wrapper for users_search
+    '''
+    token = request.args.get('token')
+    prefix = request.args.get('prefix')
+    limit = request.args.get('limit')
+
+    if not token or prefix is None:
+        raise RequestError(description="Missing data in request body")
+
+    if limit:
+        matching_users = other.users_search(token, prefix, int(limit))
+    else:
+        matching_users = other.users_search(token, prefix)
+    return json.dumps(matching_users)
 
 
 @OTHER.route('/search', methods=['GET'])
@@ -75,11 +121,14 @@ def search():
     '''
     token = request.args.get('token')
     query_str = request.args.get('query_str')
+    limit = request.args.get('limit')
+    before = request.args.get('before')
 
     if not token or (not query_str and not query_str == ""):
         raise RequestError(description="Missing data in request body")
 
-    matching_msgs = other.search(token, query_str)
+    matching_msgs = other.search(token, query_str,
+                                 int(limit) if limit else None, before or None)
     return json.dumps(matching_msgs)
 
 
@@ -7,14 +7,17 @@ Integration tests for functions in other.py
 #pylint: disable=missing-function-docstring
 #pylint: disable=unused-argument
 
+from json import loads
 import pytest
-from other import users_all, search, userpermission_change, user_remove, workspace_reset
+from other import users_all, users_all_stream, users_search, search, userpermission_change, user_remove, workspace_reset, \
+    snapshot_stats
 from auth import auth_register, auth_logout
 from channels import channels_create
 from message import message_send
 from error import InputError, AccessError
 from channel import channel_invite, channel_join, channel_leave, channel_messages, channel_details
-from user import user_profile
+from user import user_profile, user_profile_setname
+import state
 
 SLACKR_OWNER = 1
 SLACKR_MEMBER = 2
@@ -243,6 +246,91 @@ def test_users_all_invalid_token_error():
         users_all(user_ef["token"] + "invalid")
 
 
+def test_users_all_pages():
+    workspace_reset()
+    tokens = [auth_register(f"user{i}@gmail.com", "12345687", "User", f"Number{i}")["token"]
+              for i in range(5)]
+    everyone = users_all(tokens[0])["users"]
+
+    first = users_all(tokens[0], 2)
+    assert first["users"] == everyone[:2]
+    second = users_all(tokens[0], 2, first["after"])
+    assert second["users"] == everyone[2:4]
+    last = users_all(tokens[0], 2, second["after"])
+    assert last == {"users": everyone[4:], "after": -1}
+
+    with pytest.raises(InputError):
+        users_all(tokens[0], 0)
+
+
+def test_users_all_stream():
+    workspace_reset()
+    token = auth_register("edward@gmail.com", "12345687",
+                          "Edward", "Frankenstein")["token"]
+    auth_register("ian@hotmail.com", "ilovetrimesters", "Ian", "Jacobs")
+
+    assert loads(''.join(users_all_stream(token))) == users_all(token)
+    assert "after" not in users_all(token)
+
+
+def test_users_all_stream_pages():
+    workspace_reset()
+    tokens = [auth_register(f"user{i}@gmail.com", "12345687", "User", f"Number{i}")["token"]
+              for i in range(5)]
+    pages = [loads(''.join(users_all_stream(tokens[0], 2)))]
+    while pages[-1]["after"] != -1:
+        pages.append(loads(''.join(users_all_stream(tokens[0], 2, pages[-1]["after"]))))
+    assert pages == [users_all(tokens[0], 2), users_all(tokens[0], 2, pages[0]["after"]),
+                     users_all(tokens[0], 2, pages[1]["after"])]
+    assert [len(page["users"]) for page in pages] == [2, 2, 1]
+
+    with pytest.raises(InputError):
+        users_all_stream(tokens[0], 0)
+
+
+def test_users_search_prefix():
+    workspace_reset()
+    user_ef = auth_register(
+        "edward@gmail.com", "12345687", "Edward", "Frankenstein")
+    user_ij = auth_register("ian@hotmail.com", "ilovetrimesters", "Ian", "Jacobs")
+    auth_register("kim@hotmail.com", "ilovetrimesters", "Kim", "Edwards")
+
+    found = users_search(user_ef["token"], "ED")["users"]
+    assert [user["name_first"] for user in found] == ["Edward", "Kim"]
+    assert users_search(user_ef["token"], "ed", 1)["users"] == found[:1]
+
+    user_profile_setname(user_ij["token"], "Edwina", "Jacobs")
+    assert len(users_search(user_ef["token"], "edw")["users"]) == 3
+    assert users_search(user_ef["token"], "edwi")["users"] == [
+        user_profile(user_ij["token"], user_ij["u_id"])["user"]]
+
+
+'''------------------testing snapshot_stats--------------------'''
+
+
+def test_snapshot_stats(reset, make_user_ab, monkeypatch):
+    monkeypatch.setattr(state, 'SCHEDULER', None)
+    assert snapshot_stats(make_user_ab['token']) == {'stats': None}
+
+    scheduler = state.SnapshotScheduler()
+    monkeypatch.setattr(state, 'SCHEDULER', scheduler)
+    channels_create(make_user_ab['token'], "snapshotted", True)
+    stats = snapshot_stats(make_user_ab['token'])['stats']
+    assert stats == scheduler.stats()
+    assert stats['snapshots'] == 0
+    assert stats['pending_mutations'] > 0
+
+
+def test_snapshot_stats_not_admin(reset, make_user_ab, make_user_cd):
+    with pytest.raises(AccessError):
+        snapshot_stats(make_user_cd['token'])
+
+
+def test_snapshot_stats_invalid_token(reset, make_user_ab):
+    with pytest.raises(AccessError):
+        snapshot_stats(make_user_ab['token'] + 'a')
+
+
 '''------------------testing search--------------------'''
 # reminder
 # input: (token, query_str); output: {messages}
@@ -408,6 +496,63 @@ def test_search_invalid_token(reset, create_public_channel):
         search(user_ab['token'] + 'a', "Search string")
 
 
+# without a limit or a cursor, search keeps returning only the messages
+def test_search_without_limit_has_no_cursor(reset, create_public_channel):
+    new_public_channel, user_ab = create_public_channel
+    message_send(user_ab['token'], new_public_channel['channel_id'], "Hello world!")
+
+    assert set(search(user_ab['token'], "Hello")) == {'messages'}
+    assert search(user_ab['token'], "") == {'messages': []}
+    assert set(search(user_ab['token'], "Hello", limit=1)) == {'messages', 'before'}
+
+
+# a limit returns the newest matches first, with a cursor to the next page
+def test_search_limit_and_cursor(reset, create_public_channel):
+    new_public_channel, user_ab = create_public_channel
+    msg_ids = [message_send(user_ab['token'], new_public_channel['channel_id'],
+                            f"paged message {i}")['message_id'] for i in range(5)]
+
+    first_page = search(user_ab['token'], "paged", limit=2)
+    assert [msg['message_id'] for msg in first_page['messages']] == \
+        [msg_ids[4], msg_ids[3]]
+
+    second_page = search(user_ab['token'], "paged", limit=2,
+                         before=first_page['before'])
+    assert [msg['message_id'] for msg in second_page['messages']] == \
+        [msg_ids[2], msg_ids[1]]
+
+    last_page = search(user_ab['token'], "paged", limit=2,
+                       before=second_page['before'])
+    assert [msg['message_id'] for msg in last_page['messages']] == [msg_ids[0]]
+    assert last_page['before'] == -1
+
+
+# results are ordered by the time messages were created, even when that disagrees
+# with the order of their ids, and messages sent at the same time keep their order
+@pytest.mark.parametrize('query', ["timed", "#"])
+def test_search_time_order(reset, create_public_channel, monkeypatch, query):
+    new_public_channel, user_ab = create_public_channel
+    times = iter([4000000003.0, 4000000001.0, 4000000002.0, 4000000002.0, 4000000000.0])
+    monkeypatch.setattr('message.time', lambda: next(times))
+    msg_ids = [message_send(user_ab['token'], new_public_channel['channel_id'],
+                            f"#{i} timed")['message_id'] for i in range(5)]
+    expected = [msg_ids[0], msg_ids[2], msg_ids[3], msg_ids[1], msg_ids[4]]
+
+    assert [msg['message_id'] for msg in search(user_ab['token'], query)['messages']] \
+        == expected
+    pages = [search(user_ab['token'], query, limit=2)]
+    while pages[-1]['before'] != -1:
+        pages.append(search(user_ab['token'], query, limit=2, before=pages[-1]['before']))
+    assert [msg['message_id'] for page in pages for msg in page['messages']] == expected
+
+
+def test_search_invalid_limit(reset, create_public_channel):
+    user_ab = create_public_channel[1]
+
+    with pytest.raises(InputError):
+        search(user_ab['token'], "Search string", limit=0)
+
+
 '''Testing userpermission_change'''
 
 
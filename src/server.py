@@ -3,10 +3,6 @@ The server that handles the routes for slackr
 '''
 from json import dumps
 import sys
-import time
-from multiprocessing import Process
-import json
-import requests
 from flask import Flask
 from flask_cors import CORS
 
@@ -33,6 +29,9 @@ class CustomFlask(Flask):
             load_dotenv=True, **options):
         try:
             state.initialize_state()
+            state.start_session_sweeper()
+            state.start_wal_syncer()
+            state.start_snapshot_scheduler()
             super(
                 CustomFlask,
                 self).run(
@@ -41,12 +40,10 @@ class CustomFlask(Flask):
                 debug=debug,
                 load_dotenv=load_dotenv,
                 **options)
-            UPDATE_PROCESS.daemon = True
-            UPDATE_PROCESS.start()
-            UPDATE_PROCESS.join()
         except KeyboardInterrupt:
-            state.update_database()
-            UPDATE_PROCESS.terminate()
+            if state.get_scheduler() is not None:
+                state.get_scheduler().stop()
+            state.update_database(background=False)
             print('Exiting server...')
 
 
@@ -54,6 +51,14 @@ APP = CustomFlask(__name__)
 CORS(APP)
 
 
+@APP.teardown_appcontext
+def release_store(_):
+    '''
+    Frees what the request's thread holds of the database, such as its SQLite connection
+    '''
+    state.get_store().release()
+
+
 # registering the routes in other files
 APP.register_blueprint(OTHER)
 APP.register_blueprint(CHANNEL, url_prefix='/channel')
@@ -79,37 +84,16 @@ def defaultHandler(err):  # pylint: disable=missing-function-docstring
 APP.config['TRAP_HTTP_EXCEPTIONS'] = True
 APP.register_error_handler(Exception, defaultHandler)
 
-# Database update route
-@APP.route("/update", methods=['PUT'])
-def update():
-    '''
-    A regular database updater that is invoked via a seperate process http request
-    '''
-    state.update_database()
-    return json.dumps({})
-
-
-def update_timer():
-    '''
-    An HTTP request to update the database every n seconds
-    '''
-    try:
-        while True:
-            time.sleep(state.SECONDS_TO_UPDATE)
-            requests.put(f"{state.HOST}:{state.PORT}/update")
-    except KeyboardInterrupt:
-        pass
-
-
-UPDATE_PROCESS = Process(target=update_timer)
-
 
 def main():
     '''
-    The main function that runs on the command `pytest3 server.py [PORT]`
+    The main function that runs on the command `pytest3 server.py [PORT] [BACKEND]`,
+    BACKEND being 'memory' (the default), 'columnar' or 'sqlite'
     '''
     print('Server Initiated!')
-    state.PORT = int(sys.argv[1]) if len(sys.argv) == 2 else 8080
+    state.PORT = int(sys.argv[1]) if len(sys.argv) >= 2 else 8080
+    if len(sys.argv) >= 3:
+        state.STORAGE_BACKEND = sys.argv[2]
     APP.run(port=state.PORT)
 
 
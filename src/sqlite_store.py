@@ -0,0 +1,1369 @@
+'''
+A Database that keeps its data in a SQLite file instead of in memory, so that
+it can grow larger than RAM and needs no snapshot to be loaded on start.
+Selected by setting state.STORAGE_BACKEND to 'sqlite'
+'''
+import sqlite3
+import threading
+import queue
+import pickle
+import functools
+from state import (Database, Codes, UserRecord, MessageRecord, LinkRecord,
+                   InputError, MSG_BLOCK, ADMIN, MEMBER, DEFAULT_REACT_ID)
+import state
+
+# seconds a write waits for another connection's transaction before giving up
+SQLITE_TIMEOUT = 30
+# the number of idle connections kept open for the next request thread
+SQLITE_POOL_SIZE = 8
+# the number of users iter_users reads per query
+USERS_BATCH = 500
+
+# ids are AUTOINCREMENT so, like the in-memory stores, they are never reused
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    u_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL,
+    name_first TEXT NOT NULL,
+    name_last TEXT NOT NULL,
+    password TEXT NOT NULL,
+    handle_str TEXT NOT NULL,
+    img_path TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS users_by_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_by_handle ON users (handle_str);
+CREATE TABLE IF NOT EXISTS user_names (
+    name_key TEXT NOT NULL,
+    u_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    PRIMARY KEY (name_key, u_id, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS admins (
+    u_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    name_key TEXT NOT NULL,
+    is_public INTEGER NOT NULL,
+    hangman_enabled INTEGER NOT NULL DEFAULT 1,
+    hangman_running INTEGER NOT NULL DEFAULT 0,
+    bot_id INTEGER NOT NULL DEFAULT -1,
+    bot_token TEXT NOT NULL DEFAULT 'o',
+    hangman_data BLOB
+);
+CREATE INDEX IF NOT EXISTS channels_by_name ON channels (name_key);
+-- time_created has no type affinity, so that an int time is not read back as a float
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message TEXT NOT NULL,
+    time_created NOT NULL,
+    is_pinned INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_by_time ON messages (time_created);
+CREATE TABLE IF NOT EXISTS message_links (
+    message_id INTEGER PRIMARY KEY,
+    u_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS message_links_by_channel ON message_links (channel_id, message_id);
+CREATE INDEX IF NOT EXISTS message_links_by_user ON message_links (u_id, message_id);
+CREATE TABLE IF NOT EXISTS reacts (
+    message_id INTEGER NOT NULL,
+    react_id INTEGER NOT NULL,
+    u_id INTEGER NOT NULL,
+    UNIQUE (message_id, react_id, u_id)
+);
+CREATE TABLE IF NOT EXISTS timelines (
+    channel_id INTEGER NOT NULL,
+    time_created NOT NULL,
+    message_id INTEGER NOT NULL,
+    PRIMARY KEY (channel_id, time_created, message_id DESC)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS timelines_by_time ON timelines (time_created DESC, message_id);
+CREATE TABLE IF NOT EXISTS memberships (
+    u_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    is_owner INTEGER NOT NULL,
+    UNIQUE (channel_id, u_id)
+);
+CREATE INDEX IF NOT EXISTS memberships_by_user ON memberships (u_id);
+'''
+
+TABLES = ('users', 'user_names', 'admins', 'channels', 'messages', 'message_links',
+          'reacts', 'timelines', 'memberships')
+
+
+def transactional(method):
+    '''
+    Decorates a method that changes the database so that it runs in a single
+    transaction, together with every call to other such methods it makes.
+    A call that raises rolls back everything its outermost call has written
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._db:  # pylint: disable=protected-access
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def prefix_end(prefix):
+    '''
+    Returns the smallest string greater than every string starting with prefix,
+    None if there is no such bound because prefix is empty
+    '''
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class Connection():
+    '''
+    A class that gives each thread a connection to the SQLite file of its own, since a
+    sqlite3 connection must not be used by two threads at once. Connections are
+    handed back with release once a request is done and kept in a pool of at most
+    SQLITE_POOL_SIZE for the next request thread, so they are neither opened per
+    request nor left open by threads that have finished. The file is in WAL journal
+    mode so that readers never wait for a writer. Used as a context manager it is a
+    transaction, which nested uses join. Outside a transaction every statement
+    commits itself
+
+    Attributes:
+    -----------
+    path : str
+        The database file
+    local : threading.local
+        The connection of the current thread and how deep it is in transactions
+    idle : queue.LifoQueue
+        The connections no thread holds, the most recently used first
+
+    Methods:
+    --------
+    connection()
+        returns the connection of the current thread
+    execute(sql, params)
+        runs 'sql' on the connection of the current thread
+    release()
+        hands the connection of the current thread back to the pool
+    close()
+        closes the connection of the current thread and the idle connections
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        self._idle = queue.LifoQueue(maxsize=SQLITE_POOL_SIZE)
+        conn = self.connection()
+        # the journal mode is kept in the file, so it is only set once
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+
+    def _open(self):
+        '''
+        Opens a new connection to the file
+        '''
+        # statements are only grouped by the explicit transactions below, and a pooled
+        # connection moves between threads, though only one uses it at a time
+        conn = sqlite3.connect(self._path, timeout=SQLITE_TIMEOUT, isolation_level=None,
+                               check_same_thread=False)
+        # with WAL a commit survives a crash of the process, fsync happens at checkpoints
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def connection(self):
+        '''
+        Returns the connection of the current thread, taking one from the pool
+        or opening one on first use
+        '''
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open()
+            self._local.connection = conn
+            self._local.depth = 0
+        return conn
+
+    def execute(self, sql, params=()):
+        '''
+        Runs sql with params on the connection of the current thread
+        Returns: sqlite3.Cursor
+        '''
+        return self.connection().execute(sql, params)
+
+    def __enter__(self):
+        conn = self.connection()
+        if self._local.depth == 0:
+            # takes the write lock up front, so reads in the transaction see no later writes
+            conn.execute('BEGIN IMMEDIATE')
+        self._local.depth += 1
+        return conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            self._local.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+    def release(self):
+        '''
+        Hands the connection of the current thread back to the pool, or closes it
+        if the pool is full. An unfinished transaction on it is rolled back
+        '''
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            return
+        if self._local.depth:
+            conn.execute('ROLLBACK')
+        self._local.connection = None
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        '''
+        Closes the connection of the current thread and the idle connections
+        '''
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class SqliteUsers():
+    '''
+    Users kept in the users table. Handles and names are also kept lowercased
+    in user_names, whose primary key serves prefix searches
+
+    Attributes:
+    -----------
+    db : Connection
+    version : int
+        The directory version, which moves on with every change to any user.
+        Only caches in this process use it, so it is not stored
+    img_dir : str
+        Where profile images are saved
+    '''
+
+    def __init__(self, db):
+        self._db = db
+        self._version = 0
+        self._img_dir = state.IMAGE_DIR
+
+    def _record(self, u_id):
+        '''
+        Returns the UserRecord of user with u_id, None if there is no such user
+        '''
+        row = self._db.execute(
+            'SELECT email, name_first, name_last, password, handle_str, img_path '
+            'FROM users WHERE u_id = ?', (u_id,)).fetchone()
+        if row is None:
+            return None
+        record = UserRecord(*row[:5])
+        record.img_path = row[5]
+        return record
+
+    def _index_name(self, field, name, u_id):
+        self._db.execute('INSERT OR IGNORE INTO user_names VALUES (?, ?, ?)',
+                         (name.lower(), u_id, field))
+
+    def _unindex_name(self, field, name, u_id):
+        self._db.execute('DELETE FROM user_names WHERE name_key = ? AND u_id = ? AND field = ?',
+                         (name.lower(), u_id, field))
+
+    @transactional
+    def add(self, details):
+        '''
+        adds user with given details to the database
+        Arguments: first and last names, email, password, handle and permissions
+        Returns: u_id (int)
+        Raises: InputError
+        '''
+        email, password, f_name, l_name, handle = details
+        if self.email_used(email):
+            raise InputError("Email already used")
+
+        u_id = self._db.execute(
+            'INSERT INTO users (email, name_first, name_last, password, handle_str) '
+            'VALUES (?, ?, ?, ?, ?)', (email, f_name, l_name, password, handle)).lastrowid
+        for field, name in (('handle_str', handle), ('name_first', f_name),
+                            ('name_last', l_name)):
+            self._index_name(field, name, u_id)
+        self._version += 1
+        return u_id
+
+    @transactional
+    def remove(self, u_id):
+        '''
+        Remove details of a user with u_id
+        '''
+        if self._db.execute('DELETE FROM users WHERE u_id = ?', (u_id,)).rowcount == 0:
+            raise KeyError(u_id)
+        self._db.execute('DELETE FROM user_names WHERE u_id = ?', (u_id,))
+        self._version += 1
+
+    def user_details(self, u_id):
+        '''
+        Produce a dictionary with the required keys for detail in
+        '''
+        record = self._record(u_id)
+        if record is None:
+            raise InputError('User does not exist')
+        return state.Users._profile(u_id, record)  # pylint: disable=protected-access
+
+    def all(self):
+        '''
+        Returns a list of all users in the specified dictionary format
+        '''
+        return list(self.iter_users())
+
+    def search_prefix(self, prefix, limit):
+        '''
+        Input: prefix: string, limit: int
+        Returns: the details of up to limit users whose handle, first or last name
+            starts with prefix, ignoring case, in alphabetical order of the matching name
+        '''
+        prefix = prefix.lower()
+        end = prefix_end(prefix)
+        rows = self._db.execute(
+            'SELECT u_id FROM user_names WHERE name_key >= ? ' +
+            ('AND name_key < ? ' if end else '') + 'ORDER BY name_key, u_id',
+            (prefix, end) if end else (prefix,))
+        found = dict()
+        for (u_id,) in rows:
+            if len(found) >= limit:
+                break
+            found[u_id] = None
+        return list(map(self.user_details, found))
+
+    def iter_users(self, after=0):
+        '''
+        Yields the details of every user with a u_id greater than after, in u_id order.
+        Users are read USERS_BATCH at a time, so users can register or be removed
+        while a listing is still being read
+        Input: after: int
+        '''
+        while True:
+            rows = self._db.execute(
+                'SELECT u_id, email, name_first, name_last, password, handle_str, img_path '
+                'FROM users WHERE u_id > ? ORDER BY u_id LIMIT ?', (after, USERS_BATCH)).fetchall()
+            for row in rows:
+                record = UserRecord(*row[1:6])
+                record.img_path = row[6]
+                yield state.Users._profile(row[0], record)  # pylint: disable=protected-access
+            if len(rows) < USERS_BATCH:
+                return
+            after = rows[-1][0]
+
+    def version(self):
+        '''
+        Returns: the directory version (int), which changes whenever any user does
+        '''
+        return self._version
+
+    def user_exists(self, u_id):
+        '''
+        Input: u_id: int
+        Returns: Bool
+        Checks whether the user with u_id exists
+        '''
+        return self._db.execute(
+            'SELECT 1 FROM users WHERE u_id = ?', (u_id,)).fetchone() is not None
+
+    def email_used(self, email):
+        '''
+        Input: email: string
+        Returns: Bool
+        Checks whether the email is registered in the database
+        '''
+        return self.find_u_id(email) is not None
+
+    def find_u_id(self, email):
+        '''
+        Input: email: string
+        Returns: u_id: int, None if not found
+        '''
+        row = self._db.execute(
+            'SELECT u_id FROM users WHERE email = ? LIMIT 1', (email,)).fetchone()
+        return row[0] if row else None
+
+    def handle_unique(self, handle):
+        '''
+        Input: handle: string
+        Returns: Bool
+        Checks if the handle is not already used by another user
+        '''
+        return self._db.execute(
+            'SELECT 1 FROM users WHERE handle_str = ?', (handle,)).fetchone() is None
+
+    def _set_name(self, u_id, field, name):
+        '''
+        Replaces the first name, last name or handle of user with u_id, reindexing it
+        '''
+        old_name = self._db.execute(
+            f'SELECT {field} FROM users WHERE u_id = ?', (u_id,)).fetchone()[0]
+        self._unindex_name(field, old_name, u_id)
+        self._db.execute(f'UPDATE users SET {field} = ? WHERE u_id = ?', (name, u_id))
+        self._index_name(field, name, u_id)
+        self._version += 1
+
+    @transactional
+    def set_first_name(self, u_id, name):
+        '''
+        Input: u_id: int, name: string
+        Resets the first name of user with u_id
+        '''
+        self._set_name(u_id, 'name_first', name)
+
+    @transactional
+    def set_last_name(self, u_id, name):
+        '''
+        Input: u_id: int, name: string
+        Resets the last name of user with u_id
+        '''
+        self._set_name(u_id, 'name_last', name)
+
+    def get_handle(self, u_id):
+        '''
+        Input: u_id: int
+        Returns: handle: string
+        '''
+        return self._record(u_id).handle_str
+
+    @transactional
+    def set_handle(self, u_id, handle_str):
+        '''
+        Input: u_id: int, handle_str: string
+        Resets the handle of user u_id with handle_str
+        '''
+        self._set_name(u_id, 'handle_str', handle_str)
+
+    def _update(self, u_id, field, value):
+        self._db.execute(f'UPDATE users SET {field} = ? WHERE u_id = ?', (value, u_id))
+        self._version += 1
+
+    @transactional
+    def set_email(self, u_id, email):
+        '''
+        Input: u_id: int, email: string
+        Resets the email of user u_id with new email
+        '''
+        self._update(u_id, 'email', email)
+
+    @transactional
+    def set_password(self, u_id, encrypted_pass):
+        '''
+        Input: u_id: int, encrypted_pass: string
+        Resets the password of user u_id to `encrypted_pass`
+        '''
+        self._update(u_id, 'password', encrypted_pass)
+
+    @transactional
+    def set_image(self, u_id):
+        '''
+        Input: u_id: int
+        Creates an img path using u_id and saves it into the user's details
+        '''
+        self._update(u_id, 'img_path', f"{self._img_dir}/{u_id}.jpg")
+
+    def validate_login(self, email, password):
+        '''
+        Input: email: string, password: string
+        Returns: u_id of the validated user
+        Makes sure the email exist and the given password is correct
+        '''
+        row = self._db.execute(
+            'SELECT u_id, password FROM users WHERE email = ? LIMIT 1', (email,)).fetchone()
+        if row is None:
+            raise InputError('Email does not exist')
+        if password != row[1]:
+            raise InputError(description='Password incorrect')
+        return row[0]
+
+
+class SqliteAdmins():
+    '''
+    Admins kept in the admins table
+    '''
+
+    def __init__(self, db):
+        self._db = db
+
+    @transactional
+    def add(self, u_id):
+        '''
+        Input: u_id: int
+        Purpose: add the u_id into the admins
+        '''
+        self._db.execute('INSERT OR IGNORE INTO admins VALUES (?)', (u_id,))
+
+    @transactional
+    def remove(self, u_id):
+        '''
+        Input: u_id: int
+        Purpose: remove the u_id from the admins
+        '''
+        self._db.execute('DELETE FROM admins WHERE u_id = ?', (u_id,))
+
+    def is_admin(self, u_id):
+        '''
+        Input: u_id (int)
+        Return: whether u_id is an admin (bool)
+        '''
+        return self._db.execute(
+            'SELECT 1 FROM admins WHERE u_id = ?', (u_id,)).fetchone() is not None
+
+    @staticmethod
+    def is_valid_permission(p_id):
+        '''
+        Input: p_id (int): a permission ID
+        Return: whether the permission_id is valid (bool)
+        '''
+        return p_id in (ADMIN, MEMBER)
+
+
+class SqliteChannels():
+    '''
+    Channels and their hangman games kept in the channels table. The game's
+    data is pickled, as it is only ever read and written whole. Lowercased
+    names are indexed for prefix searches
+    '''
+
+    def __init__(self, db):
+        self._db = db
+        self._version = 0
+
+    def _get(self, channel_id, column):
+        row = self._db.execute(
+            f'SELECT {column} FROM channels WHERE channel_id = ?', (channel_id,)).fetchone()
+        if row is None:
+            raise KeyError(channel_id)
+        return row[0]
+
+    def _set(self, channel_id, **columns):
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        self._db.execute(f'UPDATE channels SET {assignments} WHERE channel_id = ?',
+                         tuple(columns.values()) + (channel_id,))
+
+    @transactional
+    def add(self, details):
+        '''
+        Adds details of a channel
+        Input: Channel details
+        Output: channel_id
+        '''
+        name, is_public = details
+        self._version += 1
+        return self._db.execute(
+            'INSERT INTO channels (name, name_key, is_public, hangman_data) '
+            'VALUES (?, ?, ?, ?)',
+            (name, name.lower(), bool(is_public), pickle.dumps(dict()))).lastrowid
+
+    def is_private(self, channel_id):
+        '''
+        Checks if channel is private
+        Input: Channel id
+        Returns: False if private
+        '''
+        return not self._get(channel_id, 'is_public')
+
+    def channel_exists(self, channel_id):
+        '''
+        Checks if channel_exists
+        Input: Channel id
+        '''
+        return self._db.execute('SELECT 1 FROM channels WHERE channel_id = ?',
+                                (channel_id,)).fetchone() is not None
+
+    def channel_details(self, channel_id):
+        '''
+        Raise error if channel doesn't exist otherwise return its details
+        Input: Channel id
+        Returns: Name and channel_id of a specified channel
+        '''
+        row = self._db.execute('SELECT name FROM channels WHERE channel_id = ?',
+                               (channel_id,)).fetchone()
+        if row is None:
+            raise InputError(description="Channel does not exist")
+        return {'channel_id': channel_id, 'name': row[0]}
+
+    def all(self):
+        '''
+        Returns a list of all channels created, displaying their details
+        '''
+        return [{'channel_id': channel_id, 'name': name} for channel_id, name in
+                self._db.execute('SELECT channel_id, name FROM channels ORDER BY channel_id')]
+
+    def version(self):
+        '''
+        Returns the catalogue version, which changes whenever a channel is added
+        '''
+        return self._version
+
+    def search(self, query_str, limit, visible):
+        '''
+        Finds channels whose name contains query_str, ignoring case. Names starting
+        with query_str come first in name order, then other matches by channel_id
+        Input:
+            query_str (str), limit (int),
+            visible (function): of a channel_id, whether the channel may be returned
+        Returns: details of up to limit matching channels
+        '''
+        query_str = query_str.lower()
+        end = prefix_end(query_str)
+        found = dict()
+        rows = self._db.execute(
+            'SELECT channel_id FROM channels WHERE name_key >= ? ' +
+            ('AND name_key < ? ' if end else '') + 'ORDER BY name_key, channel_id',
+            (query_str, end) if end else (query_str,)).fetchall()
+        for (channel_id,) in rows:
+            if len(found) >= limit:
+                break
+            if visible(channel_id):
+                found[channel_id] = None
+        # queries shorter than a trigram only match by prefix, as in Channels
+        if len(query_str) >= state.NGRAM_LEN:
+            rows = self._db.execute(
+                'SELECT channel_id FROM channels WHERE instr(name_key, ?) > 0 '
+                'ORDER BY channel_id', (query_str,)).fetchall()
+            for (channel_id,) in rows:
+                if len(found) >= limit:
+                    break
+                if channel_id not in found and visible(channel_id):
+                    found[channel_id] = None
+        return list(map(self.channel_details, found))
+
+    def is_hangman_enabled(self, channel_id):
+        '''
+        Args: channel_id (int)
+        Return: whether hangman is enabled (bool)
+        '''
+        return bool(self._get(channel_id, 'hangman_enabled'))
+
+    @transactional
+    def enable_hangman(self, channel_id):
+        '''
+        Enables hangman game within channel
+        Args: channel_id (int)
+        '''
+        self._set(channel_id, hangman_enabled=True)
+
+    @transactional
+    def disable_hangman(self, channel_id):
+        '''
+        Disable hangman game within channel
+        Args: channel_id (int)
+        '''
+        self._set(channel_id, hangman_enabled=False)
+
+    def is_hangman_running(self, channel_id):
+        '''
+        Args: channel_id (int)
+        Return: whether hangman is running in the channel (bool)
+        '''
+        return bool(self._get(channel_id, 'hangman_running'))
+
+    @transactional
+    def add_hbot_details(self, channel_id, bot_id, bot_token):
+        '''
+        Adds the hangman bot details when it is created
+        Args: channel_id (int), bot_id (int), bot_token (str)
+        '''
+        self._set(channel_id, bot_id=bot_id, bot_token=bot_token)
+
+    def get_hbot_details(self, channel_id):
+        '''
+        Given a channel id return details about hangman game bot
+        '''
+        return tuple(self._db.execute(
+            'SELECT bot_id, bot_token FROM channels WHERE channel_id = ?',
+            (channel_id,)).fetchone())
+
+    @transactional
+    def start_hangman(self, channel_id, details):
+        '''
+        Marks hangman as running in the channel and stores the game's details
+        '''
+        self._set(channel_id, hangman_running=True, hangman_data=pickle.dumps(details))
+
+    def get_hangman(self, channel_id):
+        '''
+        Return dictionary of the details of the current hangman game
+        '''
+        return pickle.loads(self._get(channel_id, 'hangman_data'))
+
+    @transactional
+    def edit_hangman(self, channel_id, new_details):
+        '''
+        Replaces the details of the current hangman game
+        '''
+        self._set(channel_id, hangman_data=pickle.dumps(new_details))
+
+    @transactional
+    def quit_hangman(self, channel_id):
+        '''
+        Clears the details of the hangman game and marks it as over
+        '''
+        self._set(channel_id, hangman_running=False, hangman_data=pickle.dumps(dict()))
+
+
+class SqliteMessages():
+    '''
+    Messages kept in the messages table, whose primary key is the message_id.
+    Searches check the bodies with instr rather than keeping a trigram index
+    '''
+
+    def __init__(self, db):
+        self._db = db
+
+    @staticmethod
+    def _record(row):
+        record = MessageRecord(row[0], row[1], row[2])
+        record.is_pinned = bool(row[3])
+        return record
+
+    def all(self):
+        '''
+        Returns all message dictionaries in a list
+        '''
+        return [self._record(row).to_dict() for row in self._db.execute(
+            'SELECT message_id, message, time_created, is_pinned FROM messages '
+            'ORDER BY message_id')]
+
+    @transactional
+    def add(self, details):
+        '''
+        Adds a new message from details: message, time_created and optionally
+        the sender's u_id and the channel_id, which are kept in message_links
+        '''
+        message, time_created = details[:2]
+        return self._db.execute('INSERT INTO messages (message, time_created) VALUES (?, ?)',
+                                (message, time_created)).lastrowid
+
+    @transactional
+    def edit(self, message_id, message):
+        '''
+        Replaces the contents of message with message_id with the message string
+        '''
+        self._db.execute('UPDATE messages SET message = ? WHERE message_id = ?',
+                         (message, message_id))
+
+    @transactional
+    def pin(self, message_id):
+        '''
+        Pins the message with message_id
+        '''
+        if self.find(message_id).is_pinned:
+            raise InputError(description='Message already pinned')
+        self._db.execute('UPDATE messages SET is_pinned = 1 WHERE message_id = ?', (message_id,))
+
+    @transactional
+    def unpin(self, message_id):
+        '''
+        Unpins the message with message_id
+        '''
+        if not self.find(message_id).is_pinned:
+            raise InputError(description='Message already unpinned')
+        self._db.execute('UPDATE messages SET is_pinned = 0 WHERE message_id = ?', (message_id,))
+
+    def message_details(self, message_id):
+        '''
+        Returns details of message with message_id in the form of a dictionary
+        '''
+        try:
+            return self.find(message_id).to_dict()
+        except KeyError:
+            return None
+
+    def message_exists(self, message_id):
+        '''
+        Returns whether message with message_id exists
+        '''
+        return self._db.execute('SELECT 1 FROM messages WHERE message_id = ?',
+                                (message_id,)).fetchone() is not None
+
+    def fetch_messages(self, start):
+        '''
+        Returns a list of message details starting with the specified start index
+        '''
+        num_messages = self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        if start < 0 or start > num_messages:
+            raise InputError(description='Invalid Start index')
+        return [self._record(row).to_dict() for row in self._db.execute(
+            'SELECT message_id, message, time_created, is_pinned FROM messages '
+            'ORDER BY message_id LIMIT ? OFFSET ?', (MSG_BLOCK, start))]
+
+    @transactional
+    def remove(self, message_id):
+        '''
+        Removes a message with message_id
+        '''
+        if self._db.execute('DELETE FROM messages WHERE message_id = ?',
+                            (message_id,)).rowcount == 0:
+            raise InputError(description='Message does not exist')
+
+    def find(self, message_id):
+        '''
+        Returns the record of the message with message_id
+        Raises: KeyError if there is no such message
+        '''
+        row = self._db.execute(
+            'SELECT message_id, message, time_created, is_pinned FROM messages '
+            'WHERE message_id = ?', (message_id,)).fetchone()
+        if row is None:
+            raise KeyError(message_id)
+        return self._record(row)
+
+    def search(self, query_string):
+        '''
+        Returns list of messages that contain the query_string
+        '''
+        rows = self._db.execute(
+            'SELECT message_id, message, time_created, is_pinned FROM messages '
+            'WHERE instr(message, ?) > 0 ORDER BY message_id', (query_string,))
+        return [self._record(row).to_dict() for row in rows]
+
+    @staticmethod
+    def candidates(query_string):  # pylint: disable=unused-argument
+        '''
+        Returns None, as instr checks every message within the single search query
+        '''
+        return None
+
+    def next_id(self):
+        '''
+        Returns the next message ID
+        '''
+        row = self._db.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+        return (row[0] if row else 0) + 1
+
+
+class SqliteUserMessage():
+    '''
+    The senders and channels of messages, kept in message_links with indexes by
+    channel and by user, and their reacts, kept in reacts in the order made
+    '''
+
+    def __init__(self, db):
+        self._db = db
+        self._react_ids = [DEFAULT_REACT_ID]
+
+    def _links(self, where, params):
+        '''
+        Returns the LinkRecords selected by where, in message_id order, with their reacts
+        '''
+        links = dict()
+        for message_id, u_id, channel_id in self._db.execute(
+                f'SELECT message_id, u_id, channel_id FROM message_links WHERE {where} '
+                'ORDER BY message_id', params):
+            links[message_id] = LinkRecord(message_id, u_id, channel_id)
+        for link in links.values():
+            self._load_reacts(link)
+        return list(links.values())
+
+    def _load_reacts(self, link):
+        '''
+        Fills in the reacts of link, leaving them None if nobody has reacted
+        '''
+        for react_id, u_id in self._db.execute(
+                'SELECT react_id, u_id FROM reacts WHERE message_id = ? ORDER BY rowid',
+                (link.message_id,)):
+            if link.reacts is None:
+                link.reacts = {DEFAULT_REACT_ID: dict()}
+            link.reacts.setdefault(react_id, dict())[u_id] = None
+
+    @transactional
+    def add_link(self, u_id, channel_id, message_id):
+        '''
+        Adds a link containing u_id, channel_id, message_id
+        '''
+        if self.link_exists(message_id):
+            raise InputError(description='Message already exists')
+        self._db.execute('INSERT INTO message_links VALUES (?, ?, ?)',
+                         (message_id, u_id, channel_id))
+
+    def fetch_links_by_channel(self, container):
+        '''
+        Fetches all links by channel_id/multiple channel_ids
+        '''
+        channel_ids = container if isinstance(container, list) else [container]
+        return [link for channel_id in channel_ids
+                for link in self._links('channel_id = ?', (channel_id,))]
+
+    def fetch_links_by_user(self, u_id):
+        '''
+        Fetches all message links that the user has sent
+        '''
+        return self._links('u_id = ?', (u_id,))
+
+    @transactional
+    def remove_link_by_user(self, u_id):
+        '''
+        Removes all links containing u_id
+        '''
+        self._db.execute('DELETE FROM reacts WHERE message_id IN '
+                         '(SELECT message_id FROM message_links WHERE u_id = ?)', (u_id,))
+        self._db.execute('DELETE FROM message_links WHERE u_id = ?', (u_id,))
+
+    @transactional
+    def remove_link_by_channel(self, channel_id):
+        '''
+        Removes all links containing channel_id
+        '''
+        self._db.execute('DELETE FROM reacts WHERE message_id IN '
+                         '(SELECT message_id FROM message_links WHERE channel_id = ?)',
+                         (channel_id,))
+        self._db.execute('DELETE FROM message_links WHERE channel_id = ?', (channel_id,))
+
+    @transactional
+    def remove_link_by_message(self, message_id):
+        '''
+        Removes the link containing message_id
+        '''
+        self._db.execute('DELETE FROM reacts WHERE message_id = ?', (message_id,))
+        self._db.execute('DELETE FROM message_links WHERE message_id = ?', (message_id,))
+
+    def link_exists(self, message_id):
+        '''
+        Checks whether a link with message_id exists
+        '''
+        return self._db.execute('SELECT 1 FROM message_links WHERE message_id = ?',
+                                (message_id,)).fetchone() is not None
+
+    @transactional
+    def react(self, u_id, m_id, react_id):
+        '''
+        Adds react details to the link with u_id, m_id
+        '''
+        if not self.link_exists(m_id):
+            raise InputError(description='Message does not exist')
+        if not self.is_valid_react(react_id):
+            raise InputError(description='Invalid react')
+        if self._db.execute('INSERT OR IGNORE INTO reacts VALUES (?, ?, ?)',
+                            (m_id, react_id, u_id)).rowcount == 0:
+            raise InputError(description='user already reacted')
+
+    @transactional
+    def unreact(self, u_id, m_id, react_id):
+        '''
+        Removes the react_id from active reacts in the specified link
+        '''
+        if not self.link_exists(m_id):
+            raise InputError(description='Message does not exist')
+        if not self.is_valid_react(react_id):
+            raise InputError(description='Invalid react')
+        if self._db.execute(
+                'DELETE FROM reacts WHERE message_id = ? AND react_id = ? AND u_id = ?',
+                (m_id, react_id, u_id)).rowcount == 0:
+            raise InputError(description='user does not have an active react')
+
+    def fetch_link(self, m_id):
+        '''
+        Returns the link record containing message ID of m_id, None if there is none
+        '''
+        links = self._links('message_id = ?', (m_id,))
+        return links[0] if links else None
+
+    def is_valid_react(self, react_id):
+        '''
+        Checks whether the react_id is valid
+        '''
+        return react_id in self._react_ids
+
+    def is_sender(self, m_id, u_id):
+        '''
+        Checks whether the user with ID u_id sent the message with m_id
+        '''
+        return self._db.execute('SELECT 1 FROM message_links WHERE message_id = ? AND u_id = ?',
+                                (m_id, u_id)).fetchone() is not None
+
+    def message_channel(self, message_id):
+        '''
+        Returns the channel ID of the message
+        '''
+        row = self._db.execute('SELECT channel_id FROM message_links WHERE message_id = ?',
+                               (message_id,)).fetchone()
+        return row[0] if row else None
+
+    def links(self):
+        '''
+        Returns every link record, in the order the messages were sent
+        '''
+        return self._links('1', ())
+
+
+class SqliteTimelines():
+    '''
+    The messages of every channel in order of time created, kept in the timelines
+    table whose primary key (channel_id, time_created, message_id DESC) is the order
+    pages are read in, so a page is a range of the key rather than a sort. Messages
+    sent at the same time are listed in the order they were sent, as in Timelines
+    '''
+
+    def __init__(self, db):
+        self._db = db
+
+    @transactional
+    def add(self, channel_id, message_id, time_created):
+        '''
+        Inserts a message into the timeline of a channel
+        Params: channel_id (int), message_id (int), time_created (float)
+        '''
+        self._db.execute('INSERT OR IGNORE INTO timelines VALUES (?, ?, ?)',
+                         (channel_id, time_created, message_id))
+
+    @transactional
+    def remove(self, channel_id, message_id, time_created):
+        '''
+        Removes a message from the timeline of a channel, does nothing if it is not there
+        Params: channel_id (int), message_id (int), time_created (float)
+        '''
+        self._db.execute('DELETE FROM timelines WHERE channel_id = ? AND time_created = ? '
+                         'AND message_id = ?', (channel_id, time_created, message_id))
+
+    def size(self, channel_id):
+        '''
+        Params: channel_id (int)
+        Returns: number of messages in the channel (int)
+        '''
+        return self._db.execute('SELECT COUNT(*) FROM timelines WHERE channel_id = ?',
+                                (channel_id,)).fetchone()[0]
+
+    def page(self, channel_id, start, count):
+        '''
+        Params: channel_id (int), start (int): number of newest messages to skip,
+            count (int): maximum number of messages to return
+        Returns: message_ids ordered from the newest to the oldest (List)
+        '''
+        return [message_id for (message_id,) in self._db.execute(
+            'SELECT message_id FROM timelines WHERE channel_id = ? '
+            'ORDER BY time_created DESC, message_id LIMIT ? OFFSET ?',
+            (channel_id, count, max(start, 0)))]
+
+    def seek(self, channel_id, cursor, count, before):
+        '''
+        Finds the messages on one side of a cursor, which stays valid even if
+        the message it was taken from has since been removed
+
+        Params:
+            channel_id (int)
+            cursor (tuple): (time_created, message_id) of the anchoring message
+            count (int): maximum number of messages to return
+            before (bool): True for messages older than the cursor,
+                False for the messages immediately newer than it
+        Returns:
+            message_ids ordered from the newest to the oldest (List),
+            whether there are older messages than the ones returned (bool)
+        '''
+        time_created, message_id = cursor
+        if before:
+            message_ids = [message_id for (message_id,) in self._db.execute(
+                'SELECT message_id FROM timelines WHERE channel_id = ? '
+                'AND (time_created < ? OR time_created = ? AND message_id > ?) '
+                'ORDER BY time_created DESC, message_id LIMIT ?',
+                (channel_id, time_created, time_created, message_id, count + 1))]
+            return message_ids[:count], len(message_ids) > count
+        message_ids = [message_id for (message_id,) in self._db.execute(
+            'SELECT message_id FROM timelines WHERE channel_id = ? '
+            'AND (time_created > ? OR time_created = ? AND message_id < ?) '
+            'ORDER BY time_created, message_id DESC LIMIT ?',
+            (channel_id, time_created, time_created, message_id, count))]
+        more = self._db.execute(
+            'SELECT 1 FROM timelines WHERE channel_id = ? '
+            'AND (time_created < ? OR time_created = ? AND message_id >= ?) LIMIT 1',
+            (channel_id, time_created, time_created, message_id)).fetchone() is not None
+        return message_ids[::-1], more
+
+    def iter_newest(self, channel_ids, before=None):
+        '''
+        Lazily yields the message_ids of the channels merged into one timeline
+
+        Params:
+            channel_ids (iterable): of the channels to merge
+            before (tuple): (time_created, message_id) of a message, if given
+                only the messages older than it are yielded
+        Returns: message_ids ordered from the newest to the oldest (generator)
+        '''
+        channel_ids = list(channel_ids)
+        marks = ', '.join('?' * len(channel_ids))
+        if before is None:
+            rows = self._db.execute(
+                f'SELECT message_id FROM timelines WHERE channel_id IN ({marks}) '
+                'ORDER BY time_created DESC, message_id', channel_ids)
+        else:
+            time_created, message_id = before
+            rows = self._db.execute(
+                f'SELECT message_id FROM timelines WHERE channel_id IN ({marks}) '
+                'AND (time_created < ? OR time_created = ? AND message_id > ?) '
+                'ORDER BY time_created DESC, message_id',
+                (*channel_ids, time_created, time_created, message_id))
+        return (message_id for (message_id,) in rows)
+
+
+class SqliteUserChannel():
+    '''
+    Memberships kept in the memberships table, indexed by channel and by user.
+    Rows are read in rowid order, which is the order users joined
+    '''
+
+    def __init__(self, db):
+        self._db = db
+        self._versions = dict()
+
+    def _touch(self, u_id):
+        '''
+        Moves the membership version of user with 'u_id' on
+        '''
+        self._versions[u_id] = self._versions.get(u_id, 0) + 1
+
+    @transactional
+    def add_link(self, u_id, channel_id, is_owner):
+        '''
+        Forms a link between a user and a channel, making a note of
+        whether the user is an owner of that channel.
+
+        Params: u_id (int), channel_id (int), is_owner (bool)
+        Raises: InputError if user is already in the channel
+        '''
+        if self.link_exists(u_id, channel_id):
+            raise InputError(description='user already in channel')
+        self._db.execute('INSERT INTO memberships VALUES (?, ?, ?)',
+                         (u_id, channel_id, bool(is_owner)))
+        self._touch(u_id)
+
+    @transactional
+    def remove_link_by_user(self, u_id):
+        '''
+        Removes the links between user with 'u_id' and all channels
+
+        Params: u_id (int)
+        '''
+        self._db.execute('DELETE FROM memberships WHERE u_id = ?', (u_id,))
+        self._touch(u_id)
+
+    @transactional
+    def remove_link_by_channel(self, channel_id):
+        '''
+        Removes the links between channel with 'channel_id' and all users
+
+        Params: channel_id (int)
+        '''
+        for u_id in self.members(channel_id):
+            self._touch(u_id)
+        self._db.execute('DELETE FROM memberships WHERE channel_id = ?', (channel_id,))
+
+    @transactional
+    def remove_user(self, u_id, channel_id):
+        '''
+        Removes user with 'u_id' from channel with 'channel_id'
+
+        Params: u_id (int), channel_id (int)
+        Does nothing if user not part of channel
+        '''
+        if self._db.execute('DELETE FROM memberships WHERE channel_id = ? AND u_id = ?',
+                            (channel_id, u_id)).rowcount:
+            self._touch(u_id)
+
+    @transactional
+    def add_owner(self, u_id, channel_id):
+        '''
+        Adds user with 'u_id' to the owners of channel with 'channel_id'
+
+        Params: u_id (int), channel_id (int)
+        Raises: InputError if user is already an owner of the channel
+        '''
+        if self.is_owner(u_id, channel_id):
+            raise InputError(description='user is already an owner')
+        if self.link_exists(u_id, channel_id):
+            self._db.execute('UPDATE memberships SET is_owner = 1 '
+                             'WHERE channel_id = ? AND u_id = ?', (channel_id, u_id))
+        else:
+            self.add_link(u_id, channel_id, is_owner=True)
+
+    @transactional
+    def remove_owner(self, u_id, channel_id):
+        '''
+        Removes user with 'u_id' from the owners of channel with 'channel_id'
+
+        Params: u_id (int), channel_id (int)
+        Raises: InputError if user is not an owner of the channel in the first place
+        '''
+        if not self.is_owner(u_id, channel_id):
+            raise InputError(description='user is not an owner')
+        self._db.execute('UPDATE memberships SET is_owner = 0 '
+                         'WHERE channel_id = ? AND u_id = ?', (channel_id, u_id))
+
+    @transactional
+    def join_channel(self, u_id, channel_id):
+        '''
+        Adds user with 'u_id' to channel with 'channel_id' as a normal member
+        '''
+        self.add_link(u_id, channel_id, is_owner=False)
+
+    @transactional
+    def leave_channel(self, u_id, channel_id):
+        '''
+        Removes user with 'u_id' from channel with 'channel_id' entirely
+        '''
+        self.remove_user(u_id, channel_id)
+
+    def link_exists(self, u_id, channel_id):
+        '''
+        Params: u_id (int), channel_id (int)
+        Returns: if user is part of channel (bool)
+        '''
+        return self._db.execute('SELECT 1 FROM memberships WHERE channel_id = ? AND u_id = ?',
+                                (channel_id, u_id)).fetchone() is not None
+
+    def is_member(self, u_id, channel_id):
+        '''
+        Params: u_id (int), channel_id (int)
+        Returns: if user is normal member of channel (bool)
+        '''
+        return self.link_exists(u_id, channel_id)
+
+    def is_owner(self, u_id, channel_id):
+        '''
+        Params: u_id (int), channel_id (int)
+        Returns: if user is owner member of channel (bool)
+        '''
+        row = self._db.execute('SELECT is_owner FROM memberships '
+                               'WHERE channel_id = ? AND u_id = ?',
+                               (channel_id, u_id)).fetchone()
+        return bool(row and row[0])
+
+    def members(self, channel_id):
+        '''
+        Params: channel_id (int)
+        Returns: all users who are members of channel with 'channel_id' (List)
+        '''
+        return [u_id for (u_id,) in self._db.execute(
+            'SELECT u_id FROM memberships WHERE channel_id = ? ORDER BY rowid', (channel_id,))]
+
+    def owners(self, channel_id):
+        '''
+        Params: channel_id (int)
+        Returns: all users who are owner members of channel with 'channel_id' (List)
+        '''
+        return [u_id for (u_id,) in self._db.execute(
+            'SELECT u_id FROM memberships WHERE channel_id = ? AND is_owner '
+            'ORDER BY rowid', (channel_id,))]
+
+    def user_channels(self, given_u_id):
+        '''
+        Params: given_u_id (int)
+        Returns: all channels which user with 'given_u_id' is part of (List)
+        '''
+        return [channel_id for (channel_id,) in self._db.execute(
+            'SELECT channel_id FROM memberships WHERE u_id = ? ORDER BY rowid', (given_u_id,))]
+
+    def version(self, u_id):
+        '''
+        Params: u_id (int)
+        Returns: the membership version of the user (int)
+        '''
+        return self._versions.get(u_id, 0)
+
+
+class SqliteDatabase(Database):
+    '''
+    A Database whose stores keep their data in a SQLite file. It reuses the methods
+    of Database that combine the stores, running those that change them in one
+    transaction. Reset codes stay in memory, as they expire within minutes anyway
+
+    Attributes:
+    -----------
+    path : str
+        The SQLite file
+    db : Connection
+        The connections to it, one per thread
+    '''
+
+    persistent = True
+
+    def __init__(self, path=None):  # pylint: disable=super-init-not-called
+        self.path = path or state.SQLITE_FILE
+        self._db = Connection(self.path)
+        self._open_stores()
+
+    def _open_stores(self):
+        '''
+        Creates the stores over the connection, with their in-memory versions at 0
+        '''
+        self.users = SqliteUsers(self._db)
+        self.admins = SqliteAdmins(self._db)
+        self.channels = SqliteChannels(self._db)
+        self.codes = Codes()
+        self.messages = SqliteMessages(self._db)
+        self.user_message = SqliteUserMessage(self._db)
+        self.user_channel = SqliteUserChannel(self._db)
+        self.timelines = SqliteTimelines(self._db)
+        # nothing is replayed into a database that writes itself to disk
+        self.wal_lsn = 0
+
+    @transactional
+    def reset(self):
+        '''Deletes everything in the database, so ids start from 1 again'''
+        for table in TABLES:
+            self._db.execute(f'DELETE FROM {table}')
+        self._db.execute('DELETE FROM sqlite_sequence')
+        self._open_stores()
+
+    def rebuild_timelines(self):
+        '''The timelines table is kept up to date as messages change'''
+
+    def iter_search(self, channel_ids, query_str, before=None):
+        '''
+        Lazily yields the messages in the channels which contain the query_str,
+        newest first, from a single query over the timelines and the messages
+
+        Args:
+            channel_ids (iterable): of the channels to search
+            query_str (str): which the messages must contain
+            before (tuple): (time_created, message_id) of a message,
+                only older messages are yielded
+        Return: message_ids ordered from the newest to the oldest (generator)
+        '''
+        channel_ids = list(channel_ids)
+        placeholders = ', '.join('?' * len(channel_ids))
+        query = ('SELECT timelines.message_id FROM timelines '
+                 'JOIN messages ON messages.message_id = timelines.message_id '
+                 f'WHERE timelines.channel_id IN ({placeholders}) '
+                 'AND instr(messages.message, ?) > 0')
+        params = channel_ids + [query_str]
+        if before is not None:
+            time_created, message_id = before
+            query += (' AND (timelines.time_created < ? OR timelines.time_created = ? '
+                      'AND timelines.message_id > ?)')
+            params += [time_created, time_created, message_id]
+        query += ' ORDER BY timelines.time_created DESC, timelines.message_id'
+        for (m_id,) in self._db.execute(query, params):
+            yield m_id
+
+    def release(self):
+        '''
+        Hands the connection of the current thread back to the pool once a request is done
+        '''
+        self._db.release()
+
+    def close(self):
+        '''
+        Closes the connection of the current thread and the idle connections
+        '''
+        self._db.close()
+
+    add_user = transactional(Database.add_user)
+    add_channel = transactional(Database.add_channel)
+    add_message = transactional(Database.add_message)
+    remove_message = transactional(Database.remove_message)
+    remove_messages = transactional(Database.remove_messages)
+    pin = transactional(Database.pin)
+    unpin = transactional(Database.unpin)
@@ -0,0 +1,164 @@
+'''
+Tests for the SQLite storage backend
+'''
+#pylint: disable=missing-function-docstring
+
+import json
+import sqlite3
+import threading
+import pytest
+import state
+import sqlite_store
+from sqlite_store import SqliteDatabase
+from error import InputError
+
+
+def test_sqlite_database_reopens(tmp_path):
+    path = str(tmp_path / 'database.db')
+    database = SqliteDatabase(path)
+    u_id = database.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    channel_id = database.add_channel(u_id, ('general', True))
+    message_id = database.add_message(u_id, channel_id, ('hello there', 100.0))
+    database.user_message.react(u_id, message_id, 1)
+    database.close()
+
+    database = SqliteDatabase(path)
+    assert database.admins.is_admin(u_id)
+    assert database.user_channel.is_owner(u_id, channel_id)
+    messages, more = database.channel_messages(u_id, (channel_id, 0))
+    assert not more
+    assert messages == [{
+        'message_id': message_id,
+        'u_id': u_id,
+        'message': 'hello there',
+        'time_created': 100.0,
+        'reacts': [{'react_id': 1, 'u_ids': [u_id], 'is_this_user_reacted': True}],
+        'is_pinned': False,
+    }]
+    assert database.users.search_prefix('sm', 10)[0]['u_id'] == u_id
+
+
+
+def test_sqlite_keeps_time_type(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'database.db'))
+    u_id = database.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    channel_id = database.add_channel(u_id, ('general', True))
+    int_id = database.add_message(u_id, channel_id, ('sent at an int time', 100))
+    float_id = database.add_message(u_id, channel_id, ('sent at a float time', 100.0))
+    assert isinstance(database.messages.find(int_id).time_created, int)
+    assert isinstance(database.messages.find(float_id).time_created, float)
+    # ints and floats still order by value, ties by message_id
+    assert database.timelines.page(channel_id, 0, 10) == [int_id, float_id]
+
+def test_sqlite_database_rolls_back(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'database.db'))
+    u_id = database.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    channel_id = database.add_channel(u_id, ('general', True))
+    database.add_message(u_id, channel_id, ('hello', 100.0))
+    # a stray link to the id the next message gets makes adding it fail halfway
+    next_id = database.messages.next_id()
+    database.user_message.add_link(u_id, channel_id, next_id)
+    with pytest.raises(InputError):
+        database.add_message(u_id, channel_id, ('hello again', 101.0))
+    assert not database.messages.message_exists(next_id)
+    assert database.messages.next_id() == next_id
+    assert database.timelines.size(channel_id) == 1
+
+
+def test_sqlite_transaction_rolls_back_on_input_error(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'database.db'))
+    u_id = database.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    channel_id = database.add_channel(u_id, ('general', True))
+    message_id = database.add_message(u_id, channel_id, ('hello', 100.0))
+    database.pin(u_id, message_id)
+
+    # every write the outermost transaction made is undone, nested ones included
+    with pytest.raises(InputError):
+        with database._db:  # pylint: disable=protected-access
+            database.add_channel(u_id, ('random', True))
+            database.messages.edit(message_id, 'edited')
+            database.pin(u_id, message_id)
+    assert [channel['name'] for channel in database.channels.all()] == ['general']
+    assert database.messages.find(message_id).message == 'hello'
+    # the connection is usable again afterwards
+    assert database.add_channel(u_id, ('random', True)) == channel_id + 1
+
+
+def test_sqlite_database_reopens_after_reset(tmp_path):
+    path = str(tmp_path / 'database.db')
+    database = SqliteDatabase(path)
+    u_id = database.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    database.add_channel(u_id, ('general', True))
+    database.reset()
+    u_id = database.add_user(('kim@gmail.com', 'hash', 'Kim', 'Lee', 'kimlee'))
+    database.close()
+
+    database = SqliteDatabase(path)
+    assert u_id == 1
+    assert [user['email'] for user in database.users.all()] == ['kim@gmail.com']
+    assert database.channels.all() == []
+    assert database.messages.next_id() == 1
+
+
+def test_sqlite_connections_are_pooled(tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite_store, 'SQLITE_POOL_SIZE', 2)
+    database = SqliteDatabase(str(tmp_path / 'database.db'))
+    database.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    connections = []
+    ready = threading.Barrier(4)
+
+    def request():
+        database.users.all()
+        connections.append(database._db.connection())  # pylint: disable=protected-access
+        ready.wait(5)
+        database.release()
+
+    # four threads at once need four connections, only two of them are kept
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, connections))) == 4
+    closed = 0
+    for conn in connections:
+        try:
+            conn.execute('SELECT 1')
+        except sqlite3.ProgrammingError:
+            closed += 1
+    assert closed == 2
+
+    # later request threads reuse a pooled connection instead of opening one
+    connections.clear()
+    ready = threading.Barrier(1)
+    for _ in range(3):
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+    assert len(set(map(id, connections))) == 1
+    database.close()
+
+
+def test_sqlite_connection_released_after_request(tmp_path, monkeypatch):
+    server = pytest.importorskip('server')
+    database = SqliteDatabase(str(tmp_path / 'database.db'))
+    monkeypatch.setattr(state, 'STORE', database)
+    client = server.APP.test_client()
+    client.get('/users/all', query_string={'token': 'not a token'})
+    assert getattr(database._db._local, 'connection', None) is None  # pylint: disable=protected-access
+    assert database._db._idle.qsize() == 1  # pylint: disable=protected-access
+
+
+def test_sqlite_connection_released_after_stream(tmp_path, monkeypatch):
+    server = pytest.importorskip('server')
+    database = SqliteDatabase(str(tmp_path / 'database.db'))
+    monkeypatch.setattr(state, 'STORE', database)
+    client = server.APP.test_client()
+    token = json.loads(client.post('/auth/register', json={
+        'email': 'max@gmail.com', 'password': 'password123',
+        'name_first': 'Max', 'name_last': 'Smith'}).data)['token']
+    response = client.get('/users/all', query_string={'token': token, 'stream': 'true'})
+    assert [user['email'] for user in response.get_json()['users']] == ['max@gmail.com']
+    response.close()
+    assert getattr(database._db._local, 'connection', None) is None  # pylint: disable=protected-access
+    assert database._db._idle.qsize() == 1  # pylint: disable=protected-access
@@ -67,7 +67,7 @@ def flush_standup(channel_id):
             if user_token is None:
                 # generate a temporary token
                 user_token = generate_token(to_flush['u_id'])
-                get_tokens()[user_token] = to_flush['u_id']
+                get_tokens().add(user_token, to_flush['u_id'])
                 message_send(user_token, channel_id, to_send)
                 auth_logout(user_token)
             else:
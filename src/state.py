@@ -8,10 +8,18 @@ with the server's data when its launched
 from email.message import EmailMessage
 import threading
 import pickle
+import heapq
+import os
+import struct
+import zlib
+import functools
 import random
 import uuid
 import smtplib
-import hashlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from time import time, sleep
 from error import InputError, AccessError
 
 # a constant to show a user is an admin
@@ -22,6 +30,59 @@ MEMBER = 2
 MSG_BLOCK = 50
 # A LOCK for concurrently updating the database
 DATABASE_LOCK = threading.Lock()
+# whether the current thread is inside a logged call, only the outermost is recorded
+LOGGED_CALLS = threading.local()
+# the length of the substrings used to index message bodies for searching
+NGRAM_LEN = 3
+# the react every message is shown with, even before anyone has reacted
+DEFAULT_REACT_ID = 1
+# 'memory' keeps the database in memory, snapshotted to disk, 'columnar' does the
+# same with messages kept in ColumnarMessages, 'sqlite' keeps it in SQLITE_FILE
+# through sqlite_store.SqliteDatabase
+STORAGE_BACKEND = 'memory'
+SQLITE_FILE = 'database.db'
+# the fraction of wasted rows or body bytes at which ColumnarMessages compacts itself
+COMPACT_RATIO = 0.5
+# how many of the latest distinct message bodies BodyStore remembers to spot repeats
+RECENT_BODIES = 1024
+# a session ends after this many seconds without a request
+SESSION_IDLE_TTL = 60 * 60 * 24
+# a session ends this many seconds after login regardless of use
+SESSION_ABSOLUTE_TTL = 60 * 60 * 24 * 30
+# how often the background sweep evicts expired sessions
+SESSION_SWEEP_SECONDS = 60
+# whether sessions survive a server restart
+PERSIST_SESSIONS = True
+SESSIONS_FILE = 'sessions.dat'
+# file header, then per session: u_id, created, last_seen, expires, token length
+SESSIONS_MAGIC = b'SES1'
+SESSION_FORMAT = struct.Struct('<iddBH')
+# a password reset code is only accepted for this many seconds after it is sent
+RESET_CODE_TTL = 60 * 15
+# whether Database changes are logged so they can be replayed after a crash
+WAL_ENABLED = True
+WAL_FILE = 'database.wal'
+# where snapshots of the database are kept
+DATABASE_FILE = 'database.p'
+# whether snapshots are written by a forked child instead of the thread asking for them
+SNAPSHOT_FORK = hasattr(os, 'fork')
+# whether snapshots only write the parts of the database changed since the last one,
+# as files in SNAPSHOT_DIR listed by SNAPSHOT_MANIFEST, instead of all of DATABASE_FILE
+INCREMENTAL_SNAPSHOTS = True
+SNAPSHOT_DIR = 'snapshot'
+SNAPSHOT_MANIFEST = 'manifest.p'
+# the number of consecutive message ids an incremental snapshot writes to one file
+SEGMENT_SIZE = 4096
+# the stores an incremental snapshot writes whole once changed, and those it writes
+# by segment. Timelines are not written, being rebuilt from the messages on load
+WHOLE_STORES = ('users', 'admins', 'channels', 'codes', 'user_channel')
+SEGMENTED_STORES = ('messages', 'user_message')
+# 'always' fsyncs every record, 'group' shares an fsync between concurrent writers,
+# 'periodic' fsyncs every WAL_FSYNC_SECONDS
+WAL_FSYNC = 'group'
+WAL_FSYNC_SECONDS = 1
+# per record: sequence number, payload length, crc32 of the payload
+WAL_RECORD = struct.Struct('<QII')
 
 # needed for generating the image_url
 ROUTE = '/imgurl'
@@ -30,17 +91,73 @@ IMAGE_DIR = './images'
 PORT = 5000
 
 
-def is_this_user_reacted(u_id, link_info):
+def react_projection(u_id, reacts):
     '''
-    Updates whether the user has reacted given a link which contains message info
-    Output: a link_info which has been updated with a new key added to one of its dictionaries
+    Builds the reacts list as seen by the user with u_id from the reacts stored in a link,
+    without modifying them so that concurrent readers never write to shared data
+    Output: a list of dictionaries with keys react_id, u_ids and is_this_user_reacted
     '''
-    # updating is_this_user_reacted based on the authorized user
-    reacts_lists = [msg['reacts'] for msg in link_info]
+    # links only allocate reacts once someone has reacted
+    if not reacts:
+        reacts = {DEFAULT_REACT_ID: ()}
+    return [{
+        'react_id': react_id,
+        'u_ids': list(u_ids),
+        'is_this_user_reacted': u_id in u_ids
+    } for react_id, u_ids in reacts.items()]
 
-    for reacts_list in reacts_lists:
-        for react in reacts_list:
-            react['is_this_user_reacted'] = u_id in react['u_ids']
+
+def logged(method):
+    '''
+    Decorates a method that changes the Database. While a WriteAheadLog is open or a
+    SnapshotScheduler is running, the outermost such call in a thread runs under
+    DATABASE_LOCK and, if it succeeds, is recorded in the log before returning and
+    counted towards the next snapshot. Calls it makes to other logged methods are
+    part of the same record. Every call marks its store in DIRTY_STORES for the next
+    incremental snapshot. The class names the Database attribute it lives under
+    in store_name, '' for the Database itself
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        wal = WAL
+        scheduler = SCHEDULER
+        if (wal is None and scheduler is None) or getattr(LOGGED_CALLS, 'active', False):
+            DIRTY_STORES.add(self.store_name)
+            return method(self, *args, **kwargs)
+        with DATABASE_LOCK:
+            # marked under the lock so a snapshot never takes the mark before the change
+            DIRTY_STORES.add(self.store_name)
+            LOGGED_CALLS.active = True
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                LOGGED_CALLS.active = False
+            lsn, size = 0, 0
+            if wal is not None:
+                lsn, size = wal.append(self.store_name, method.__name__, args, kwargs)
+                get_store().wal_lsn = lsn
+        if wal is not None:
+            wal.commit(lsn)
+        if scheduler is not None:
+            scheduler.record(size)
+        return result
+    return wrapper
+
+
+def ngrams(text):
+    '''
+    Returns the set of distinct substrings of length NGRAM_LEN in text
+    '''
+    return {text[i:i + NGRAM_LEN] for i in range(len(text) - NGRAM_LEN + 1)}
+
+
+def timeline_key(time_created, message_id):
+    '''
+    Returns the key messages are ordered by, oldest first; negating the id
+    keeps messages sent at the same time in the order they were sent once
+    the order is reversed to list the newest first
+    '''
+    return (time_created, -message_id)
 
 
 def generate_reset_code():
@@ -57,6 +174,158 @@ def generate_reset_code():
     reset_code = reset_code.upper()[0:str_len]
     return reset_code
 
+
+class UserRecord():
+    '''
+    A compact record of a user's details, stored in Users.
+    Slots avoid the memory overhead of a dictionary per user
+    '''
+    __slots__ = ('email', 'name_first', 'name_last', 'password', 'handle_str', 'img_path')
+
+    def __init__(self, email, name_first, name_last, password, handle_str):
+        self.email = email
+        self.name_first = name_first
+        self.name_last = name_last
+        self.password = password
+        self.handle_str = handle_str
+        self.img_path = ""
+
+
+class MessageRecord():
+    '''
+    A compact record of a message's details, stored in Messages.
+    Slots avoid the memory overhead of a dictionary per message
+    '''
+    __slots__ = ('message_id', 'message', 'time_created', 'is_pinned')
+
+    def __init__(self, message_id, message, time_created):
+        self.message_id = message_id
+        self.message = message
+        self.time_created = time_created
+        self.is_pinned = False
+
+    def to_dict(self):
+        '''
+        Returns the message in the dictionary format used by the API
+        '''
+        return {
+            'message_id': self.message_id,
+            'message': self.message,
+            'time_created': self.time_created,
+            'is_pinned': self.is_pinned,
+        }
+
+
+class LinkRecord():
+    '''
+    A compact record linking a message to its sender and channel, stored in UserMessage.
+    reacts stays None until the first react, then maps each react_id to the
+    u_ids that reacted with it
+    '''
+    __slots__ = ('message_id', 'u_id', 'channel_id', 'reacts')
+
+    def __init__(self, message_id, u_id, channel_id):
+        self.message_id = message_id
+        self.u_id = u_id
+        self.channel_id = channel_id
+        self.reacts = None
+
+
+class SessionRecord():
+    '''
+    A compact record of a login session, stored in Sessions. queued is the deadline
+    the session was last pushed onto the expiry heap with
+    '''
+    __slots__ = ('u_id', 'created', 'last_seen', 'expires', 'queued')
+
+    def __init__(self, u_id, created, last_seen, expires=True):
+        self.u_id = u_id
+        self.created = created
+        self.last_seen = last_seen
+        self.expires = expires
+        self.queued = None
+
+    def deadline(self):
+        '''
+        Returns: the time at which the session expires (float), infinity if it never does
+        '''
+        if not self.expires:
+            return float('inf')
+        return min(self.last_seen + SESSION_IDLE_TTL,
+                   self.created + SESSION_ABSOLUTE_TTL)
+
+
+class PrefixIndex():
+    '''
+    A class that indexes ids under case-insensitive string keys in a sorted list,
+    so that every key starting with a prefix is found with a binary search
+
+    Attributes:
+    -----------
+    entries : list
+        Sorted (key, id) pairs, with keys lowercased
+
+    Methods:
+    --------
+    add(key, entry_id)
+        indexes 'entry_id' under 'key'
+    remove(key, entry_id)
+        removes 'entry_id' from under 'key'
+    iter_prefix(prefix)
+        yields the ids with a key starting with 'prefix'
+    search(prefix, limit)
+        returns up to 'limit' distinct ids with a key starting with 'prefix'
+    '''
+
+    def __init__(self):
+        self._entries = []
+
+    def add(self, key, entry_id):
+        '''
+        Indexes entry_id under key
+        Params: key (str), entry_id (int)
+        '''
+        insort(self._entries, (key.lower(), entry_id))
+
+    def remove(self, key, entry_id):
+        '''
+        Removes entry_id from under key, if it is there
+        Params: key (str), entry_id (int)
+        '''
+        entry = (key.lower(), entry_id)
+        index = bisect_left(self._entries, entry)
+        if index < len(self._entries) and self._entries[index] == entry:
+            del self._entries[index]
+
+    def iter_prefix(self, prefix):
+        '''
+        Yields the ids whose key starts with prefix, in key order. An id
+        indexed under several matching keys is yielded once per key
+        Params: prefix (str)
+        '''
+        prefix = prefix.lower()
+        index = bisect_left(self._entries, (prefix,))
+        while index < len(self._entries):
+            key, entry_id = self._entries[index]
+            if not key.startswith(prefix):
+                break
+            yield entry_id
+            index += 1
+
+    def search(self, prefix, limit):
+        '''
+        Params: prefix (str), limit (int)
+        Returns: up to limit distinct ids whose key starts with prefix,
+            in key order (List)
+        '''
+        found = dict()
+        for entry_id in self.iter_prefix(prefix):
+            if len(found) >= limit:
+                break
+            found[entry_id] = None
+        return list(found)
+
+
 class Users():
     '''
     A class that contains and manages user information, excluding the links between those users
@@ -64,24 +333,61 @@ class Users():
 
     Attributes:
     -----------
-    _users : list
-        Contains dictionaries with information regarding each user, each dictionary
-            contains keys for email, first and last names, pswrd, handle and img_path
+    _users : dict
+        Maps each u_id to a UserRecord with information regarding that user:
+            email, first and last names, pswrd, handle and img_path
+    _emails: dict
+        Maps each registered email to the u_id of the user who owns it
+    _handles: dict
+        Maps each handle in use to the u_id of the user who owns it
     _num_users: int
         Keeps track of the total number of users currently existing
     current_id: int
         Keeps track of the current ID of the latest user. ID's increment by 1 and
             continue to do so even with deletion of previous messages
+    _version: int
+        The directory version, which moves on with every change to any user
+    _names: PrefixIndex
+        Indexes each u_id under the user's handle, first and last names
 
 
     '''
 
+    store_name = 'users'
+
     def __init__(self):
         self._users = dict()
+        self._emails = dict()
+        self._handles = dict()
         self._num_users = 0
         self._current_id = 0
         self._img_dir = IMAGE_DIR
+        self._version = 0
+        self._names = PrefixIndex()
 
+    def __setstate__(self, fields):
+        '''
+        Restores a pickled store. One pickled before users were kept in UserRecords,
+        as an older database.p is, has its records converted and its indexes built
+        '''
+        self.__dict__.update(fields)
+        if '_emails' in fields:
+            return
+        users, current_id = self._users, self._current_id
+        self.__init__()
+        for u_id, details in users.items():
+            record = UserRecord(details['email'], details['name_first'], details['name_last'],
+                                details['password'], details['handle_str'])
+            record.img_path = details['img_path']
+            self._users[u_id] = record
+            self._emails[record.email] = u_id
+            self._handles[record.handle_str] = u_id
+            for name in (record.handle_str, record.name_first, record.name_last):
+                self._names.add(name, u_id)
+        self._num_users = len(self._users)
+        self._current_id = current_id
+
+    @logged
     def add(self, details):
         '''
         adds user with given details to the database
@@ -96,22 +402,35 @@ class Users():
 
         self._num_users += 1
         self._current_id += 1
-        self._users[self._current_id] = {
-            'email': email,
-            'name_first': f_name,
-            'name_last': l_name,
-            'password': password,
-            'handle_str': handle,
-            'img_path': ""
-        }
+        self._version += 1
+        self._users[self._current_id] = UserRecord(
+            email, f_name, l_name, password, handle)
+        self._emails[email] = self._current_id
+        self._handles[handle] = self._current_id
+        for name in (handle, f_name, l_name):
+            self._names.add(name, self._current_id)
         return self._current_id
 
+    @logged
     def remove(self, u_id):
         '''
         Remove details of a user with u_id from the dictionary
         '''
-        self._users.pop(u_id)
+        details = self._users.pop(u_id)
+        self._unindex(self._emails, details.email, u_id)
+        self._unindex(self._handles, details.handle_str, u_id)
+        for name in (details.handle_str, details.name_first, details.name_last):
+            self._names.remove(name, u_id)
         self._num_users -= 1
+        self._version += 1
+
+    @staticmethod
+    def _unindex(index, key, u_id):
+        '''
+        Removes key from an email/handle index if it still belongs to u_id
+        '''
+        if index.get(key) == u_id:
+            del index[key]
 
     def user_details(self, u_id):
         '''
@@ -120,24 +439,61 @@ class Users():
         if not self.user_exists(u_id):
             raise InputError('User does not exist')
 
-        details = self._users[u_id]
+        return self._profile(u_id, self._users[u_id])
+
+    @staticmethod
+    def _profile(u_id, details):
+        '''
+        Produce the profile dictionary of user with u_id from their UserRecord
+        '''
         global PORT  # pylint: disable=global-statement
         return {
             'u_id': u_id,
-            'email': details['email'],
-            'name_first': details['name_first'],
-            'name_last': details['name_last'],
-            'handle_str': details['handle_str'],
-            'profile_img_url': f"{HOST}:{PORT}{ROUTE}?path={details['img_path']}"
-                               if details['img_path'] else ""
+            'email': details.email,
+            'name_first': details.name_first,
+            'name_last': details.name_last,
+            'handle_str': details.handle_str,
+            'profile_img_url': f"{HOST}:{PORT}{ROUTE}?path={details.img_path}"
+                               if details.img_path else ""
         }
 
     def all(self):
         '''
         Returns a list of all users in the specified dictionary format
         '''
+        # built from a copy, so users registering or being removed meanwhile
+        # neither break the iteration nor go missing halfway
         all_users = dict(self._users)
-        return list(map(self.user_details, all_users))
+        return [self._profile(u_id, details) for u_id, details in all_users.items()]
+
+    def search_prefix(self, prefix, limit):
+        '''
+        Input: prefix: string, limit: int
+        Returns: the details of up to limit users whose handle, first or last name
+            starts with prefix, ignoring case, in alphabetical order of the matching name
+        '''
+        return [self._profile(u_id, self._users[u_id])
+                for u_id in self._names.search(prefix, limit)]
+
+    def iter_users(self, after=0):
+        '''
+        Yields the details of every user with a u_id greater than after, in u_id order.
+        Walks the range of ids handed out rather than the dictionary, so users can
+        register or be removed while a listing is still being read
+        Input: after: int
+        '''
+        u_id = after
+        while u_id < self._current_id:
+            u_id += 1
+            details = self._users.get(u_id)
+            if details is not None:
+                yield self._profile(u_id, details)
+
+    def version(self):
+        '''
+        Returns: the directory version (int), which changes whenever any user does
+        '''
+        return self._version
 
     def user_exists(self, u_id):
         '''
@@ -155,9 +511,7 @@ class Users():
         Returns: Bool
         Checks whether the email is registered in the database
         '''
-        if email in [user['email'] for user in self._users.values()]:
-            return True
-        return False
+        return email in self._emails
 
     def find_u_id(self, email):
         '''
@@ -165,13 +519,7 @@ class Users():
         Returns: u_id: int, None if not found
         Returns the user id given the email if it exists
         '''
-        u_id = 1
-        for user in self._users.values():
-            if email == user['email']:
-                return u_id
-            u_id += 1
-
-        return None
+        return self._emails.get(email)
 
     def handle_unique(self, handle):
         '''
@@ -179,26 +527,31 @@ class Users():
         Returns: Bool
         Checks if the handle is not already used by another user
         '''
-        if handle in [user['handle_str'] for user in self._users.values()]:
-            return False
-
-        return True
+        return handle not in self._handles
 
+    @logged
     def set_first_name(self, u_id, name):
         '''
         Input: u_id: int, name: string
         Returns: nothing
         Resets the first name of user with u_id
         '''
-        self._users[u_id]['name_first'] = name
+        self._names.remove(self._users[u_id].name_first, u_id)
+        self._users[u_id].name_first = name
+        self._names.add(name, u_id)
+        self._version += 1
 
+    @logged
     def set_last_name(self, u_id, name):
         '''
         Input: u_id: int, name: string
         Returns: nothing
         Resets the last name of user with u_id
         '''
-        self._users[u_id]['name_last'] = name
+        self._names.remove(self._users[u_id].name_last, u_id)
+        self._users[u_id].name_last = name
+        self._names.add(name, u_id)
+        self._version += 1
 
     def get_handle(self, u_id):
         '''
@@ -206,40 +559,54 @@ class Users():
         Returns: handle: string
         Gives back the handle of the user with u_id
         '''
-        return self._users[u_id]['handle_str']
+        return self._users[u_id].handle_str
 
+    @logged
     def set_handle(self, u_id, handle_str):
         '''
         Input: u_id: int, handle_str: string
         Returns: nothing
         Resets the handle of user u_id with handle_str
         '''
-        self._users[u_id]['handle_str'] = handle_str
+        self._unindex(self._handles, self._users[u_id].handle_str, u_id)
+        self._names.remove(self._users[u_id].handle_str, u_id)
+        self._users[u_id].handle_str = handle_str
+        self._handles[handle_str] = u_id
+        self._names.add(handle_str, u_id)
+        self._version += 1
 
+    @logged
     def set_email(self, u_id, email):
         '''
         Input: u_id: int, email: string
         Returns: nothing
         Resets the email of user u_id with new email
         '''
-        self._users[u_id]['email'] = email
+        self._unindex(self._emails, self._users[u_id].email, u_id)
+        self._users[u_id].email = email
+        self._emails[email] = u_id
+        self._version += 1
 
-    def set_password(self, u_id, password):
+    @logged
+    def set_password(self, u_id, encrypted_pass):
         '''
-        Input: u_id: int, password: string
+        Input: u_id: int, encrypted_pass: string
         Returns: nothing
-        Resets the password of user u_id with an encrypted `password`
+        Resets the password of user u_id to `encrypted_pass`, which is hashed by the
+        caller as in add_user so that the plain password never reaches the log
         '''
-        encrypt_pass = hashlib.sha256(password.encode()).hexdigest()
-        self._users[u_id]['password'] = encrypt_pass
+        self._users[u_id].password = encrypted_pass
+        self._version += 1
 
+    @logged
     def set_image(self, u_id):
         '''
         Input: u_id: int
         Returns: nothing
         Creates an img path using u_id and saves it into the user's details
         '''
-        self._users[u_id]['img_path'] = f"{self._img_dir}/{u_id}.jpg"
+        self._users[u_id].img_path = f"{self._img_dir}/{u_id}.jpg"
+        self._version += 1
 
     def validate_login(self, email, password):
         '''
@@ -247,14 +614,11 @@ class Users():
         Returns: u_id of the validated user
         Makes sure the email exist and the given password is correct
         '''
-        try:
-            [u_id] = [
-                key for key,
-                value in self._users.items() if value['email'] == email]
-        except ValueError:
+        u_id = self._emails.get(email)
+        if u_id is None:
             raise InputError('Email does not exist')
 
-        if password != self._users[u_id]['password']:
+        if password != self._users[u_id].password:
             raise InputError(description='Password incorrect')
         return u_id
 
@@ -264,10 +628,13 @@ class Admins():
     A special class for users who are admins
     '''
 
+    store_name = 'admins'
+
     def __init__(self):
         self._admins = list()
         self._valid_permissions = [ADMIN, MEMBER]
 
+    @logged
     def add(self, u_id):
         '''
         Input: u_id: int
@@ -277,6 +644,7 @@ class Admins():
         if not self.is_admin(u_id):
             self._admins.append(u_id)
 
+    @logged
     def remove(self, u_id):
         '''
         Input: u_id: int
@@ -309,14 +677,37 @@ class Channels():
     A class to add newly created channels to the database
     and also gather information about specified channels.
     Also store information about the hangman game within
-    each channel
+    each channel. The catalogue version changes whenever a channel's
+    listed details do, so cached listings can tell they are stale.
+    Names are indexed by prefix and by trigram for searching, ignoring case
     '''
 
+    store_name = 'channels'
+
     def __init__(self):
         self._channels = dict()
         self._num_channels = 0
         self._current_id = 0
-
+        self._version = 0
+        self._names = PrefixIndex()
+        self._name_grams = NgramIndex()
+
+    def __setstate__(self, fields):
+        '''
+        Restores a pickled store. One pickled before names were indexed,
+        as an older database.p is, has its indexes built
+        '''
+        self.__dict__.update(fields)
+        if '_names' in fields:
+            return
+        self._version = 0
+        self._names = PrefixIndex()
+        self._name_grams = NgramIndex()
+        for channel_id, details in self._channels.items():
+            self._names.add(details['name'], channel_id)
+            self._name_grams.add(channel_id, details['name'].lower())
+
+    @logged
     def add(self, details):
         '''
         Adds details of a channel to dictionary
@@ -327,6 +718,9 @@ class Channels():
 
         self._num_channels += 1
         self._current_id += 1
+        self._version += 1
+        self._names.add(name, self._current_id)
+        self._name_grams.add(self._current_id, name.lower())
         self._channels[self._current_id] = {
             'name': name,
             'is_public': is_public,
@@ -385,7 +779,40 @@ class Channels():
         Returns a list of all channels created, displaying their details
         '''
         channels_copy = dict(self._channels)
-        return list(map(self.channel_details, channels_copy))
+        return [{'channel_id': channel_id, 'name': details['name']}
+                for channel_id, details in channels_copy.items()]
+
+    def version(self):
+        '''
+        Returns the catalogue version, which changes whenever a channel is added
+        '''
+        return self._version
+
+    def search(self, query_str, limit, visible):
+        '''
+        Finds channels whose name contains query_str, ignoring case. Names starting
+        with query_str come first in name order, then other matches by channel_id
+        Input:
+            query_str (str), limit (int),
+            visible (function): of a channel_id, whether the channel may be returned
+        Returns: details of up to limit matching channels
+        '''
+        query_str = query_str.lower()
+        found = dict()
+        for channel_id in self._names.iter_prefix(query_str):
+            if len(found) >= limit:
+                break
+            if visible(channel_id):
+                found[channel_id] = None
+        # queries shorter than a trigram only match by prefix
+        candidates = self._name_grams.candidates(query_str) or ()
+        for channel_id in sorted(candidates):
+            if len(found) >= limit:
+                break
+            if (channel_id not in found and visible(channel_id)
+                    and query_str in self._channels[channel_id]['name'].lower()):
+                found[channel_id] = None
+        return list(map(self.channel_details, found))
 
 
 # methods relating to hangman game
@@ -399,6 +826,7 @@ class Channels():
         '''
         return bool(self._channels[channel_id]['hangman']['is_enabled'])
 
+    @logged
     def enable_hangman(self, channel_id):
         '''
         Enables hangman game within channel
@@ -406,6 +834,7 @@ class Channels():
         '''
         self._channels[channel_id]['hangman']['is_enabled'] = True
 
+    @logged
     def disable_hangman(self, channel_id):
         '''
         Disable hangman game within channel
@@ -421,6 +850,7 @@ class Channels():
         '''
         return bool(self._channels[channel_id]['hangman']['is_running'])
 
+    @logged
     def add_hbot_details(self, channel_id, bot_id, bot_token):
         '''
         Adds the hangman bot details to the dictionary when it is created
@@ -438,6 +868,7 @@ class Channels():
             self._channels[channel_id]['hangman']['bot_token']
         )
 
+    @logged
     def start_hangman(self, channel_id, details):
         '''
         Changes the state of hangman in specified channel to True
@@ -454,6 +885,7 @@ class Channels():
         return dict(self._channels[channel_id]['hangman']['data'])
 
     # for each turn during the ongoing game
+    @logged
     def edit_hangman(self, channel_id, new_details):
         '''
         Updates the details in the hangman database given users' interactions
@@ -461,6 +893,7 @@ class Channels():
         '''
         self._channels[channel_id]['hangman']['data'] = new_details
 
+    @logged
     def quit_hangman(self, channel_id):
         '''
         Clear all data in the hangman dict
@@ -472,12 +905,53 @@ class Channels():
 class Codes():
     '''
     A class to store reset codes in a dictionary with a user's email
-    as the key to allow users to reset their passwords
+    as the key to allow users to reset their passwords. Codes are also indexed
+    by value and expire RESET_CODE_TTL seconds after they are sent
+
+    Attributes:
+    -----------
+    codes_dict : dict
+        Maps each email with a pending reset to its reset code
+    codes : dict
+        Maps each live reset code to the (email, deadline) it was issued for
+    expiry : list
+        A heap of (deadline, reset_code) pairs, entries whose code has since been
+        used or replaced are skipped when popped
+
+    Methods:
+    --------
+    push(email)
+        issues a new reset code for 'email' and emails it
+    delete(email)
+        removes the reset code of 'email'
+    code_exists(reset_code)
+        raises an InputError unless 'reset_code' is live
+    find_email(reset_code)
+        returns the email 'reset_code' was issued for
+    redeem(reset_code)
+        removes 'reset_code' and returns the email it was issued for
     '''
 
     def __init__(self):
         self._codes_dict = dict()
-        self._num_codes = 0
+        self._codes = dict()
+        self._expiry = []
+
+    def __setstate__(self, fields):
+        '''
+        Restores a pickled store. Codes pickled before they expired, as in an
+        older database.p, are given a full RESET_CODE_TTL from now
+        '''
+        self.__dict__.update(fields)
+        self.__dict__.pop('_num_codes', None)
+        if '_codes' in fields:
+            return
+        self._codes = dict()
+        self._expiry = []
+        deadline = time() + RESET_CODE_TTL
+        for email, reset_code in self._codes_dict.items():
+            self._codes[reset_code] = (email, deadline)
+            heapq.heappush(self._expiry, (deadline, reset_code))
 
     def _send_email(self, email):
         sender_email = 'comp1531resetpass@gmail.com'
@@ -491,32 +965,48 @@ class Codes():
             smtp.login(sender_email, sender_pass)
             smtp.send_message(msg)
 
+    def _expire(self):
+        '''
+        Drops the reset codes whose deadline has passed
+        '''
+        now = time()
+        while self._expiry and self._expiry[0][0] <= now:
+            deadline, reset_code = heapq.heappop(self._expiry)
+            entry = self._codes.get(reset_code)
+            if entry is not None and entry[1] == deadline:
+                self.delete(entry[0])
+
     def push(self, email):
         '''
         Append reset_code to dictionary
         '''
+        self._expire()
         if email in self._codes_dict:
             self.delete(email)
 
         reset_code = generate_reset_code()
+        while reset_code in self._codes:
+            reset_code = generate_reset_code()
+        deadline = time() + RESET_CODE_TTL
         self._codes_dict[email] = reset_code
-        self._num_codes += 1
+        self._codes[reset_code] = (email, deadline)
+        heapq.heappush(self._expiry, (deadline, reset_code))
         self._send_email(email)
 
     def delete(self, email):
         '''
         Delete reset code from dicitonary
         '''
-        del self._codes_dict[email]
-        self._num_codes -= 1
+        reset_code = self._codes_dict.pop(email)
+        del self._codes[reset_code]
 
     def code_exists(self, reset_code):
         '''
         Check if given reset code exists within dictionary else raise an error
         '''
-        for values in self._codes_dict.values():
-            if reset_code in values:
-                return True
+        self._expire()
+        if reset_code in self._codes:
+            return True
         raise InputError(description="Reset code is not valid")
 
     def find_email(self, reset_code):
@@ -524,8 +1014,198 @@ class Codes():
         Returns email within codes dictionary if reset code matches one within dicitonary
         else return None
         '''
-        return [key for (key, value) in self._codes_dict.items()
-                if value == reset_code]
+        self._expire()
+        entry = self._codes.get(reset_code)
+        return [] if entry is None else [entry[0]]
+
+    def redeem(self, reset_code):
+        '''
+        Looks up a reset code and deletes it in one step, so it cannot expire in between
+        Returns: the email the code was issued for (str)
+        Raises: InputError if the code is not live
+        '''
+        self._expire()
+        entry = self._codes.get(reset_code)
+        if entry is None:
+            raise InputError(description="Reset code is not valid")
+        self.delete(entry[0])
+        return entry[0]
+
+
+class NgramIndex():
+    '''
+    A class that indexes message bodies by the trigrams they contain, so that
+    a substring search only has to check the messages sharing all of the query's trigrams
+
+    Attributes:
+    -----------
+    postings : dict
+        Maps every trigram found in a message body to the set of message_ids containing it
+
+    Methods:
+    --------
+    add(message_id, message)
+        indexes 'message' under 'message_id'
+    remove(message_id, message)
+        removes the entries 'message' added under 'message_id'
+    candidates(query_string)
+        returns the message_ids that may contain 'query_string'
+    '''
+
+    def __init__(self):
+        self._postings = dict()
+
+    def add(self, message_id, message):
+        '''
+        Adds message_id to the index under every trigram of message
+        '''
+        for gram in ngrams(message):
+            self._postings.setdefault(gram, set()).add(message_id)
+
+    def remove(self, message_id, message):
+        '''
+        Removes message_id from the index under every trigram of message
+        '''
+        for gram in ngrams(message):
+            posting = self._postings.get(gram)
+            if posting is None:
+                continue
+            posting.discard(message_id)
+            if not posting:
+                del self._postings[gram]
+
+    def candidates(self, query_string):
+        '''
+        Returns the set of message_ids having every trigram of query_string,
+        or None if the query is shorter than a trigram and cannot use the index.
+        Candidates still need to be checked for an actual substring match
+        '''
+        if len(query_string) < NGRAM_LEN:
+            return None
+        # intersecting from the rarest trigram keeps the candidate set small
+        postings = sorted((self._postings.get(gram, set())
+                           for gram in ngrams(query_string)), key=len)
+        return set(postings[0]).intersection(*postings[1:])
+
+
+class BodyStore():
+    '''
+    A class that interns repeated message bodies by their content, so that messages with
+    identical text (bot help text, hangman replies, standup boilerplate) share one string.
+    Pickle writes a shared string once, so snapshots shrink in the same way.
+
+    Most bodies are never repeated, and an entry for each of them would cost more than
+    sharing saves, so a body is only interned once it is seen again among the
+    RECENT_BODIES latest distinct bodies; the message that first sent it keeps its own copy
+
+    Attributes:
+    -----------
+    bodies : dict
+        Maps each interned body to a list of its shared string and the set of
+        message_ids of the messages holding that string
+    recent : dict
+        The hashes of the latest bodies seen once, oldest first, with None values
+
+    Methods:
+    --------
+    intern(message_id, body)
+        returns the shared copy of 'body', taking a reference for 'message_id' if it is repeated
+    release(message_id, body)
+        drops the reference 'message_id' holds to 'body', forgetting it once no message uses it
+    '''
+
+    def __init__(self):
+        self._bodies = dict()
+        self._recent = dict()
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def intern(self, message_id, body):
+        '''
+        Returns the shared copy of body for the message with message_id, which is body
+        itself if it is not repeated or is repeated for the first time
+        '''
+        entry = self._bodies.get(body)
+        if entry is not None:
+            entry[1].add(message_id)
+            return entry[0]
+        key = hash(body)
+        if key in self._recent:
+            # seen again, later copies share this one
+            del self._recent[key]
+            self._bodies[body] = [body, {message_id}]
+        else:
+            self._recent[key] = None
+            if len(self._recent) > RECENT_BODIES:
+                del self._recent[next(iter(self._recent))]
+        return body
+
+    def release(self, message_id, body):
+        '''
+        Drops the reference the message with message_id holds to body, if it took one.
+        References are kept by message rather than by the identity of the string, as
+        the message that first sent a body may hold that very same string
+        '''
+        entry = self._bodies.get(body)
+        if entry is None or message_id not in entry[1]:
+            return
+        entry[1].discard(message_id)
+        if not entry[1]:
+            del self._bodies[body]
+
+
+class DirtySegments():
+    '''
+    A class that remembers which segments of a store, runs of SEGMENT_SIZE consecutive
+    ids, have changed since the last snapshot, so that only those are written again
+
+    Attributes:
+    -----------
+    segments : set
+        The numbers of the changed segments, an id's segment being id // SEGMENT_SIZE
+
+    Methods:
+    --------
+    touch(entry_id)
+        marks the segment holding 'entry_id' as changed
+    take()
+        returns the changed segments and starts tracking afresh
+    restore(segments)
+        marks 'segments' as changed again, after a snapshot of them failed
+    '''
+
+    def __init__(self):
+        self._segments = set()
+
+    def touch(self, entry_id):
+        '''
+        Marks the segment holding entry_id as changed
+        '''
+        self._segments.add(entry_id // SEGMENT_SIZE)
+
+    def take(self):
+        '''
+        Returns: the segments changed since the last call (set)
+        '''
+        segments = self._segments
+        self._segments = set()
+        return segments
+
+    def restore(self, segments):
+        '''
+        Marks segments as changed again
+        '''
+        self._segments.update(segments)
+
+
+def id_segment(entries, segment):
+    '''
+    Returns the entries of a dict keyed by id that fall in segment, in id order
+    '''
+    start = segment * SEGMENT_SIZE
+    return {entry_id: entries[entry_id]
+            for entry_id in range(start, start + SEGMENT_SIZE) if entry_id in entries}
 
 
 class Messages():
@@ -535,14 +1215,21 @@ class Messages():
 
     Attributes:
     -----------
-    messages : list
-        Contains dictionaries with information regarding each message, each dictionary
-            contains keys message_id, message, time_created and is_pinned
+    messages : dict
+        Maps each message_id to a MessageRecord with information regarding that message:
+            message_id, message, time_created and is_pinned.
+            Insertion order is preserved, so iterating gives messages in the order sent
     num_messages: int
         Keeps track of the total number of messages currently existing
     current_id: int
         Keeps track of the current ID of the latest message sent. ID's increment by 1 and
             continue to do so even with deletion of previous messages
+    ngram_index: NgramIndex
+        Indexes message bodies by trigram for searching
+    bodies: BodyStore
+        Shares the string of identical message bodies
+    dirty: DirtySegments
+        The message id ranges changed since the last snapshot
 
     Methods:
     --------
@@ -557,83 +1244,128 @@ class Messages():
     def remove(self, message_id)
     def find(self, message_id)
     def search(self, query_string)
+    def candidates(self, query_string)
     def next_id(self)
+    def take_dirty_segments(self)
+    def restore_dirty_segments(self, segments)
+    def segment_ids(self)
+    def segment(self, segment)
+    def snapshot_meta(self)
+    def load_segments(self, segments, meta)
     '''
 
+    store_name = 'messages'
+
     def __init__(self):
-        self._messages = list()
+        self._messages = dict()
         self._num_messages = 0
         self._current_id = 0
+        self._ngram_index = NgramIndex()
+        self._bodies = BodyStore()
+        self._dirty = DirtySegments()
+
+    def __getstate__(self):
+        '''
+        Leaves the trigram index out of pickles, as it is rebuilt from the bodies
+        '''
+        fields = self.__dict__.copy()
+        del fields['_ngram_index']
+        return fields
+
+    def __setstate__(self, fields):
+        '''
+        Restores a pickled store, rebuilding its trigram index. One pickled with
+        a list of dictionaries, as an older database.p is, has them converted
+        '''
+        self.__dict__.update(fields)
+        if isinstance(self._messages, list):
+            messages = self._messages
+            self._messages = dict()
+            self._bodies = BodyStore()
+            self._dirty = DirtySegments()
+            for details in messages:
+                message_id = details['message_id']
+                body = self._bodies.intern(message_id, details['message'])
+                record = MessageRecord(message_id, body, details['time_created'])
+                record.is_pinned = details['is_pinned']
+                self._messages[message_id] = record
+        self._ngram_index = NgramIndex()
+        for message_id, record in self._messages.items():
+            self._ngram_index.add(message_id, record.message)
 
     def all(self):
         '''
         Returns all message dictionaries in a list
         '''
-        return list(self._messages)
+        # a copy of the records, as messages may be sent while they are listed
+        return [msg.to_dict() for msg in list(self._messages.values())]
 
+    @logged
     def add(self, details):
         '''
-        Appends to the list of messages a new dictionary
-        containing the following details
+        Adds to the messages a new record
+        containing the following details:
+        message, time_created and optionally the sender's u_id and the channel_id,
+        which are only kept by ColumnarMessages
         '''
-        message, time_created = details
+        message, time_created = details[:2]
         self._num_messages += 1
         self._current_id += 1
-        self._messages.append({
-            'message_id': self._current_id,
-            'message': message,
-            'time_created': time_created,
-            'is_pinned': False,
-        })
+        self._messages[self._current_id] = MessageRecord(
+            self._current_id, self._bodies.intern(self._current_id, message), time_created)
+        self._ngram_index.add(self._current_id, message)
+        self._dirty.touch(self._current_id)
         return self._current_id
 
+    @logged
     def edit(self, message_id, message):
         '''
         Replaces the contents of message with message_id
         with the message string
         '''
-        for msg in self._messages:
-            if msg['message_id'] == message_id:
-                msg['message'] = message
+        if message_id in self._messages:
+            old_message = self._messages[message_id].message
+            self._ngram_index.remove(message_id, old_message)
+            self._bodies.release(message_id, old_message)
+            self._messages[message_id].message = self._bodies.intern(message_id, message)
+            self._ngram_index.add(message_id, message)
+            self._dirty.touch(message_id)
 
+    @logged
     def pin(self, message_id):
         '''
         Pins the message with message_id
         '''
-        if self.message_details(message_id)['is_pinned']:
+        if self._messages[message_id].is_pinned:
             raise InputError(description='Message already pinned')
-        ids = [msg['message_id'] for msg in self._messages]
-        self._messages[ids.index(message_id)]['is_pinned'] = True
+        self._messages[message_id].is_pinned = True
+        self._dirty.touch(message_id)
 
+    @logged
     def unpin(self, message_id):
         '''
         Unpins the message with message_id
         '''
-        if not self.message_details(message_id)['is_pinned']:
+        if not self._messages[message_id].is_pinned:
             raise InputError(description='Message already unpinned')
-        ids = [msg['message_id'] for msg in self._messages]
-        self._messages[ids.index(message_id)]['is_pinned'] = False
+        self._messages[message_id].is_pinned = False
+        self._dirty.touch(message_id)
 
     def message_details(self, message_id):
         '''
         Returns details of message with message_id
         in the form of a dictionary
         '''
-        try:
-            [message] = list(
-                filter(
-                    lambda x: x['message_id'] == message_id,
-                    self._messages))
-            return dict(message)
-        except ValueError:
+        message = self._messages.get(message_id)
+        if message is None:
             return None
+        return message.to_dict()
 
     def message_exists(self, message_id):
         '''
         Returns whether message with message_id exists
         '''
-        return message_id in [message['message_id']
-                              for message in self._messages]
+        return message_id in self._messages
 
     def fetch_messages(self, start):
         '''
@@ -642,25 +1374,25 @@ class Messages():
         '''
         if start < 0 or start > self._num_messages:
             raise InputError(description='Invalid Start index')
-        if start + MSG_BLOCK >= self._num_messages:
-            return list(self._messages[start:])
-        return list(self._messages[start: start + MSG_BLOCK])
+        records = list(self._messages.values())
+        return [msg.to_dict() for msg in records[start:start + MSG_BLOCK]]
 
+    @logged
     def remove(self, message_id):
         '''
         Removes a message with message_id
         '''
         if not self.message_exists(message_id):
             raise InputError(description='Message does not exist')
-        self._messages[:] = list(
-            filter(
-                lambda x: x['message_id'] != message_id,
-                self._messages))
+        self._ngram_index.remove(message_id, self._messages[message_id].message)
+        self._bodies.release(message_id, self._messages[message_id].message)
+        del self._messages[message_id]
         self._num_messages -= 1
+        self._dirty.touch(message_id)
 
     def find(self, message_id):
         '''
-        Returns the message_id of message
+        Returns the record of the message with message_id
         '''
         return self._messages[message_id]
 
@@ -668,8 +1400,19 @@ class Messages():
         '''
         Returns list of messages that contain the query_string
         '''
-        return list(
-            [msg for msg in self._messages if query_string in msg['message']])
+        candidates = self.candidates(query_string)
+        message_ids = list(self._messages) if candidates is None else sorted(candidates)
+        # skipping messages removed since the candidates were taken
+        records = (msg for msg in map(self._messages.get, message_ids) if msg is not None)
+        # every trigram matching does not guarantee a substring match
+        return [msg.to_dict() for msg in records if query_string in msg.message]
+
+    def candidates(self, query_string):
+        '''
+        Returns the set of message_ids that may contain the query_string, from the
+        trigram index, or None if the query is too short and any message may
+        '''
+        return self._ngram_index.candidates(query_string)
 
     def next_id(self):
         '''
@@ -677,146 +1420,563 @@ class Messages():
         '''
         return int(self._current_id + 1)
 
+    def take_dirty_segments(self):
+        '''
+        Returns the segments changed since the last call, for an incremental snapshot
+        '''
+        return self._dirty.take()
+
+    def restore_dirty_segments(self, segments):
+        '''
+        Marks segments as changed again after a snapshot of them failed
+        '''
+        self._dirty.restore(segments)
 
-class UserMessage():
+    def segment_ids(self):
+        '''
+        Returns every segment holding a message, for a full snapshot
+        '''
+        return {message_id // SEGMENT_SIZE for message_id in self._messages}
+
+    def segment(self, segment):
+        '''
+        Returns the records of the messages in segment, keyed by message_id
+        '''
+        return id_segment(self._messages, segment)
+
+    def snapshot_meta(self):
+        '''
+        Returns what load_segments needs besides the segments themselves
+        '''
+        return {'current_id': self._current_id}
+
+    def load_segments(self, segments, meta):
+        '''
+        Fills an empty store from the segments of a snapshot, in segment order,
+        rebuilding the indexes that are not written
+        Params: segments (iterable of dict), meta (dict): from snapshot_meta
+        '''
+        for records in segments:
+            for message_id, record in records.items():
+                record.message = self._bodies.intern(message_id, record.message)
+                self._messages[message_id] = record
+                self._ngram_index.add(message_id, record.message)
+        self._num_messages = len(self._messages)
+        self._current_id = meta.get('current_id', max(self._messages, default=0))
+
+
+class ColumnarMessages():
     '''
-    A class containing the structure that maintains the relationship
-    between users, channels, reacts and messages they sent
+    An alternative to Messages that stores every field in its own contiguous column
+    rather than one object per message, which takes several times less memory,
+    makes scans over a field tight loops and pickles as a handful of buffers.
+
+    Removed messages are only marked as dead, and edited bodies are appended to the
+    arena, until enough space is wasted for the columns to be compacted.
 
     Attributes:
     -----------
-    user_messages : list
-        Contains tuples with information linking message_id to u_id, as well
-            as channel_id and creates an empty reacts list of that message
-    react_ids: list
-        Stores the currently valid react ID's (currently 1)
+    ids, times, senders, channels : array
+        The message_id, time_created, sender's u_id and channel_id of each row;
+        message_ids only grow so the ids column is sorted and rows are found by bisection
+    offsets, lengths : array
+        Where the utf-8 encoded body of each row lies in the arena
+    arena : bytearray
+        The append-only storage of every message body
+    pinned, alive : bytearray
+        Bitsets of which rows are pinned and which have not been removed
+    int_times : bytearray
+        Bitset of which rows were created with an int time_created, which the
+        times column stores as a float but records give back as an int
+    num_messages: int
+        Keeps track of the total number of messages currently existing
+    current_id: int
+        Keeps track of the current ID of the latest message sent
+    ngram_index: NgramIndex
+        Indexes message bodies by trigram for searching
 
     Methods:
     --------
-    def add_link(self, u_id, channel_id, message_id)
-    def fetch_links_by_channel(self, container)
-        returns list of links filtered by specified channel_id(s)
-    def fetch_links_by_user(self, u_id)
-    def remove_link_by_user(self, u_id)
-    def remove_link_by_channel(self, channel_id)
-    def remove_link_by_message(self, message_id)
-    def link_exists(self, message_id)
-    def react(self, u_id, m_id, react_id)
-    def unreact(self, u_id, m_id, react_id)
-    def fetch_link(self, m_id)
-        returns the tuple containing a specified message_id
-    def is_valid_react(self, react_id)
-    def is_sender(self, m_id, u_id)
-    def message_channel(self, message_id)
-        returns the channel the message with message_id is in
+    The same as Messages, along with
+    def channel_counts(self)
+    def time_range(self, time_from, time_to)
     '''
 
+    store_name = 'messages'
+
     def __init__(self):
-        self._user_messages = list()
-        self._react_ids = [1]
+        self._ids = array('q')
+        self._times = array('d')
+        self._senders = array('q')
+        self._channels = array('q')
+        self._offsets = array('Q')
+        self._lengths = array('I')
+        self._arena = bytearray()
+        self._pinned = bytearray()
+        self._alive = bytearray()
+        self._int_times = bytearray()
+        self._wasted_bytes = 0
+        self._num_messages = 0
+        self._current_id = 0
+        self._ngram_index = NgramIndex()
 
-    def add_link(self, u_id, channel_id, message_id):
+    def __getstate__(self):
         '''
-        Adds a tuple containing u_id, channel_id, message_id
+        Leaves the trigram index out of pickles, as it is rebuilt from the arena
         '''
-        if self.link_exists(message_id):
-            raise InputError(description='Message already exists')
-        self._user_messages.append({
-            'message_id': message_id,
-            'u_id': u_id,
-            'channel_id': channel_id,
-            'reacts': [{
-                'react_id': 1,
-                'u_ids': []
-            }]
-        })
+        fields = self.__dict__.copy()
+        del fields['_ngram_index']
+        return fields
 
-    def fetch_links_by_channel(self, container):
+    def __setstate__(self, fields):
         '''
-        Fetches all links by channel_id/multiple channel_ids
+        Restores a pickled store, rebuilding its trigram index
         '''
-        if isinstance(container, list):
-            channel_msgs = list(
-                filter(
-                    lambda x: x['channel_id'] in container,
-                    self._user_messages))
-        else:
-            channel_msgs = list(
-                filter(
-                    lambda x: x['channel_id'] == container,
-                    self._user_messages))
+        self.__dict__.update(fields)
+        self._ngram_index = NgramIndex()
+        for row in self._live_rows():
+            self._ngram_index.add(self._ids[row], self._body(row))
 
-        return list(channel_msgs)
+    @staticmethod
+    def _get_bit(bits, row):
+        '''
+        Returns whether the bit for row is set in a bitset
+        '''
+        return bool(bits[row >> 3] & (1 << (row & 7)))
 
-    def fetch_links_by_user(self, u_id):
+    @staticmethod
+    def _set_bit(bits, row, value):
         '''
-        Fetches all message links that the user has sent
+        Sets or clears the bit for row in a bitset
         '''
-        filtered = list(
-            filter(
-                lambda x: x['u_id'] == u_id,
-                self._user_messages))
-        return list(filtered)
+        if value:
+            bits[row >> 3] |= 1 << (row & 7)
+        else:
+            bits[row >> 3] &= ~(1 << (row & 7)) & 0xFF
 
-    def remove_link_by_user(self, u_id):
+    def _row(self, message_id):
         '''
-        Removes all tuples from list of links containing u_id
+        Returns the row of the live message with message_id, or None
         '''
-        self._user_messages = list(
-            filter(
-                lambda x: x['u_id'] != u_id,
-                self._user_messages))
+        row = bisect_left(self._ids, message_id)
+        if row < len(self._ids) and self._ids[row] == message_id \
+                and self._get_bit(self._alive, row):
+            return row
+        return None
 
-    def remove_link_by_channel(self, channel_id):
+    def _existing_row(self, message_id):
         '''
-        Removes all tuples from list of links containing channel_id
+        Returns the row of the live message with message_id
+        Raises: KeyError if there is no such message, as Messages does
         '''
-        self._user_messages = list(
-            filter(lambda x: x['channel_id'] != channel_id, self._user_messages))
+        row = self._row(message_id)
+        if row is None:
+            raise KeyError(message_id)
+        return row
 
-    def remove_link_by_message(self, message_id):
+    def _live_rows(self):
         '''
-        Removes all tuples from list of links containing channel_id
+        Yields the rows of messages that have not been removed, oldest first
         '''
-        self._user_messages = list(
-            filter(lambda x: x['message_id'] != message_id, self._user_messages))
+        return (row for row in range(len(self._ids)) if self._get_bit(self._alive, row))
 
-    def link_exists(self, message_id):
+    def _body(self, row):
         '''
-        Checks whether a tuple with message_id exists in user_messages
+        Decodes the message body of row from the arena
         '''
-        return message_id in [link['message_id']
-                              for link in self._user_messages]
+        offset = self._offsets[row]
+        return self._arena[offset:offset + self._lengths[row]].decode()
 
-    def react(self, u_id, m_id, react_id):
+    def _record(self, row):
         '''
-        Adds react details to the link with u_id, m_id
+        Builds a MessageRecord from the columns of row
         '''
-        if not self.link_exists(m_id):
-            raise InputError(description='Message does not exist')
+        time_created = self._times[row]
+        if self._get_bit(self._int_times, row):
+            time_created = int(time_created)
+        record = MessageRecord(self._ids[row], self._body(row), time_created)
+        record.is_pinned = self._get_bit(self._pinned, row)
+        return record
 
-        if not self.is_valid_react(react_id):
-            raise InputError(description='Invalid react')
+    def _store_body(self, row, message):
+        '''
+        Appends message to the arena and points row at it
+        '''
+        encoded = message.encode()
+        self._offsets[row] = len(self._arena)
+        self._lengths[row] = len(encoded)
+        self._arena += encoded
 
-        [link] = list(
-            filter(lambda x: x['message_id'] == m_id, self._user_messages))
+    def all(self):
+        '''
+        Returns all message dictionaries in a list
+        '''
+        return [self._record(row).to_dict() for row in self._live_rows()]
 
-        reacts = link['reacts']
+    @logged
+    def add(self, details):
+        '''
+        Appends a new row containing the following details:
+        message, time_created and optionally the sender's u_id and the channel_id
+        '''
+        message, time_created, u_id, channel_id = (tuple(details) + (-1, -1))[:4]
+        self._num_messages += 1
+        self._current_id += 1
+        row = len(self._ids)
+        self._ids.append(self._current_id)
+        self._times.append(time_created)
+        self._senders.append(u_id)
+        self._channels.append(channel_id)
+        self._offsets.append(0)
+        self._lengths.append(0)
+        self._store_body(row, message)
+        if row % 8 == 0:
+            self._pinned.append(0)
+            self._alive.append(0)
+            self._int_times.append(0)
+        self._set_bit(self._alive, row, True)
+        self._set_bit(self._int_times, row, isinstance(time_created, int))
+        self._ngram_index.add(self._current_id, message)
+        return self._current_id
 
-        try:
-            react = None
-            for tmp_react in reacts:
-                if tmp_react['react_id'] == react_id:
-                    react = tmp_react
-            if u_id in react['u_ids']:
-                raise InputError(description='user already reacted')
-            react['u_ids'].append(u_id)
-        except (ValueError, TypeError):
-            reacts.append({
-                'react_id': react_id,
-                'u_ids': [u_id],
-            })
+    @logged
+    def edit(self, message_id, message):
+        '''
+        Replaces the contents of message with message_id
+        with the message string
+        '''
+        row = self._row(message_id)
+        if row is None:
+            return
+        self._ngram_index.remove(message_id, self._body(row))
+        self._wasted_bytes += self._lengths[row]
+        self._store_body(row, message)
+        self._ngram_index.add(message_id, message)
+        self._maybe_compact()
+
+    @logged
+    def pin(self, message_id):
+        '''
+        Pins the message with message_id
+        '''
+        row = self._existing_row(message_id)
+        if self._get_bit(self._pinned, row):
+            raise InputError(description='Message already pinned')
+        self._set_bit(self._pinned, row, True)
+
+    @logged
+    def unpin(self, message_id):
+        '''
+        Unpins the message with message_id
+        '''
+        row = self._existing_row(message_id)
+        if not self._get_bit(self._pinned, row):
+            raise InputError(description='Message already unpinned')
+        self._set_bit(self._pinned, row, False)
+
+    def message_details(self, message_id):
+        '''
+        Returns details of message with message_id
+        in the form of a dictionary
+        '''
+        row = self._row(message_id)
+        if row is None:
+            return None
+        return self._record(row).to_dict()
+
+    def message_exists(self, message_id):
+        '''
+        Returns whether message with message_id exists
+        '''
+        return self._row(message_id) is not None
+
+    def fetch_messages(self, start):
+        '''
+        Returns a list of message details starting
+        with the specified start index
+        '''
+        if start < 0 or start > self._num_messages:
+            raise InputError(description='Invalid Start index')
+        return [self._record(row).to_dict()
+                for row in islice(self._live_rows(), start, start + MSG_BLOCK)]
+
+    @logged
+    def remove(self, message_id):
+        '''
+        Removes a message with message_id
+        '''
+        row = self._row(message_id)
+        if row is None:
+            raise InputError(description='Message does not exist')
+        self._ngram_index.remove(message_id, self._body(row))
+        self._set_bit(self._alive, row, False)
+        self._wasted_bytes += self._lengths[row]
+        self._num_messages -= 1
+        self._maybe_compact()
+
+    def find(self, message_id):
+        '''
+        Returns a record of the message with message_id, built from its row;
+        changing the record does not change the stored message
+        '''
+        return self._record(self._existing_row(message_id))
 
+    def search(self, query_string):
+        '''
+        Returns list of messages that contain the query_string
+        '''
+        candidates = self.candidates(query_string)
+        if candidates is None:
+            # queries shorter than a trigram look at every live row
+            rows = self._live_rows()
+        else:
+            rows = (row for row in map(self._row, sorted(candidates)) if row is not None)
+        return [self._record(row).to_dict() for row in rows
+                if query_string in self._body(row)]
+
+    def candidates(self, query_string):
+        '''
+        Returns the set of message_ids that may contain the query_string, from the
+        trigram index, or None if the query is too short and any message may
+        '''
+        return self._ngram_index.candidates(query_string)
+
+    def next_id(self):
+        '''
+        Returns the next message ID
+        '''
+        return int(self._current_id + 1)
+
+    def channel_counts(self):
+        '''
+        Returns a dictionary mapping each channel_id to its number of messages
+        '''
+        counts = dict()
+        for row, channel_id in enumerate(self._channels):
+            if self._get_bit(self._alive, row):
+                counts[channel_id] = counts.get(channel_id, 0) + 1
+        return counts
+
+    def time_range(self, time_from, time_to):
+        '''
+        Returns the message_ids of messages created between time_from and time_to inclusive
+        '''
+        return [self._ids[row] for row, time_created in enumerate(self._times)
+                if time_from <= time_created <= time_to and self._get_bit(self._alive, row)]
+
+    def _maybe_compact(self):
+        '''
+        Rewrites the columns without dead rows and stale bodies once
+        they make up more than COMPACT_RATIO of the storage
+        '''
+        num_rows = len(self._ids)
+        if num_rows - self._num_messages <= COMPACT_RATIO * num_rows and \
+                self._wasted_bytes <= COMPACT_RATIO * len(self._arena):
+            return
+
+        live = list(self._live_rows())
+        pinned = [self._get_bit(self._pinned, row) for row in live]
+        int_times = [self._get_bit(self._int_times, row) for row in live]
+        bodies = [bytes(self._arena[self._offsets[row]:self._offsets[row] + self._lengths[row]])
+                  for row in live]
+        self._ids = array('q', (self._ids[row] for row in live))
+        self._times = array('d', (self._times[row] for row in live))
+        self._senders = array('q', (self._senders[row] for row in live))
+        self._channels = array('q', (self._channels[row] for row in live))
+        self._lengths = array('I', map(len, bodies))
+        self._offsets = array('Q')
+        offset = 0
+        for length in self._lengths:
+            self._offsets.append(offset)
+            offset += length
+        self._arena = bytearray(b''.join(bodies))
+        self._wasted_bytes = 0
+        self._pinned = bytearray((len(live) + 7) // 8)
+        self._alive = bytearray((len(live) + 7) // 8)
+        self._int_times = bytearray((len(live) + 7) // 8)
+        for row, (is_pinned, is_int) in enumerate(zip(pinned, int_times)):
+            self._set_bit(self._alive, row, True)
+            self._set_bit(self._pinned, row, is_pinned)
+            self._set_bit(self._int_times, row, is_int)
+
+
+class UserMessage():
+    '''
+    A class containing the structure that maintains the relationship
+    between users, channels, reacts and messages they sent
+
+    Attributes:
+    -----------
+    user_messages : dict
+        Maps each message_id to a LinkRecord linking that message to its u_id, as well
+            as channel_id and the reacts of that message. Reacts map each react_id to
+            the u_ids that reacted with it, kept as a dict with None values so that
+            lookups are constant time while the order of reacting is preserved
+    channel_index : dict
+        Maps each channel_id to the message_ids sent into that channel, in the order sent
+    user_index : dict
+        Maps each u_id to the message_ids sent by that user, in the order sent
+    react_ids: list
+        Stores the currently valid react ID's (currently 1)
+    dirty: DirtySegments
+        The message id ranges whose links changed since the last snapshot
+
+    Methods:
+    --------
+    def add_link(self, u_id, channel_id, message_id)
+    def fetch_links_by_channel(self, container)
+        returns list of links filtered by specified channel_id(s)
+    def fetch_links_by_user(self, u_id)
+    def remove_link_by_user(self, u_id)
+    def remove_link_by_channel(self, channel_id)
+    def remove_link_by_message(self, message_id)
+    def link_exists(self, message_id)
+    def react(self, u_id, m_id, react_id)
+    def unreact(self, u_id, m_id, react_id)
+    def fetch_link(self, m_id)
+        returns the link containing a specified message_id
+    def is_valid_react(self, react_id)
+    def is_sender(self, m_id, u_id)
+    def message_channel(self, message_id)
+        returns the channel the message with message_id is in
+    def links(self)
+        returns every link, in the order sent
+    def take_dirty_segments(self)
+    def restore_dirty_segments(self, segments)
+    def segment_ids(self)
+    def segment(self, segment)
+    def snapshot_meta(self)
+    def load_segments(self, segments, meta)
+    '''
+
+    store_name = 'user_message'
+
+    def __init__(self):
+        self._user_messages = dict()
+        # secondary indexes; dicts with None values act as ordered sets
+        self._channel_index = dict()
+        self._user_index = dict()
+        self._react_ids = [1]
+        self._dirty = DirtySegments()
+
+    def __setstate__(self, fields):
+        '''
+        Restores a pickled store. One pickled with a list of dictionaries,
+        as an older database.p is, has them converted and its indexes built
+        '''
+        self.__dict__.update(fields)
+        if not isinstance(self._user_messages, list):
+            return
+        links = self._user_messages
+        self.__init__()
+        self._react_ids = fields['_react_ids']
+        for details in links:
+            message_id = details['message_id']
+            link = LinkRecord(message_id, details['u_id'], details['channel_id'])
+            # reacts are only kept once a message has one
+            if any(react['u_ids'] for react in details['reacts']):
+                link.reacts = {react['react_id']: dict.fromkeys(react['u_ids'])
+                               for react in details['reacts']}
+            self._user_messages[message_id] = link
+            self._channel_index.setdefault(link.channel_id, dict())[message_id] = None
+            self._user_index.setdefault(link.u_id, dict())[message_id] = None
+
+    @logged
+    def add_link(self, u_id, channel_id, message_id):
+        '''
+        Adds a link containing u_id, channel_id, message_id
+        '''
+        if self.link_exists(message_id):
+            raise InputError(description='Message already exists')
+        self._user_messages[message_id] = LinkRecord(message_id, u_id, channel_id)
+        self._channel_index.setdefault(channel_id, dict())[message_id] = None
+        self._user_index.setdefault(u_id, dict())[message_id] = None
+        self._dirty.touch(message_id)
+
+    def fetch_links_by_channel(self, container):
+        '''
+        Fetches all links by channel_id/multiple channel_ids
+        '''
+        channel_ids = container if isinstance(container, list) else [container]
+        return [self._user_messages[m_id]
+                for channel_id in channel_ids
+                for m_id in list(self._channel_index.get(channel_id, ()))]
+
+    def fetch_links_by_user(self, u_id):
+        '''
+        Fetches all message links that the user has sent
+        '''
+        return [self._user_messages[m_id]
+                for m_id in list(self._user_index.get(u_id, ()))]
+
+    @logged
+    def remove_link_by_user(self, u_id):
+        '''
+        Removes all links containing u_id
+        '''
+        for m_id in list(self._user_index.get(u_id, ())):
+            self.remove_link_by_message(m_id)
+
+    @logged
+    def remove_link_by_channel(self, channel_id):
+        '''
+        Removes all links containing channel_id
+        '''
+        for m_id in list(self._channel_index.get(channel_id, ())):
+            self.remove_link_by_message(m_id)
+
+    @logged
+    def remove_link_by_message(self, message_id):
+        '''
+        Removes the link containing message_id
+        '''
+        link = self._user_messages.pop(message_id, None)
+        if link is None:
+            return
+        self._discard(self._channel_index, link.channel_id, message_id)
+        self._discard(self._user_index, link.u_id, message_id)
+        self._dirty.touch(message_id)
+
+    @staticmethod
+    def _discard(index, key, message_id):
+        '''
+        Removes message_id from the bucket of a secondary index,
+        dropping the bucket once it is empty
+        '''
+        bucket = index.get(key)
+        if bucket is None:
+            return
+        bucket.pop(message_id, None)
+        if not bucket:
+            del index[key]
+
+    def link_exists(self, message_id):
+        '''
+        Checks whether a link with message_id exists in user_messages
+        '''
+        return message_id in self._user_messages
+
+    @logged
+    def react(self, u_id, m_id, react_id):
+        '''
+        Adds react details to the link with u_id, m_id
+        '''
+        if not self.link_exists(m_id):
+            raise InputError(description='Message does not exist')
+
+        if not self.is_valid_react(react_id):
+            raise InputError(description='Invalid react')
+
+        link = self._user_messages[m_id]
+        if link.reacts is None:
+            link.reacts = {DEFAULT_REACT_ID: dict()}
+        u_ids = link.reacts.setdefault(react_id, dict())
+        if u_id in u_ids:
+            raise InputError(description='user already reacted')
+        u_ids[u_id] = None
+        self._dirty.touch(m_id)
+
+    @logged
     def unreact(self, u_id, m_id, react_id):
         '''
         Removes the react_id from active reacts in the specified link
@@ -827,28 +1987,17 @@ class UserMessage():
         if not self.is_valid_react(react_id):
             raise InputError(description='Invalid react')
 
-        [link] = list(
-            filter(lambda x: x['message_id'] == m_id, self._user_messages))
-
-        reacts = link['reacts']
-        try:
-            [react] = list(filter(lambda x: x['react_id'] == react_id, reacts))
-            react['u_ids'].remove(u_id)
-        except ValueError:
+        u_ids = (self._user_messages[m_id].reacts or {}).get(react_id, {})
+        if u_id not in u_ids:
             raise InputError(description='user does not have an active react')
+        del u_ids[u_id]
+        self._dirty.touch(m_id)
 
     def fetch_link(self, m_id):
         '''
-        Returns the link tuple containing message ID of m_id
+        Returns the link record containing message ID of m_id
         '''
-        try:
-            [info] = list(
-                filter(
-                    lambda x: x['message_id'] == m_id,
-                    self._user_messages))
-            return info
-        except ValueError:
-            return None
+        return self._user_messages.get(m_id)
 
     def is_valid_react(self, react_id):
         '''
@@ -860,15 +2009,193 @@ class UserMessage():
         '''
         Checks whether the user with ID u_id sent the message with m_id
         '''
-        return u_id in [link['u_id']
-                        for link in self._user_messages if link['message_id'] == m_id]
+        link = self._user_messages.get(m_id)
+        return link is not None and link.u_id == u_id
 
     def message_channel(self, message_id):
         '''
         Returns the channel ID of the message
         '''
         link = self.fetch_link(message_id)
-        return link['channel_id']
+        return link.channel_id
+
+    def links(self):
+        '''
+        Returns every link record, in the order the messages were sent
+        '''
+        return list(self._user_messages.values())
+
+    def take_dirty_segments(self):
+        '''
+        Returns the segments changed since the last call, for an incremental snapshot
+        '''
+        return self._dirty.take()
+
+    def restore_dirty_segments(self, segments):
+        '''
+        Marks segments as changed again after a snapshot of them failed
+        '''
+        self._dirty.restore(segments)
+
+    def segment_ids(self):
+        '''
+        Returns every segment holding a link, for a full snapshot
+        '''
+        return {message_id // SEGMENT_SIZE for message_id in self._user_messages}
+
+    def segment(self, segment):
+        '''
+        Returns the links of the messages in segment, keyed by message_id
+        '''
+        return id_segment(self._user_messages, segment)
+
+    def snapshot_meta(self):
+        '''
+        Returns what load_segments needs besides the segments themselves
+        '''
+        return {'react_ids': self._react_ids}
+
+    def load_segments(self, segments, meta):
+        '''
+        Fills an empty store from the segments of a snapshot, in segment order,
+        rebuilding the channel and user indexes, which are not written
+        Params: segments (iterable of dict), meta (dict): from snapshot_meta
+        '''
+        for links in segments:
+            for message_id, link in links.items():
+                self._user_messages[message_id] = link
+                self._channel_index.setdefault(link.channel_id, dict())[message_id] = None
+                self._user_index.setdefault(link.u_id, dict())[message_id] = None
+        self._react_ids = meta.get('react_ids', self._react_ids)
+
+
+class Timelines():
+    '''
+    A class that keeps the messages of every channel ordered by the time they were created,
+    so that a page of a channel's history can be sliced out without sorting the channel
+
+    Attributes:
+    -----------
+    timelines : dict
+        Maps each channel_id to a list of (time_created, -message_id) tuples kept in
+        ascending order; the newest message of the channel is the last entry. Negating
+        the id lists messages sent at the same time in the order they were sent
+
+    Methods:
+    --------
+    add(channel_id, message_id, time_created)
+        inserts a message into the timeline of channel with 'channel_id'
+    remove(channel_id, message_id, time_created)
+        removes a message from the timeline of channel with 'channel_id'
+    size(channel_id)
+        returns the number of messages in the channel with 'channel_id'
+    page(channel_id, start, count)
+        returns up to 'count' message_ids, newest first, skipping the 'start' newest
+    seek(channel_id, cursor, count, before)
+        returns up to 'count' message_ids, newest first, on one side of 'cursor'
+    iter_newest(channel_ids, before)
+        lazily yields the message_ids of several channels, newest first
+    '''
+
+    store_name = 'timelines'
+
+    def __init__(self):
+        self._timelines = dict()
+
+    @logged
+    def add(self, channel_id, message_id, time_created):
+        '''
+        Inserts a message into the timeline of a channel.
+        Messages usually arrive in time order, which makes this an append
+
+        Params: channel_id (int), message_id (int), time_created (float)
+        '''
+        timeline = self._timelines.setdefault(channel_id, list())
+        entry = timeline_key(time_created, message_id)
+        if not timeline or timeline[-1] < entry:
+            timeline.append(entry)
+        else:
+            insort(timeline, entry)
+
+    @logged
+    def remove(self, channel_id, message_id, time_created):
+        '''
+        Removes a message from the timeline of a channel, does nothing if it is not there
+
+        Params: channel_id (int), message_id (int), time_created (float)
+        '''
+        timeline = self._timelines.get(channel_id)
+        if timeline is None:
+            return
+        entry = timeline_key(time_created, message_id)
+        index = bisect_left(timeline, entry)
+        if index < len(timeline) and timeline[index] == entry:
+            del timeline[index]
+        if not timeline:
+            del self._timelines[channel_id]
+
+    def size(self, channel_id):
+        '''
+        Params: channel_id (int)
+        Returns: number of messages in the channel (int)
+        '''
+        return len(self._timelines.get(channel_id, ()))
+
+    def page(self, channel_id, start, count):
+        '''
+        Params: channel_id (int), start (int): number of newest messages to skip,
+            count (int): maximum number of messages to return
+        Returns: message_ids ordered from the newest to the oldest (List)
+        '''
+        timeline = self._timelines.get(channel_id, [])
+        end = max(len(timeline) - start, 0)
+        begin = max(end - count, 0)
+        return [-key for _, key in reversed(timeline[begin:end])]
+
+    def seek(self, channel_id, cursor, count, before):
+        '''
+        Binary searches the timeline for a cursor, which stays valid even if
+        the message it was taken from has since been removed
+
+        Params:
+            channel_id (int)
+            cursor (tuple): (time_created, message_id) of the anchoring message
+            count (int): maximum number of messages to return
+            before (bool): True for messages older than the cursor,
+                False for the messages immediately newer than it
+        Returns:
+            message_ids ordered from the newest to the oldest (List),
+            whether there are older messages than the ones returned (bool)
+        '''
+        timeline = self._timelines.get(channel_id, [])
+        key = timeline_key(*cursor)
+        if before:
+            end = bisect_left(timeline, key)
+            begin = max(end - count, 0)
+        else:
+            begin = bisect_right(timeline, key)
+            end = min(begin + count, len(timeline))
+        page = [-key for _, key in reversed(timeline[begin:end])]
+        return page, begin > 0
+
+    def iter_newest(self, channel_ids, before=None):
+        '''
+        Lazily yields the message_ids of the channels merged into one timeline
+
+        Params:
+            channel_ids (iterable): of the channels to merge
+            before (tuple): (time_created, message_id) of a message, if given
+                only the messages older than it are yielded
+        Returns: message_ids ordered from the newest to the oldest (generator)
+        '''
+        newest_first = []
+        for channel_id in channel_ids:
+            timeline = self._timelines.get(channel_id, [])
+            end = len(timeline) if before is None \
+                else bisect_left(timeline, timeline_key(*before))
+            # a copy, as messages may be sent or removed while the merge is read
+            newest_first.append(reversed(timeline[:end]))
+        return (-key for _, key in heapq.merge(*newest_first, reverse=True))
 
 
 class UserChannel():
@@ -877,9 +2204,14 @@ class UserChannel():
 
     Attributes:
     -----------
-    user_channels : list
-        Contains tuples linking u_id's to channel_id's, as well as
-        whether the user with u_id is an owner of that channel
+    channel_roles : dict
+        Maps each channel_id to a dictionary of its members' u_id's, each mapped to
+        whether that user is an owner of the channel
+    user_channels : dict
+        Maps each u_id to the channel_id's the user has joined, in the order joined
+    versions : dict
+        Maps each u_id to a counter that changes whenever the user joins or leaves
+        a channel, so cached listings of their channels can tell they are stale
 
     Methods:
     --------
@@ -911,11 +2243,40 @@ class UserChannel():
         returns a list of all owner members in channel with 'channel_id'
     user_channels(self, given_u_id)
         returns a list of channels which user with 'given_u_id' is part of
+    version(self, u_id)
+        returns the membership version of user with 'u_id'
     '''
 
+    store_name = 'user_channel'
+
     def __init__(self):
-        self._user_channels = list()
+        self._channel_roles = dict()
+        # dicts with None values act as ordered sets of channel_ids
+        self._user_channels = dict()
+        self._versions = dict()
+
+    def __setstate__(self, fields):
+        '''
+        Restores a pickled store. One pickled with a list of (u_id, channel_id, is_owner)
+        links, as an older database.p is, has them converted
+        '''
+        self.__dict__.update(fields)
+        if not isinstance(self._user_channels, list):
+            return
+        links = self._user_channels
+        self.__init__()
+        for u_id, channel_id, is_owner in links:
+            self._channel_roles.setdefault(channel_id, dict())[u_id] = is_owner
+            self._user_channels.setdefault(u_id, dict())[channel_id] = None
 
+    def _touch(self, u_id):
+        '''
+        Moves the membership version of user with 'u_id' on. Versions never
+        go back, even once the user has left every channel
+        '''
+        self._versions[u_id] = self._versions.get(u_id, 0) + 1
+
+    @logged
     def add_link(self, u_id, channel_id, is_owner):
         '''
         Forms a link between a user and a channel, making a note of
@@ -927,44 +2288,59 @@ class UserChannel():
         if self.link_exists(u_id, channel_id):
             raise InputError(description='user already in channel')
 
-        self._user_channels.append((u_id, channel_id, is_owner))
+        self._channel_roles.setdefault(channel_id, dict())[u_id] = is_owner
+        self._user_channels.setdefault(u_id, dict())[channel_id] = None
+        self._touch(u_id)
 
+    @logged
     def remove_link_by_user(self, u_id):
         '''
         Removes a link made between a user with 'u_id' and all chanenels this user is part of
 
         Params: u_id (int)
         '''
-        self._user_channels = list(
-            filter(
-                lambda x: x[0] != u_id,
-                self._user_channels))
+        for channel_id in self._user_channels.pop(u_id, ()):
+            roles = self._channel_roles[channel_id]
+            del roles[u_id]
+            if not roles:
+                del self._channel_roles[channel_id]
+        self._touch(u_id)
 
+    @logged
     def remove_link_by_channel(self, channel_id):
         '''
         Removes a link made between a channel with 'channel_id' and all users part of this channel
 
         Params: channel_id (int)
         '''
-        self._user_channels = list(
-            filter(
-                lambda x: x[1] != channel_id,
-                self._user_channels))
+        for u_id in self._channel_roles.pop(channel_id, ()):
+            channels = self._user_channels[u_id]
+            del channels[channel_id]
+            if not channels:
+                del self._user_channels[u_id]
+            self._touch(u_id)
 
+    @logged
     def remove_user(self, u_id, channel_id):
         '''
         Removes user with 'u_id' from channel with 'channel_id'
 
         Params: u_id (int), channel_id (int)
-        Raises: ValueError if either 'u_id' or 'channel_id' invalid or user not part of channel
-        '''
-        try:
-            [to_remove] = list(
-                filter(lambda x: x[0] == u_id and x[1] == channel_id, self._user_channels))
-            self._user_channels.remove(to_remove)
-        except ValueError:
-            pass
-
+        Does nothing if either 'u_id' or 'channel_id' invalid or user not part of channel
+        '''
+        if not self.link_exists(u_id, channel_id):
+            return
+        roles = self._channel_roles[channel_id]
+        del roles[u_id]
+        if not roles:
+            del self._channel_roles[channel_id]
+        channels = self._user_channels[u_id]
+        del channels[channel_id]
+        if not channels:
+            del self._user_channels[u_id]
+        self._touch(u_id)
+
+    @logged
     def add_owner(self, u_id, channel_id):
         '''
         Adds user with 'u_id' to the list of owners for channel with 'channel_id'
@@ -974,10 +2350,12 @@ class UserChannel():
         '''
         if self.is_owner(u_id, channel_id):
             raise InputError(description='user is already an owner')
-        # tuples cannot allow modification; therefore delete then add
-        self.remove_user(u_id, channel_id)
-        self.add_link(u_id, channel_id, is_owner=True)
+        if self.link_exists(u_id, channel_id):
+            self._channel_roles[channel_id][u_id] = True
+        else:
+            self.add_link(u_id, channel_id, is_owner=True)
 
+    @logged
     def remove_owner(self, u_id, channel_id):
         '''
         Removes user with 'u_id' from the list of owners for channel with 'channel_id'
@@ -988,10 +2366,9 @@ class UserChannel():
         if not self.is_owner(u_id, channel_id):
             raise InputError(description='user is not an owner')
 
-        # tuples are immutable; so we delete him then add him as a member
-        self.remove_user(u_id, channel_id)
-        self.add_link(u_id, channel_id, is_owner=False)
+        self._channel_roles[channel_id][u_id] = False
 
+    @logged
     def join_channel(self, u_id, channel_id):
         '''
         Adds user with 'u_id' to channel with 'channel_id' as a normal member
@@ -1000,6 +2377,7 @@ class UserChannel():
         '''
         self.add_link(u_id, channel_id, is_owner=False)
 
+    @logged
     def leave_channel(self, u_id, channel_id):
         '''
         Removes user with 'u_id' from channel with 'channel_id' entirely
@@ -1013,46 +2391,50 @@ class UserChannel():
         Params: u_id (int), channel_id (int)
         Returns: if user is part of channel (bool)
         '''
-        return u_id in \
-            [u_id for u_id, ch_id, _ in self._user_channels if ch_id == channel_id]
+        return u_id in self._channel_roles.get(channel_id, ())
 
     def is_member(self, u_id, channel_id):
         '''
         Params: u_id (int), channel_id (int)
         Returns: if user is normal member of channel (bool)
         '''
-        return u_id in self.members(channel_id)
+        return self.link_exists(u_id, channel_id)
 
     def is_owner(self, u_id, channel_id):
         '''
         Params: u_id (int), channel_id (int)
         Returns: if user is owner member of channel (bool)
         '''
-        return u_id in self.owners(channel_id)
+        return bool(self._channel_roles.get(channel_id, {}).get(u_id, False))
 
     def members(self, channel_id):
         '''
         Params: channel_id (int)
         Returns: all users who are normal members of channel with 'channel_id' (List)
         '''
-        return [u_id for u_id, ch_id,
-                _ in self._user_channels if channel_id == ch_id]
+        return list(self._channel_roles.get(channel_id, ()))
 
     def owners(self, channel_id):
         '''
         Params: channel_id (int)
         Returns: all users who are owner members of channel with 'channel_id' (List)
         '''
-        return [u_id for u_id, ch_id, is_owner in self._user_channels if
-                ch_id == channel_id and is_owner]
+        roles = dict(self._channel_roles.get(channel_id, {}))
+        return [u_id for u_id, is_owner in roles.items() if is_owner]
 
     def user_channels(self, given_u_id):
         '''
         Params: given_u_id (int)
         Returns: all channels which user with 'given_u_id' is part of (List)
         '''
-        return list(
-            [ch_id for u_id, ch_id, _ in self._user_channels if u_id == given_u_id])
+        return list(self._user_channels.get(given_u_id, ()))
+
+    def version(self, u_id):
+        '''
+        Params: u_id (int)
+        Returns: the membership version of the user (int)
+        '''
+        return self._versions.get(u_id, 0)
 
 
 class Database():
@@ -1069,11 +2451,21 @@ class Database():
     messages: class
     user_message: class
     user_channel: class
+    timelines: class
+    wal_lsn: int
+        The last write-ahead log record reflected in the database, so a snapshot
+        knows which records to replay on top of it
+    persistent: bool
+        Whether the database writes itself to disk, so it is never snapshotted
 
     Methods:
     --------
     reset()
         Reinitialises the database
+    rebuild_timelines()
+        Rebuilds the channel timelines from the messages and their links
+    release()
+        Frees what the current thread holds of the database once a request is done
     add_user(details)
         Adds a user with 'details' to the database
     user_channels(u_id)
@@ -1087,13 +2479,18 @@ class Database():
         Returns information on all owner members in a channel
     channel_messages(u_id, details)
         Returns up to 50 messages from a channel
+    channel_messages_from(u_id, details)
+        Returns up to 50 messages from a channel next to a cursor
     add_message(u_id, channel_id, details)
         Adds a message sent by user with 'u_id' to channel with 'channel_id'
     remove_message(message_id)
         Removes a message with 'message_id'
-    message_search(u_id, query_str)
+    message_search(u_id, query_str, limit, before)
         Searches channels which user with 'u_id' is part of
         for messages which contain the query_str
+    iter_search(channel_ids, query_str, before)
+        Lazily yields the message_ids in channels with 'channel_ids' which contain
+        the query_str, newest first
     remove_messages(u_id)
         Removes all messages associated with a user
     pin(u_id, message_id)
@@ -1103,19 +2500,58 @@ class Database():
 
     '''
 
+    store_name = ''
+    persistent = False
+
     def __init__(self):
         self.users = Users()
         self.admins = Admins()
         self.channels = Channels()
         self.codes = Codes()
-        self.messages = Messages()
+        self.messages = ColumnarMessages() if STORAGE_BACKEND == 'columnar' else Messages()
         self.user_message = UserMessage()
         self.user_channel = UserChannel()
+        self.timelines = Timelines()
+        # the sequence number of the last write-ahead log record applied
+        self.wal_lsn = 0
+
+    def __setstate__(self, fields):
+        '''
+        Restores a pickled database. One pickled before the channel timelines and the
+        write-ahead log, as an older database.p is, gets them, built from its messages
+        '''
+        self.__dict__.update(fields)
+        if 'wal_lsn' not in fields:
+            self.wal_lsn = 0
+        if 'timelines' not in fields:
+            self.rebuild_timelines()
 
+    @logged
     def reset(self):
         '''Reinitialises the database'''
+        # the files of the last incremental snapshot hold the old stores
+        global FULL_SNAPSHOT_DUE  # pylint: disable=global-statement
+        FULL_SNAPSHOT_DUE = True
         self.__init__()
 
+    def rebuild_timelines(self):
+        '''
+        Rebuilds the channel timelines from the messages and their links,
+        which is how a database assembled from an incremental snapshot gets them
+        '''
+        self.timelines = Timelines()
+        for link in self.user_message.links():
+            if self.messages.message_exists(link.message_id):
+                self.timelines.add(link.channel_id, link.message_id,
+                                   self.messages.find(link.message_id).time_created)
+
+    def release(self):
+        '''
+        Frees what the current thread holds of the database once a request is done,
+        which is nothing for a database in memory
+        '''
+
+    @logged
     def add_user(self, details):
         '''
         Adds a user with 'details' to the database
@@ -1144,6 +2580,7 @@ class Database():
         details = list(map(self.channels.channel_details, channels))
         return list(details)
 
+    @logged
     def add_channel(self, u_id, details):
         '''
         Adds a channel to the database,
@@ -1212,40 +2649,65 @@ class Database():
                 is_pinned (bool)
         '''
         channel_id, start = details
-        # getting the links between messages, users and channels
-        link_info = self.user_message.fetch_links_by_channel(channel_id)
+        num_messages = self.timelines.size(channel_id)
         # not enough messages to retrieve
-        if start > len(link_info):
+        if start > num_messages:
             raise InputError('Invalid start index')
 
         # no relevant messages
-        if not link_info:
+        if not num_messages:
             return [], False  # False means no more messages to return
 
-        # getting message details given the message id
-        msgs_info = list(
-            map(lambda x: self.messages.message_details(x['message_id']), link_info))
-
-        # updating the is_this_user_reacted field for the reacts
-        is_this_user_reacted(u_id, link_info)
-        # constructing the full details
-        full_info = list(map(lambda x, y: {
-            'message_id': y['message_id'],
-            'u_id': x['u_id'],
-            'message': y['message'],
-            'time_created': y['time_created'],
-            'reacts': x['reacts'],
-            'is_pinned': y['is_pinned']
-        }, link_info, msgs_info))
+        # the timeline is already sorted by timestamp, so only the page is fetched
+        message_ids = self.timelines.page(channel_id, start, MSG_BLOCK)
 
-        # sorting based on timestamp
-        full_info.sort(key=lambda x: x['time_created'], reverse=True)
-        # chopping messages
-        if start + MSG_BLOCK < len(full_info):
-            # means more to give
-            return list(full_info[start: start + MSG_BLOCK]), True
-        return list(full_info[start:]), False  # means no more to give
+        # True means more to give
+        return self._message_page(u_id, message_ids), start + MSG_BLOCK < num_messages
 
+    def channel_messages_from(self, u_id, details):
+        '''
+        Returns up to 50 messages from a channel next to a cursor. Unlike
+        an index, a cursor does not shift when new messages are sent
+
+        Args:
+            u_id (int): of the user invoking this action
+            details (tuple):
+                channel_id (int)
+                cursor (tuple): (time_created, message_id) of the anchoring message
+                before (bool): True for messages older than the cursor,
+                    False for messages newer than it
+        Return:
+            List of up to 50 dictionaries, newest first, each containing:
+                message_id (int)
+                u_id (int): of the user who sent the message
+                message (str)
+                time_created (time)
+                reacts (List)
+                is_pinned (bool)
+            whether there are older messages than the ones returned (bool)
+        '''
+        channel_id, cursor, before = details
+        message_ids, more = self.timelines.seek(channel_id, cursor, MSG_BLOCK, before)
+        return self._message_page(u_id, message_ids), more
+
+    def _message_page(self, u_id, message_ids):
+        '''
+        Joins the details of each message in message_ids with its link
+        '''
+        link_info = list(map(self.user_message.fetch_link, message_ids))
+        msgs_info = list(map(self.messages.find, message_ids))
+
+        # constructing the full details, with the reacts as seen by the user
+        return list(map(lambda x, y: {
+            'message_id': y.message_id,
+            'u_id': x.u_id,
+            'message': y.message,
+            'time_created': y.time_created,
+            'reacts': react_projection(u_id, x.reacts),
+            'is_pinned': y.is_pinned
+        }, link_info, msgs_info))
+
+    @logged
     def add_message(self, u_id, channel_id, details):
         '''
         Adds a message sent by user with 'u_id' to channel with 'channel_id'
@@ -1259,20 +2721,50 @@ class Database():
         Return:
             message_id (int): unique identifier of the message within the channel
         '''
-        message_id = self.messages.add(details)
+        message_id = self.messages.add(tuple(details) + (u_id, channel_id))
         self.user_message.add_link(u_id, channel_id, message_id)
+        self.timelines.add(channel_id, message_id, details[1])
         return message_id
 
+    @logged
     def remove_message(self, message_id):
         '''
         Removes a message
 
         Args: message_id (int)
         '''
+        if not self.messages.message_exists(message_id):
+            raise InputError(description='Message does not exist')
+        time_created = self.messages.find(message_id).time_created
+        channel_id = self.user_message.message_channel(message_id)
         self.messages.remove(message_id)
+        self.timelines.remove(channel_id, message_id, time_created)
         self.user_message.remove_link_by_message(message_id)
 
-    def message_search(self, u_id, query_str):
+    def channel_search(self, u_id, query_str, limit):
+        '''
+        Searches the channels user with 'u_id' can see, which are the public
+        channels and the private channels they are part of, for names containing query_str
+
+        Args:
+            u_id (int): of the user invoking the function
+            query_str (str): which the user requests be contained in the channel name
+            limit (int): the maximum number of results
+        Return:
+            a list of dictionaries each containing
+                channel_id (int)
+                name (str): of channel
+        '''
+        def visible(channel_id):
+            '''
+            Whether user with 'u_id' may find the channel
+            '''
+            return (not self.channels.is_private(channel_id)
+                    or self.user_channel.link_exists(u_id, channel_id))
+
+        return self.channels.search(query_str, limit, visible)
+
+    def message_search(self, u_id, query_str, limit=None, before=None):
         '''
         Searches channels which user with 'u_id' is part of
         for messages which contain the query_str
@@ -1280,9 +2772,12 @@ class Database():
         Args:
             u_id (int): of the user invoking the function
             query_str (str): which the user requests be contained in the search results
+            limit (int): the maximum number of results, None for all of them
+            before (tuple): (time_created, message_id) of a message,
+                only older messages are returned
         Return:
             a list of dictionaries each containing information about a message
-            that contains the query_str, sorted in numerical order by message_id:
+            that contains the query_str, newest first as in a channel's messages:
             message_id (int)
                 u_id (int): of the user who sent the message
                 message (str)
@@ -1291,35 +2786,44 @@ class Database():
                 is_pinned (bool)
         '''
         # fetching relevant channels
-        channel_ids = self.user_channel.user_channels(u_id)
+        channel_ids = set(self.user_channel.user_channels(u_id))
         if not channel_ids:
             return []
 
-        # fetching relevant message links to those channels
-        filtered_links = self.user_message.fetch_links_by_channel(channel_ids)
-        # getting the relevant message ids
-        filtered_mids = list(map(lambda x: x['message_id'], filtered_links))
-        # getting all messages with a query string
-        msgs = self.messages.search(query_str)
-        # filtering those messages based on the message ids
-        relevant_msgs = list(
-            filter(
-                lambda x: x['message_id'] in filtered_mids,
-                msgs))
-        # updating the is_this_user_reacted key for all the reacts
-        is_this_user_reacted(u_id, filtered_links)
-        # constructing the full details
-        relevant_msgs = list(map(lambda x, y: {
-            'message_id': y['message_id'],
-            'u_id': x['u_id'],
-            'message': y['message'],
-            'time_created': y['time_created'],
-            'reacts': x['reacts'],
-            'is_pinned': y['is_pinned']
-        }, filtered_links, relevant_msgs))
-        return sorted(
-            relevant_msgs, key=lambda x: x['time_created'], reverse=True)
+        # stopping as soon as enough results were found,
+        # then constructing the full details
+        relevant_mids = self.iter_search(channel_ids, query_str, before)
+        return self._message_page(u_id, list(islice(relevant_mids, limit)))
+
+    def iter_search(self, channel_ids, query_str, before=None):
+        '''
+        Lazily yields the messages in the channels which contain the query_str by
+        walking the channels' timelines merged newest first, so that only as many
+        messages are looked at as it takes to find the results a caller reads.
+        The trigram index, when the query is long enough to use it, skips the
+        messages that cannot match without reading them
 
+        Args:
+            channel_ids (iterable): of the channels to search
+            query_str (str): which the messages must contain
+            before (tuple): (time_created, message_id) of a message,
+                only older messages are yielded
+        Return: message_ids ordered from the newest to the oldest (generator)
+        '''
+        candidates = self.messages.candidates(query_str)
+        for m_id in self.timelines.iter_newest(channel_ids, before):
+            if candidates is not None and m_id not in candidates:
+                continue
+            try:
+                message = self.messages.find(m_id).message
+            except KeyError:
+                # removed since the timelines were read
+                continue
+            # every trigram matching does not guarantee a substring match
+            if query_str in message:
+                yield m_id
+
+    @logged
     def remove_messages(self, u_id):
         '''
         Removes all messages associated with a user
@@ -1327,10 +2831,11 @@ class Database():
         '''
         relevant_msg_links = self.user_message.fetch_links_by_user(u_id)
         for link in relevant_msg_links:
-            self.remove_message(link['message_id'])
+            self.remove_message(link.message_id)
 
         self.user_message.remove_link_by_user(u_id)
 
+    @logged
     def pin(self, u_id, message_id):
         '''
         Marks a message for special treatment in the frontend
@@ -1354,6 +2859,7 @@ class Database():
 
         self.messages.pin(message_id)
 
+    @logged
     def unpin(self, u_id, message_id):
         '''
         Unmarks a message for special treatment in the frontend
@@ -1378,11 +2884,655 @@ class Database():
         self.messages.unpin(message_id)
 
 
+class Sessions():
+    '''
+    A class that keeps the session tokens of logged in users, indexed both ways
+    so that finding the user of a token and the tokens of a user are constant time.
+    A user may hold several sessions at once. A session expires after SESSION_IDLE_TTL
+    seconds without use or SESSION_ABSOLUTE_TTL seconds after it started; expired
+    sessions are evicted when they are looked up and by sweep(), which pops deadlines
+    off a heap instead of scanning every session
+
+    Attributes:
+    -----------
+    tokens : dict
+        Maps each session token to its SessionRecord
+    user_tokens : dict
+        Maps each logged in u_id to its tokens, kept as a dict with None values
+        so that the oldest session comes first
+    expiry : list
+        A heap of (deadline, token) pairs. An entry is only current while it
+        matches the queued deadline of the token's record, others are skipped
+    lock : threading.Lock
+        Guards the indexes against the background sweep
+
+    Methods:
+    --------
+    add(token, u_id, expires=True)
+        starts a session with 'token' for user with 'u_id'
+    remove(token)
+        ends the session with 'token'
+    remove_user(u_id)
+        ends every session of user with 'u_id'
+    token(u_id)
+        returns a token of user with 'u_id', or None if they are logged out
+    tokens(u_id)
+        returns all the tokens of user with 'u_id'
+    sweep(now=None)
+        ends every session that has expired by 'now'
+    clear()
+        ends every session
+    save(path)
+        writes the live sessions to 'path'
+    load(path)
+        returns the sessions saved in 'path' that have not expired yet
+    '''
+
+    def __init__(self):
+        self._tokens = dict()
+        self._user_tokens = dict()
+        self._expiry = []
+        self._lock = threading.Lock()
+
+    def __contains__(self, token):
+        '''
+        Checks that token belongs to a live session, refreshing its idle deadline
+        '''
+        with self._lock:
+            now = time()
+            if not self._live(token, now):
+                return False
+            self._tokens[token].last_seen = now
+            return True
+
+    def __getitem__(self, token):
+        return self._tokens[token].u_id
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def add(self, token, u_id, expires=True):
+        '''
+        Starts a session with token for user with u_id
+        Params: token (str), u_id (int),
+            expires (bool): False for sessions that never time out, e.g. bots
+        '''
+        now = time()
+        with self._lock:
+            self._remove(token)
+            self._insert(token, SessionRecord(u_id, now, now, expires))
+
+    def remove(self, token):
+        '''
+        Ends the session with token
+        Params: token (str)
+        Returns: the u_id the token belonged to, None if it was not in use
+        '''
+        with self._lock:
+            return self._remove(token)
+
+    def remove_user(self, u_id):
+        '''
+        Ends every session of user with u_id
+        Params: u_id (int)
+        '''
+        with self._lock:
+            for token in self._user_tokens.pop(u_id, ()):
+                del self._tokens[token]
+
+    def token(self, u_id):
+        '''
+        Params: u_id (int)
+        Returns: the oldest live token of the user, None if they are logged out
+        '''
+        with self._lock:
+            now = time()
+            for token in list(self._user_tokens.get(u_id, ())):
+                if self._live(token, now):
+                    return token
+            return None
+
+    def tokens(self, u_id):
+        '''
+        Params: u_id (int)
+        Returns: all the live tokens of the user (List)
+        '''
+        with self._lock:
+            now = time()
+            return [token for token in list(self._user_tokens.get(u_id, ()))
+                    if self._live(token, now)]
+
+    def sweep(self, now=None):
+        '''
+        Ends every session that has expired by now. Entries whose session was used
+        since they were queued are pushed back with the new deadline
+        Params: now (float): unix timestamp, defaults to the current time
+        Returns: the number of sessions ended (int)
+        '''
+        if now is None:
+            now = time()
+        ended = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                deadline, token = heapq.heappop(self._expiry)
+                record = self._tokens.get(token)
+                if record is None or record.queued != deadline:
+                    continue
+                record.queued = record.deadline()
+                if record.queued <= now:
+                    self._remove(token)
+                    ended += 1
+                else:
+                    heapq.heappush(self._expiry, (record.queued, token))
+        return ended
+
+    def clear(self):
+        '''
+        Ends every session
+        '''
+        with self._lock:
+            self._tokens.clear()
+            self._user_tokens.clear()
+            self._expiry.clear()
+
+    def save(self, path):
+        '''
+        Writes the live sessions to path in a compact binary format. The file is
+        written next to path and renamed over it so a crash never leaves it half written
+        Params: path (str)
+        '''
+        with self._lock:
+            records = list(self._tokens.items())
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as sessions_file:
+            sessions_file.write(SESSIONS_MAGIC)
+            for token, record in records:
+                encoded = token.encode('utf-8')
+                sessions_file.write(SESSION_FORMAT.pack(
+                    record.u_id, record.created, record.last_seen,
+                    record.expires, len(encoded)))
+                sessions_file.write(encoded)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Reads the sessions written by save, dropping the ones that have expired
+        since. A missing or unrecognised file gives an empty store
+        Params: path (str)
+        Returns: Sessions
+        '''
+        sessions = cls()
+        try:
+            with open(path, 'rb') as sessions_file:
+                data = sessions_file.read()
+        except FileNotFoundError:
+            return sessions
+        if not data.startswith(SESSIONS_MAGIC):
+            return sessions
+        now = time()
+        offset = len(SESSIONS_MAGIC)
+        while offset + SESSION_FORMAT.size <= len(data):
+            u_id, created, last_seen, expires, length = SESSION_FORMAT.unpack_from(
+                data, offset)
+            offset += SESSION_FORMAT.size
+            token = data[offset:offset + length].decode('utf-8')
+            offset += length
+            record = SessionRecord(u_id, created, last_seen, bool(expires))
+            if record.deadline() > now:
+                sessions._insert(token, record)
+        return sessions
+
+    def _insert(self, token, record):
+        '''
+        Indexes a new session and queues its deadline. Callers hold the lock
+        '''
+        self._tokens[token] = record
+        self._user_tokens.setdefault(record.u_id, dict())[token] = None
+        if record.expires:
+            record.queued = record.deadline()
+            heapq.heappush(self._expiry, (record.queued, token))
+
+    def _remove(self, token):
+        '''
+        Unindexes a session, leaving its heap entry to be skipped by sweep.
+        Callers hold the lock
+        '''
+        record = self._tokens.pop(token, None)
+        if record is None:
+            return None
+        user_tokens = self._user_tokens[record.u_id]
+        del user_tokens[token]
+        if not user_tokens:
+            del self._user_tokens[record.u_id]
+        return record.u_id
+
+    def _live(self, token, now):
+        '''
+        Checks that token is a session that has not expired by now,
+        evicting it if it has. Callers hold the lock
+        '''
+        record = self._tokens.get(token)
+        if record is None:
+            return False
+        if record.deadline() <= now:
+            self._remove(token)
+            return False
+        return True
+
+
+class WriteAheadLog():
+    '''
+    A class that appends every mutating Database operation to a log file before
+    the operation is acknowledged, so that operations since the last snapshot can
+    be replayed after a crash. Each record is a header of its log sequence number,
+    payload length and crc32, then the pickled (store_name, method, args, kwargs)
+
+    Attributes:
+    -----------
+    path : str
+        The log file
+    fsync : str
+        'always' to fsync after every record, 'group' to let concurrent writers
+        share one fsync, 'periodic' to fsync every WAL_FSYNC_SECONDS
+    lsn : int
+        The sequence number of the last record appended
+    synced_lsn : int
+        The sequence number of the last record known to be on disk
+
+    Methods:
+    --------
+    append(store_name, method, args, kwargs)
+        appends a record and returns its sequence number and size
+    commit(lsn)
+        returns once record 'lsn' is as durable as the fsync policy requires
+    sync()
+        forces every appended record to disk
+    replay(store)
+        applies the records 'store' does not contain yet and opens the log for appending
+    rotate()
+        moves the records so far into a segment a snapshot in progress will cover
+    drop_rotated()
+        deletes that segment once the snapshot is written
+    truncate()
+        empties the log once a snapshot covers it
+    close()
+        syncs and closes the log
+    '''
+
+    def __init__(self, path, fsync=None):
+        self._path = path
+        self._fsync = fsync or WAL_FSYNC
+        if self._fsync not in ('always', 'group', 'periodic'):
+            raise ValueError(f"Unknown fsync policy {self._fsync}")
+        self._file = None
+        self._lsn = 0
+        self._synced_lsn = 0
+        self._syncing = False
+        self._synced = threading.Condition()
+        # keeps fsyncs off a file that is being swapped or closed
+        self._io_lock = threading.Lock()
+
+    def fsync_policy(self):
+        '''
+        Returns the fsync policy of the log
+        '''
+        return self._fsync
+
+    def append(self, store_name, method, args, kwargs):
+        '''
+        Appends a record of a completed operation. Callers hold DATABASE_LOCK
+        so that records are in the order operations were applied
+        Params: store_name (str): the Database attribute called, '' for the Database
+            method (str), args (tuple), kwargs (dict)
+        Returns: the sequence number of the record (int) and its size in bytes (int)
+        '''
+        payload = pickle.dumps((store_name, method, args, kwargs),
+                               protocol=pickle.HIGHEST_PROTOCOL)
+        self._lsn += 1
+        self._file.write(WAL_RECORD.pack(self._lsn, len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        # the record reaches the OS now, so it survives the process even if not the machine
+        self._file.flush()
+        if self._fsync == 'always':
+            os.fsync(self._file.fileno())
+            self._synced_lsn = self._lsn
+        return self._lsn, WAL_RECORD.size + len(payload)
+
+    def commit(self, lsn):
+        '''
+        Returns once record lsn is as durable as the fsync policy requires. Under
+        'group' the first waiting writer fsyncs for everyone who appended before it
+        Params: lsn (int)
+        '''
+        if self._fsync != 'group':
+            return
+        with self._synced:
+            while self._synced_lsn < lsn and self._syncing:
+                self._synced.wait()
+            if self._synced_lsn >= lsn:
+                return
+            self._syncing = True
+        try:
+            self.sync()
+        finally:
+            with self._synced:
+                self._syncing = False
+                self._synced.notify_all()
+
+    def sync(self):
+        '''
+        Forces every record appended so far to disk
+        '''
+        target = self._lsn
+        with self._io_lock:
+            if self._file is None:
+                return
+            os.fsync(self._file.fileno())
+        with self._synced:
+            self._synced_lsn = max(self._synced_lsn, target)
+
+    def replay(self, store):
+        '''
+        Applies the records with a sequence number above store.wal_lsn to store,
+        in order, from a rotated segment and then the log itself, and opens the
+        log for appending. A torn record left by a crash mid-write ends the log
+        and is cut off
+        Params: store (Database)
+        Returns: the number of records applied (int)
+        '''
+        applied = 0
+        # a store pickled before the log existed has no sequence number yet
+        store.wal_lsn = getattr(store, 'wal_lsn', 0)
+        for path in (self._rotated_path(), self._path):
+            try:
+                with open(path, 'rb') as log_file:
+                    data = log_file.read()
+            except FileNotFoundError:
+                data = b''
+            end = 0
+            while end + WAL_RECORD.size <= len(data):
+                lsn, length, checksum = WAL_RECORD.unpack_from(data, end)
+                start = end + WAL_RECORD.size
+                payload = data[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    break
+                end = start + length
+                self._lsn = lsn
+                if lsn <= store.wal_lsn:
+                    continue
+                store_name, method, args, kwargs = pickle.loads(payload)
+                target = getattr(store, store_name) if store_name else store
+                getattr(target, method)(*args, **kwargs)
+                store.wal_lsn = lsn
+                applied += 1
+
+        self._lsn = max(self._lsn, store.wal_lsn)
+        self._synced_lsn = self._lsn
+        self._file = open(self._path, 'ab')
+        if end < len(data):
+            self._file.truncate(end)
+        return applied
+
+    def _rotated_path(self):
+        '''
+        Returns the path records are moved to while a snapshot of them is written
+        '''
+        return self._path + '.old'
+
+    def rotate(self):
+        '''
+        Moves the records so far into a separate segment, so that a snapshot being
+        written of them can drop them once done while new records go to a fresh log.
+        Callers hold DATABASE_LOCK
+        Returns: False if an earlier segment is still waiting for its snapshot,
+            in which case nothing moves (bool)
+        '''
+        if os.path.exists(self._rotated_path()):
+            return False
+        self._file.flush()
+        self.sync()
+        with self._io_lock:
+            self._file.close()
+            os.replace(self._path, self._rotated_path())
+            self._file = open(self._path, 'ab')
+        return True
+
+    def drop_rotated(self):
+        '''
+        Deletes the rotated segment once a snapshot holds every record in it
+        '''
+        try:
+            os.remove(self._rotated_path())
+        except FileNotFoundError:
+            pass
+
+    def truncate(self):
+        '''
+        Empties the log once a snapshot holds every record in it. Sequence numbers
+        carry on from where they were. Callers hold DATABASE_LOCK
+        '''
+        with self._io_lock:
+            self._file.truncate(0)
+            os.fsync(self._file.fileno())
+        self.drop_rotated()
+
+    def close(self):
+        '''
+        Syncs and closes the log
+        '''
+        if self._file is not None:
+            self._file.flush()
+            self.sync()
+            with self._io_lock:
+                self._file.close()
+                self._file = None
+
+
+class SnapshotScheduler():
+    '''
+    A class that snapshots STORE from a thread inside the server process, as soon as
+    SECONDS_TO_UPDATE have passed, MUTATIONS_TO_UPDATE changes have been made or
+    DIRTY_BYTES_TO_UPDATE write-ahead log bytes have been written since the last
+    snapshot, whichever comes first. Triggers that arrive while a snapshot is due
+    or running are coalesced into the next one. Each snapshot taken logs a line
+    with its duration and size
+
+    Attributes:
+    -----------
+    mutations : int
+        Changes made since the last snapshot began
+    dirty_bytes : int
+        Write-ahead log bytes written since the last snapshot began
+    last_started : float
+        When the last snapshot began
+    wake : threading.Event
+        Set to have the scheduler thread check the triggers straight away
+    stats : dict
+        The number of snapshots taken and the duration, size and end time of the last one
+
+    Methods:
+    --------
+    record(size)
+        counts a change that wrote 'size' log bytes
+    request()
+        asks for a snapshot as soon as possible
+    stats()
+        returns the snapshot statistics
+    run()
+        takes snapshots whenever a trigger fires, until stop is called
+    stop()
+        ends run after any snapshot in progress
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mutations = 0
+        self._dirty_bytes = 0
+        self._requested = False
+        self._stopped = False
+        self._last_started = time()
+        self._wake = threading.Event()
+        self._stats = {
+            'snapshots': 0,
+            'last_duration': None,
+            'last_size': None,
+            'last_finished': None,
+        }
+
+    def record(self, size):
+        '''
+        Counts a change that wrote size bytes to the write-ahead log, waking the
+        scheduler thread if that crosses a threshold
+        Params: size (int)
+        '''
+        with self._lock:
+            self._mutations += 1
+            self._dirty_bytes += size
+            due = (self._mutations >= MUTATIONS_TO_UPDATE
+                   or self._dirty_bytes >= DIRTY_BYTES_TO_UPDATE)
+        if due:
+            self._wake.set()
+
+    def request(self):
+        '''
+        Asks for a snapshot as soon as possible. Requests made before it starts share it
+        '''
+        with self._lock:
+            self._requested = True
+        self._wake.set()
+
+    def stats(self):
+        '''
+        Returns: a copy of the statistics, along with the changes waiting for the next snapshot (dict)
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending_mutations'] = self._mutations
+            stats['pending_bytes'] = self._dirty_bytes
+        return stats
+
+    def _due(self):
+        '''
+        Returns: the seconds until the time trigger fires, 0 if any trigger has fired.
+            The timer restarts instead of firing when nothing has changed
+        '''
+        with self._lock:
+            if (self._requested or self._mutations >= MUTATIONS_TO_UPDATE
+                    or self._dirty_bytes >= DIRTY_BYTES_TO_UPDATE):
+                return 0
+            wait = self._last_started + SECONDS_TO_UPDATE - time()
+            if wait <= 0 and not self._mutations:
+                # nothing changed, so the last snapshot is still current
+                self._last_started = time()
+                return SECONDS_TO_UPDATE
+            return max(0, wait)
+
+    def _snapshot(self):
+        '''
+        Takes one snapshot. The counters restart when it begins, so changes made
+        while it is written count towards the next one
+        '''
+        with self._lock:
+            self._requested = False
+            self._mutations = 0
+            self._dirty_bytes = 0
+            self._last_started = time()
+        started = time()
+        saved = update_database(background=SNAPSHOT_FORK, wait=True)
+        if saved:
+            with self._lock:
+                self._stats['snapshots'] += 1
+                self._stats['last_duration'] = time() - started
+                self._stats['last_size'] = snapshot_size()
+                self._stats['last_finished'] = time()
+            stats = self.stats()
+            print(f"Snapshot {stats['snapshots']} took {stats['last_duration']:.3f}s "
+                  f"and wrote {stats['last_size']} bytes, "
+                  f"{stats['pending_mutations']} changes since")
+
+    def run(self):
+        '''
+        Takes snapshots whenever a trigger fires, until stop is called
+        '''
+        while not self._stopped:
+            wait = self._due()
+            if wait > 0:
+                self._wake.wait(wait)
+                self._wake.clear()
+                continue
+            self._snapshot()
+
+    def stop(self):
+        '''
+        Ends run after any snapshot in progress
+        '''
+        self._stopped = True
+        self._wake.set()
+
+
+class ResponseCache():
+    '''
+    A class that keeps serialised responses alongside the version of the data
+    they were built from. A response is only served while the caller still sees
+    the same version, so mutations invalidate it without touching the cache
+
+    Attributes:
+    -----------
+    responses : dict
+        Maps each key to a (version, response) pair
+
+    Methods:
+    --------
+    get(key, version)
+        returns the response stored under 'key' if it was built at 'version'
+    put(key, version, response)
+        stores 'response' under 'key' as built at 'version'
+    clear()
+        drops every response
+    '''
+
+    def __init__(self):
+        self._responses = dict()
+
+    def get(self, key, version):
+        '''
+        Params: key (hashable), version (hashable)
+        Returns: the response stored under key at version, None if it is stale or missing
+        '''
+        entry = self._responses.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+
+    def put(self, key, version, response):
+        '''
+        Stores response under key as built at version
+        Params: key (hashable), version (hashable), response (str)
+        '''
+        self._responses[key] = (version, response)
+
+    def clear(self):
+        '''
+        Drops every response
+        '''
+        self._responses.clear()
+
+
 STORE = Database()
-# this dictionary contains the session tokens that
+# this store contains the session tokens that
 # won't need to be stored in the Store data dictionary for pickling
-# {"token_str1": u_id1, "token_str2": u_id2, ..}
-TOKENS = dict()
+TOKENS = Sessions()
+# serialised responses built from STORE, which is why they are not pickled with it
+CACHE = ResponseCache()
+# the write-ahead log of STORE, opened by initialize_store
+WAL = None
+# the thread snapshotting STORE, started by start_snapshot_scheduler
+SCHEDULER = None
+# the stores changed since the last snapshot began, by store_name, and whether
+# the next incremental snapshot has to write every store regardless
+DIRTY_STORES = set()
+FULL_SNAPSHOT_DUE = True
 
 
 def image_config():
@@ -1420,41 +3570,378 @@ def get_tokens():
     return TOKENS
 
 
+def get_cache():
+    '''
+    Returns the global ResponseCache for serving pre-serialised responses
+    '''
+    global CACHE  # pylint: disable=global-statement
+    return CACHE
+
+
 def initialize_store():
     '''
-    Initialize the server database dictionary, creates an empty dictionary if the
-    database file is empty
+    Initialize the server database dictionary from the last incremental snapshot, or
+    from the database file if there is none, creates an empty dictionary if the
+    database file is empty. The sqlite backend opens SQLITE_FILE instead
     '''
     global STORE  # pylint: disable=global-statement
-    with open('database.p', "rb") as file:
-        try:
-            STORE = pickle.load(file, encoding="utf-8")
-        except EOFError:
-            STORE = Database()
+    global WAL  # pylint: disable=global-statement
+    global FULL_SNAPSHOT_DUE  # pylint: disable=global-statement
+    # closed first so that assembling a snapshot is not logged
+    if WAL is not None:
+        WAL.close()
+        WAL = None
+    if STORAGE_BACKEND == 'sqlite':
+        # imported here as sqlite_store builds on the classes in this module
+        from sqlite_store import SqliteDatabase  # pylint: disable=import-outside-toplevel
+        STORE = SqliteDatabase(SQLITE_FILE)
+        return
+    if STORAGE_BACKEND not in ('memory', 'columnar'):
+        raise ValueError(f"Unknown storage backend {STORAGE_BACKEND}")
+    manifest = read_manifest() if INCREMENTAL_SNAPSHOTS else None
+    if manifest is not None:
+        STORE = load_snapshot(manifest)
+    else:
+        with open(DATABASE_FILE, "rb") as file:
+            try:
+                STORE = pickle.load(file, encoding="utf-8")
+            except EOFError:
+                STORE = Database()
+    # the next snapshot only builds on the files the store was assembled from
+    DIRTY_STORES.clear()
+    FULL_SNAPSHOT_DUE = manifest is None
+    if WAL_ENABLED:
+        # replaying before WAL is set keeps the replayed calls out of the log
+        wal = WriteAheadLog(WAL_FILE)
+        wal.replay(STORE)
+        WAL = wal
 
 
 def initialize_state():
     '''
-    initialise the store and the tokens dictionary
+    initialise the store and the session tokens, restoring saved sessions
     '''
     initialize_store()
     global TOKENS  # pylint: disable=global-statement
-    TOKENS = dict()
+    TOKENS = Sessions.load(SESSIONS_FILE) if PERSIST_SESSIONS else Sessions()
+    get_cache().clear()
+
+
+def start_session_sweeper():
+    '''
+    Starts a daemon thread that evicts expired sessions every SESSION_SWEEP_SECONDS
+    '''
+    def sweep_forever():
+        '''
+        Sweeps the current session store until the server exits
+        '''
+        while True:
+            sleep(SESSION_SWEEP_SECONDS)
+            get_tokens().sweep()
+
+    sweeper = threading.Thread(target=sweep_forever, daemon=True)
+    sweeper.start()
+    return sweeper
+
+
+def start_snapshot_scheduler():
+    '''
+    Starts a daemon thread that snapshots the database whenever a SnapshotScheduler
+    trigger fires
+    Returns: the SnapshotScheduler, None if the database writes itself to disk
+    '''
+    global SCHEDULER  # pylint: disable=global-statement
+    if STORE.persistent:
+        return None
+    if SCHEDULER is None:
+        SCHEDULER = SnapshotScheduler()
+        threading.Thread(target=SCHEDULER.run, daemon=True).start()
+    return SCHEDULER
+
+
+def get_scheduler():
+    '''
+    Returns the running SnapshotScheduler, None if there is none
+    '''
+    global SCHEDULER  # pylint: disable=global-statement
+    return SCHEDULER
+
+
+def start_wal_syncer():
+    '''
+    Starts a daemon thread that fsyncs the write-ahead log every WAL_FSYNC_SECONDS,
+    when the log's fsync policy is 'periodic'
+    '''
+    if WAL is None or WAL.fsync_policy() != 'periodic':
+        return None
+
+    def sync_forever():
+        '''
+        Syncs the current write-ahead log until the server exits
+        '''
+        while True:
+            sleep(WAL_FSYNC_SECONDS)
+            if WAL is not None:
+                WAL.sync()
+
+    syncer = threading.Thread(target=sync_forever, daemon=True)
+    syncer.start()
+    return syncer
 
 
 # A constant to update the database every hour
 SECONDS_TO_UPDATE = 3000
+# a snapshot is also taken once this many changes have been made since the last one
+MUTATIONS_TO_UPDATE = 10000
+# or once the changes since the last one add up to this many write-ahead log bytes
+DIRTY_BYTES_TO_UPDATE = 64 * 1024 * 1024
+
+
+# the pid of the forked child writing a background snapshot, None when idle
+SNAPSHOT_PID = None
+
+
+def write_file(path, data):
+    '''
+    Pickles data into a temporary file and renames it over path,
+    so a crash mid-write never leaves a half written file behind
+    Returns: the number of bytes written (int)
+    '''
+    temp_path = path + '.tmp'
+    with open(temp_path, "wb") as out_file:
+        pickle.dump(data, out_file)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+        size = out_file.tell()
+    os.replace(temp_path, path)
+    return size
+
+
+def read_file(path):
+    '''
+    Returns the data pickled in path
+    '''
+    with open(path, "rb") as in_file:
+        return pickle.load(in_file, encoding="utf-8")
 
 
-def update_database():
+def read_manifest():
     '''
-    pickle the state database into a file
+    Returns: the manifest of the last incremental snapshot (dict), None if there is none
+    '''
+    try:
+        return read_file(os.path.join(SNAPSHOT_DIR, SNAPSHOT_MANIFEST))
+    except FileNotFoundError:
+        return None
+
+
+def take_dirty(store):
+    '''
+    Collects what the next incremental snapshot of store has to write and starts
+    tracking changes afresh. Callers hold DATABASE_LOCK so that no change is missed
+    Params: store (Database)
+    Returns: a dictionary with keys full (bool), stores (set): the stores to write
+        whole and segments (dict): the segments to write of each segmented store
+    '''
+    global FULL_SNAPSHOT_DUE  # pylint: disable=global-statement
+    full = FULL_SNAPSHOT_DUE or not os.path.exists(
+        os.path.join(SNAPSHOT_DIR, SNAPSHOT_MANIFEST))
+    dirty = set(DIRTY_STORES)
+    DIRTY_STORES.clear()
+    FULL_SNAPSHOT_DUE = False
+
+    stores = set(WHOLE_STORES) if full else dirty & set(WHOLE_STORES)
+    # reset codes are random and emailed, so they are not logged or marked
+    stores.add('codes')
+    segments = dict()
+    for name in SEGMENTED_STORES:
+        sub_store = getattr(store, name)
+        if not hasattr(sub_store, 'take_dirty_segments'):
+            # ColumnarMessages is written whole
+            if full or name in dirty:
+                stores.add(name)
+            continue
+        taken = sub_store.take_dirty_segments()
+        segments[name] = sub_store.segment_ids() if full else taken
+    return {'full': full, 'stores': stores, 'segments': segments}
+
+
+def restore_dirty(store, parts):
+    '''
+    Marks the parts taken by take_dirty as changed again, after their snapshot failed.
+    Callers hold DATABASE_LOCK
+    Params: store (Database), parts (dict): from take_dirty
+    '''
+    global FULL_SNAPSHOT_DUE  # pylint: disable=global-statement
+    FULL_SNAPSHOT_DUE = FULL_SNAPSHOT_DUE or parts['full']
+    DIRTY_STORES.update(parts['stores'])
+    for name, segments in parts['segments'].items():
+        getattr(store, name).restore_dirty_segments(segments)
+
+
+def write_snapshot(store, parts=None):
+    '''
+    Writes a snapshot of store. An incremental snapshot writes the parts taken by
+    take_dirty to new files in SNAPSHOT_DIR and commits them by renaming a new
+    manifest over the old one, then deletes the files no manifest lists any more.
+    Otherwise store is written whole over DATABASE_FILE. Either way a crash
+    mid-write leaves the previous snapshot whole
+    Params: store (Database), parts (dict): from take_dirty, None to write DATABASE_FILE
+    Returns: the number of bytes written (int)
+    '''
+    if parts is None:
+        return write_file(DATABASE_FILE, store)
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    manifest = None if parts['full'] else read_manifest()
+    if manifest is None:
+        manifest = {'generation': 0, 'stores': dict(), 'segments': dict(), 'meta': dict()}
+    generation = manifest['generation'] + 1
+    written = 0
+
+    for name in sorted(parts['stores']):
+        file_name = f'{name}.{generation}.p'
+        written += write_file(os.path.join(SNAPSHOT_DIR, file_name), getattr(store, name))
+        manifest['stores'][name] = file_name
+    for name, segments in parts['segments'].items():
+        sub_store = getattr(store, name)
+        files = manifest['segments'].setdefault(name, dict())
+        for segment in sorted(segments):
+            entries = sub_store.segment(segment)
+            if not entries:
+                # everything in the segment has been removed
+                files.pop(segment, None)
+                continue
+            file_name = f'{name}.{segment}.{generation}.p'
+            written += write_file(os.path.join(SNAPSHOT_DIR, file_name), entries)
+            files[segment] = file_name
+        manifest['meta'][name] = sub_store.snapshot_meta()
+
+    manifest.update(generation=generation, wal_lsn=store.wal_lsn, written=written)
+    written += write_file(os.path.join(SNAPSHOT_DIR, SNAPSHOT_MANIFEST), manifest)
+
+    live = set(manifest['stores'].values())
+    for files in manifest['segments'].values():
+        live.update(files.values())
+    for file_name in os.listdir(SNAPSHOT_DIR):
+        if file_name != SNAPSHOT_MANIFEST and file_name not in live:
+            os.remove(os.path.join(SNAPSHOT_DIR, file_name))
+    return written
+
+
+def load_snapshot(manifest):
+    '''
+    Assembles a database from the files listed in the manifest of an incremental
+    snapshot, rebuilding the timelines and indexes that are not written
+    Params: manifest (dict): from read_manifest
+    Returns: Database
+    '''
+    store = Database()
+    for name, file_name in manifest['stores'].items():
+        setattr(store, name, read_file(os.path.join(SNAPSHOT_DIR, file_name)))
+    for name, files in manifest['segments'].items():
+        getattr(store, name).load_segments(
+            (read_file(os.path.join(SNAPSHOT_DIR, files[segment])) for segment in sorted(files)),
+            manifest['meta'].get(name, dict()))
+    store.rebuild_timelines()
+    store.wal_lsn = manifest['wal_lsn']
+    return store
+
+
+def snapshot_size():
+    '''
+    Returns: the number of bytes the last snapshot wrote (int)
+    '''
+    if INCREMENTAL_SNAPSHOTS:
+        manifest = read_manifest()
+        return manifest['written'] if manifest is not None else 0
+    return os.path.getsize(DATABASE_FILE)
+
+
+def await_snapshot(pid, parts=None):
+    '''
+    Waits for the forked child with pid to finish its snapshot, then drops the
+    rotated log segment, which only holds records from before the fork, if it succeeded.
+    If it failed the parts it was writing are marked as changed again
+    Params: pid (int), parts (dict): from take_dirty, None if not incremental
+    '''
+    global SNAPSHOT_PID  # pylint: disable=global-statement
+    status = os.waitpid(pid, 0)[1]
+    saved = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    if saved and WAL is not None:
+        WAL.drop_rotated()
+    with DATABASE_LOCK:
+        if not saved and parts is not None:
+            restore_dirty(STORE, parts)
+        SNAPSHOT_PID = None
+    print('Updated database!' if saved else 'Background snapshot failed!')
+    return saved
+
+
+def update_database(background=True, wait=False):
+    '''
+    pickle the state database into a file, or with INCREMENTAL_SNAPSHOTS only the parts
+    changed since the last snapshot. In the background a forked child pickles its
+    copy-on-write view of STORE while this process carries on serving, otherwise
+    STORE is pickled here under DATABASE_LOCK
+    Args: background (bool), wait (bool): whether to return only once a background
+        snapshot is written
+    Returns: whether a snapshot was made or started (bool), False if a background
+        snapshot is already running or failed
     '''
     # pylint: disable=global-statement
 
     global STORE
+    global SNAPSHOT_PID
+
+    if PERSIST_SESSIONS:
+        get_tokens().save(SESSIONS_FILE)
+
+    if STORE.persistent:
+        # every change is already on disk
+        return True
 
+    if background and SNAPSHOT_FORK:
+        # writers only wait for the fork, which freezes the child's view of STORE.
+        # The child starts with only this thread, holding DATABASE_LOCK, so no logged
+        # change is half applied in its copy. Any other lock (the write-ahead log's,
+        # the session and response cache locks, the standup lock, stdout's) may have
+        # been held by another thread at the fork and would never be released in the
+        # child, so the child only pickles STORE to files and exits without printing
+        with DATABASE_LOCK:
+            if SNAPSHOT_PID is not None:
+                return False
+            if WAL is not None:
+                WAL.rotate()
+            parts = take_dirty(STORE) if INCREMENTAL_SNAPSHOTS else None
+            pid = os.fork()
+            if pid == 0:
+                exit_code = 1
+                try:
+                    write_snapshot(STORE, parts)
+                    exit_code = 0
+                finally:
+                    # skip the parent's exit handlers and buffered output
+                    os._exit(exit_code)  # pylint: disable=protected-access
+            SNAPSHOT_PID = pid
+        if wait:
+            return await_snapshot(pid, parts)
+        threading.Thread(target=await_snapshot, args=(pid, parts), daemon=True).start()
+        return True
+
+    # a background snapshot finishing later would replace this newer one
+    while SNAPSHOT_PID is not None:
+        sleep(0.1)
     with DATABASE_LOCK:
-        with open('database.p', "wb") as database_file:
-            pickle.dump(STORE, database_file)
+        parts = take_dirty(STORE) if INCREMENTAL_SNAPSHOTS else None
+        try:
+            write_snapshot(STORE, parts)
+        except BaseException:
+            if parts is not None:
+                restore_dirty(STORE, parts)
+            raise
+        # the snapshot now holds everything logged so far
+        if WAL is not None:
+            WAL.truncate()
     print('Updated database!')
+    return True
@@ -0,0 +1,754 @@
+'''
+Tests for the stores in state that the function tests do not reach directly
+'''
+
+#pylint: disable=missing-function-docstring
+#pylint: disable=redefined-outer-name
+
+import os
+import io
+import signal
+import pickle
+import threading
+from time import sleep
+import pytest  # pylint: disable=import-error
+import state
+from state import (ColumnarMessages, BodyStore, Messages, Codes, Database, WriteAheadLog,
+                   SnapshotScheduler, Timelines, RESET_CODE_TTL, WAL_RECORD)
+from auth import auth_register, auth_logout, auth_login, auth_passwordreset_request, \
+    auth_passwordreset_reset
+from other import workspace_reset
+from error import InputError
+
+
+def test_messages_search_survives_removal():
+    store = Database()
+    u_id = store.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    channel_id = store.add_channel(u_id, ('general', True))
+    message_ids = [store.add_message(u_id, channel_id, (f'hello {i}', 100.0 + i))
+                   for i in range(3)]
+    found = store.iter_search({channel_id}, 'hello')
+    assert next(found) == message_ids[2]
+    # a message removed mid-search is skipped rather than raising
+    store.remove_message(message_ids[0])
+    assert list(found) == [message_ids[1]]
+
+
+def test_timelines_merge_reads_a_copy():
+    timelines = Timelines()
+    for message_id in range(1, 4):
+        timelines.add(1, message_id, 100.0 + message_id)
+    newest = timelines.iter_newest([1])
+    assert next(newest) == 3
+    timelines.remove(1, 1, 101.0)
+    timelines.add(1, 4, 104.0)
+    assert list(newest) == [2, 1]
+
+
+@pytest.mark.parametrize('store_class', [Messages, ColumnarMessages])
+def test_messages_pickle_without_index(store_class):
+    messages = store_class()
+    for body in ('hello world', 'goodbye world', 'hello again'):
+        messages.add((body, 100.0))
+    messages.remove(2)
+    data = pickle.dumps(messages)
+    assert b'_ngram_index' not in data
+    # the index is rebuilt on loading, so searching still uses it
+    loaded = pickle.loads(data)
+    assert loaded.candidates('hello') == {1, 3}
+    assert [msg['message_id'] for msg in loaded.search('world')] == [1]
+
+
+def test_columnar_pin_missing_message():
+    messages = ColumnarMessages()
+    messages.add(('hello', 100.0))
+    with pytest.raises(KeyError):
+        messages.pin(2)
+    with pytest.raises(KeyError):
+        messages.unpin(2)
+    with pytest.raises(KeyError):
+        messages.find(2)
+
+
+def test_columnar_keeps_time_type():
+    messages = ColumnarMessages()
+    int_id = messages.add(('sent at an int time', 100))
+    float_id = messages.add(('sent at a float time', 100.5))
+    assert messages.find(int_id).time_created == 100
+    assert isinstance(messages.find(int_id).time_created, int)
+    assert isinstance(messages.message_details(float_id)['time_created'], float)
+
+    # compacting rewrites every column, the types must survive it
+    for _ in range(4):
+        messages.remove(messages.add(('short lived', 101)))
+    assert len(messages._ids) < 6  # pylint: disable=protected-access
+    assert isinstance(messages.find(int_id).time_created, int)
+    assert messages.find(float_id).time_created == 100.5
+
+
+def test_body_store_interns_only_repeats():
+    bodies = BodyStore()
+    first = bodies.intern(1, ''.join(['hello ', 'there']))
+    assert len(bodies) == 0
+    second = bodies.intern(2, ''.join(['hello ', 'there']))
+    third = bodies.intern(3, ''.join(['hello ', 'there']))
+    assert len(bodies) == 1
+    assert second is third and second is not first
+
+    # only messages holding the shared copy hold a reference to it
+    bodies.release(1, first)
+    assert len(bodies) == 1
+    bodies.release(2, second)
+    assert len(bodies) == 1
+    bodies.release(3, third)
+    assert len(bodies) == 0
+
+
+def test_body_store_release_is_symmetric():
+    bodies = BodyStore()
+    body = 'the same string every time'
+    # the first message holds the very string that becomes the shared copy
+    for message_id in range(1, 4):
+        assert bodies.intern(message_id, body) is body
+    bodies.release(1, body)
+    bodies.release(1, body)
+    bodies.release(2, body)
+    assert len(bodies) == 1
+    bodies.release(3, body)
+    assert len(bodies) == 0
+
+
+def test_body_store_forgets_old_bodies(monkeypatch):
+    monkeypatch.setattr(state, 'RECENT_BODIES', 2)
+    bodies = BodyStore()
+    for message_id, body in enumerate(('one', 'two', 'three', 'one')):
+        bodies.intern(message_id, body)
+    assert len(bodies) == 0
+    bodies.intern(4, 'three')
+    assert len(bodies) == 1
+
+
+def test_messages_release_bodies_on_edit_and_remove():
+    messages = Messages()
+    bodies = messages._bodies  # pylint: disable=protected-access
+    message_ids = [messages.add(('/guess a', 100.0)) for _ in range(3)]
+    assert len(bodies) == 1
+    messages.edit(message_ids[1], 'something else')
+    messages.remove(message_ids[2])
+    assert len(bodies) == 0
+    # the first copy was never shared, so releasing it frees nothing
+    messages.remove(message_ids[0])
+    assert len(bodies) == 0
+
+
+def test_codes_expire_and_match_exactly(monkeypatch):
+    monkeypatch.setattr(Codes, '_send_email', lambda self, email: None)
+    now = 1000.0
+    monkeypatch.setattr(state, 'time', lambda: now)
+    # codes with letters, so that a lowercased code is a different one
+    monkeypatch.setattr(state, 'generate_reset_code',
+                        iter(['A1B2C3D4', 'E5F6A7B8', 'C9D0E1F2']).__next__)
+    codes = Codes()
+    codes.push('max@gmail.com')
+    codes.push('kim@gmail.com')
+    # a second request replaces the first code
+    old_code = codes._codes_dict['kim@gmail.com']  # pylint: disable=protected-access
+    now += RESET_CODE_TTL / 2
+    codes.push('kim@gmail.com')
+    reset_code = codes._codes_dict['max@gmail.com']  # pylint: disable=protected-access
+    assert sorted(codes._codes_dict) == ['kim@gmail.com', 'max@gmail.com']  # pylint: disable=protected-access
+    assert codes.find_email(old_code) == []
+    assert codes.find_email(reset_code) == ['max@gmail.com']
+    assert codes.find_email(reset_code[:-1]) == []
+    assert codes.find_email(reset_code.lower()) == []
+
+    now += RESET_CODE_TTL / 2
+    assert codes.find_email(reset_code) == []
+    with pytest.raises(InputError):
+        codes.redeem(reset_code)
+    assert list(codes._codes_dict) == ['kim@gmail.com']  # pylint: disable=protected-access
+
+    assert codes.redeem(codes._codes_dict['kim@gmail.com']) == 'kim@gmail.com'  # pylint: disable=protected-access
+    assert codes._codes_dict == {}  # pylint: disable=protected-access
+
+
+def open_wal(path, store, fsync=None):
+    '''
+    Opens the log at path for store, replaying it, and makes both current
+    as initialize_store does
+    '''
+    if state.WAL is not None:
+        state.WAL.close()
+    # replayed calls are not logged again
+    state.WAL = None
+    state.STORE = store
+    wal = WriteAheadLog(path, fsync)
+    applied = wal.replay(store)
+    state.WAL = wal
+    return wal, applied
+
+
+@pytest.fixture
+def wal_path(tmp_path, monkeypatch):
+    '''
+    A log file that tests open with open_wal; the current store and log are put back after
+    '''
+    monkeypatch.setattr(state, 'STORE', state.STORE)
+    monkeypatch.setattr(state, 'WAL', None)
+    yield str(tmp_path / 'database.wal')
+    if state.WAL is not None:
+        close_wal()
+
+
+def close_wal():
+    '''
+    Closes the current log, so that further changes are not logged
+    '''
+    state.WAL.close()
+    state.WAL = None
+
+
+def fill(store):
+    '''
+    Makes some logged changes to store, returning the channel they were made in
+    '''
+    u_id = store.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    channel_id = store.add_channel(u_id, ('general', True))
+    for i in range(5):
+        store.add_message(u_id, channel_id, (f'message {i}', 100.0 + i))
+    store.messages.edit(2, 'edited')
+    store.pin(u_id, 3)
+    store.remove_message(4)
+    return u_id, channel_id
+
+
+def test_wal_replays_into_fresh_database(wal_path):
+    store = Database()
+    open_wal(wal_path, store)
+    u_id, channel_id = fill(store)
+    expected = store.channel_messages(u_id, (channel_id, 0))
+    close_wal()
+
+    fresh = Database()
+    _, applied = open_wal(wal_path, fresh)
+    assert applied == 10
+    assert fresh.wal_lsn == store.wal_lsn == 10
+    assert fresh.channel_messages(u_id, (channel_id, 0)) == expected
+    assert fresh.users.all() == store.users.all()
+
+
+def test_wal_replays_into_store_without_lsn(wal_path):
+    store = Database()
+    open_wal(wal_path, store)
+    fill(store)
+    close_wal()
+
+    # as pickled before the log was added
+    old = Database()
+    del old.wal_lsn
+    _, applied = open_wal(wal_path, old)
+    assert applied == 10
+    assert old.wal_lsn == 10
+
+
+def test_wal_skips_records_in_snapshot(wal_path):
+    store = Database()
+    open_wal(wal_path, store)
+    u_id = store.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    channel_id = store.add_channel(u_id, ('general', True))
+    close_wal()
+
+    # a store that already holds the first record only gets the second
+    fresh = Database()
+    fresh.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    fresh.wal_lsn = 1
+    _, applied = open_wal(wal_path, fresh)
+    assert applied == 1
+    assert len(fresh.users.all()) == 1
+    assert fresh.channels.channel_exists(channel_id)
+    # numbering carries on after the records that were skipped
+    fresh.add_channel(u_id, ('random', True))
+    assert fresh.wal_lsn == 3
+
+
+@pytest.mark.parametrize('damage', ['torn', 'corrupt'])
+def test_wal_cuts_damaged_tail(wal_path, damage):
+    store = Database()
+    open_wal(wal_path, store)
+    u_id = store.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    store.add_channel(u_id, ('general', True))
+    intact = os.path.getsize(wal_path)
+    store.add_channel(u_id, ('random', True))
+    close_wal()
+
+    with open(wal_path, 'r+b') as log_file:
+        if damage == 'torn':
+            log_file.truncate(intact + WAL_RECORD.size + 3)
+        else:
+            log_file.seek(-1, os.SEEK_END)
+            last = log_file.read(1)
+            log_file.seek(-1, os.SEEK_END)
+            log_file.write(bytes([last[0] ^ 0xFF]))
+
+    fresh = Database()
+    _, applied = open_wal(wal_path, fresh)
+    assert applied == 2
+    assert os.path.getsize(wal_path) == intact
+    assert [channel['name'] for channel in fresh.channels.all()] == ['general']
+
+    # records appended after the cut replay along with the ones before it
+    fresh.add_channel(u_id, ('random', True))
+    close_wal()
+    replayed = Database()
+    _, applied = open_wal(wal_path, replayed)
+    assert applied == 3
+    assert [channel['name'] for channel in replayed.channels.all()] == ['general', 'random']
+
+
+def count_fsyncs(monkeypatch):
+    '''
+    Counts the calls to os.fsync from now on
+    '''
+    calls = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: calls.append(fd) or fsync(fd))
+    return calls
+
+
+def test_wal_fsync_always(wal_path, monkeypatch):
+    store = Database()
+    open_wal(wal_path, store, 'always')
+    calls = count_fsyncs(monkeypatch)
+    store.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    store.add_user(('kim@gmail.com', 'hash', 'Kim', 'Smith', 'kimsmith'))
+    assert len(calls) == 2
+
+
+def test_wal_fsync_group(wal_path, monkeypatch):
+    store = Database()
+    wal, _ = open_wal(wal_path, store, 'group')
+    calls = count_fsyncs(monkeypatch)
+    store.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    assert len(calls) == 1
+
+    # one fsync covers every record appended before it
+    lsns = [wal.append('users', 'version', (), {})[0] for _ in range(3)]
+    wal.commit(lsns[0])
+    assert len(calls) == 2
+    for lsn in lsns:
+        wal.commit(lsn)
+    assert len(calls) == 2
+
+
+def test_wal_fsync_periodic(wal_path, monkeypatch):
+    monkeypatch.setattr(state, 'WAL_FSYNC_SECONDS', 0.01)
+    store = Database()
+    open_wal(wal_path, store, 'periodic')
+    calls = count_fsyncs(monkeypatch)
+    store.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    assert not calls
+
+    assert state.start_wal_syncer() is not None
+    for _ in range(100):
+        if calls:
+            break
+        sleep(0.01)
+    assert calls
+
+
+def test_wal_keeps_no_plain_passwords(wal_path, monkeypatch):
+    monkeypatch.setattr(Codes, '_send_email', lambda self, email: None)
+    monkeypatch.setattr(state, 'TOKENS', state.Sessions())
+    open_wal(wal_path, Database())
+    auth_logout(auth_register('max@gmail.com', 'password123', 'Max', 'Smith')['token'])
+    auth_passwordreset_request('max@gmail.com')
+    reset_code = state.get_store().codes._codes_dict['max@gmail.com']  # pylint: disable=protected-access
+    auth_passwordreset_reset(reset_code, 'SuperSecret!42')
+    auth_login('max@gmail.com', 'SuperSecret!42')
+    state.WAL.sync()
+
+    with open(wal_path, 'rb') as log_file:
+        log = log_file.read()
+    assert b'password123' not in log
+    assert b'SuperSecret!42' not in log
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    '''
+    Gives a test an empty directory where snapshots and the log are written, with
+    a store of its own whose changes are logged; the current store is put back after
+    '''
+    monkeypatch.setattr(state, 'DATABASE_FILE', str(tmp_path / 'database.p'))
+    monkeypatch.setattr(state, 'WAL_FILE', str(tmp_path / 'database.wal'))
+    monkeypatch.setattr(state, 'SNAPSHOT_DIR', str(tmp_path / 'snapshot'))
+    monkeypatch.setattr(state, 'PERSIST_SESSIONS', False)
+    monkeypatch.setattr(state, 'SNAPSHOT_PID', None)
+    monkeypatch.setattr(state, 'FULL_SNAPSHOT_DUE', True)
+    monkeypatch.setattr(state, 'DIRTY_STORES', set())
+    monkeypatch.setattr(state, 'STORE', state.STORE)
+    monkeypatch.setattr(state, 'WAL', None)
+    # the segments tested are those of Messages, whatever backend the tests run against
+    monkeypatch.setattr(state, 'STORAGE_BACKEND', 'memory')
+    open_wal(state.WAL_FILE, Database())
+    yield tmp_path
+    if state.WAL is not None:
+        close_wal()
+
+
+def replay_snapshot():
+    '''
+    Loads the last snapshot and replays the log into it, as a restart would
+    '''
+    with open(state.DATABASE_FILE, 'rb') as in_file:
+        store = pickle.load(in_file)
+    open_wal(state.WAL_FILE, store)
+    return store
+
+
+needs_fork = pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+
+
+@needs_fork
+def test_background_snapshot_replaces_file(snapshot_dir, monkeypatch):
+    monkeypatch.setattr(state, 'INCREMENTAL_SNAPSHOTS', False)
+    store = state.get_store()
+    u_id, channel_id = fill(store)
+    assert state.update_database(background=True, wait=True)
+
+    assert sorted(os.listdir(snapshot_dir)) == ['database.p', 'database.wal']
+    assert os.path.getsize(state.WAL_FILE) == 0
+    close_wal()
+    with open(state.DATABASE_FILE, 'rb') as in_file:
+        saved = pickle.load(in_file)
+    assert saved.wal_lsn == store.wal_lsn
+    assert saved.channel_messages(u_id, (channel_id, 0)) == \
+        store.channel_messages(u_id, (channel_id, 0))
+
+
+@needs_fork
+@pytest.mark.parametrize('failure', ['error', 'killed'])
+def test_failed_background_snapshot_keeps_log(snapshot_dir, monkeypatch, failure):
+    monkeypatch.setattr(state, 'INCREMENTAL_SNAPSHOTS', False)
+    store = state.get_store()
+    u_id = store.add_user(('max@gmail.com', 'hash', 'Max', 'Smith', 'maxsmith'))
+    assert state.update_database(background=False)
+    with open(state.DATABASE_FILE, 'rb') as in_file:
+        before = in_file.read()
+
+    channel_id = store.add_channel(u_id, ('general', True))
+    message_id = store.add_message(u_id, channel_id, ('hello', 100.0))
+
+    def fail(*_):
+        if failure == 'killed':
+            os.kill(os.getpid(), signal.SIGKILL)
+        raise OSError('disk full')
+    # the child inherits the patched function
+    monkeypatch.setattr(state, 'write_snapshot', fail)
+    assert not state.update_database(background=True, wait=True)
+    assert state.SNAPSHOT_PID is None
+
+    with open(state.DATABASE_FILE, 'rb') as in_file:
+        assert in_file.read() == before
+    assert os.path.exists(state.WAL_FILE + '.old')
+    # writes after the failure go to the fresh log and survive with the rest
+    store.messages.edit(message_id, 'edited')
+    close_wal()
+    restored = replay_snapshot()
+    assert restored.channel_messages(u_id, (channel_id, 0)) == \
+        store.channel_messages(u_id, (channel_id, 0))
+
+
+@pytest.fixture
+def snapshots(monkeypatch):
+    '''
+    Stands in for update_database, recording each snapshot and holding it
+    until the test sets 'release'
+    '''
+    taken = []
+    release = threading.Event()
+    release.set()
+
+    def update_database(background=True, wait=False):
+        taken.append((background, wait))
+        release.wait(5)
+        return True
+    monkeypatch.setattr(state, 'update_database', update_database)
+    monkeypatch.setattr(state, 'snapshot_size', lambda: 123)
+    return taken, release
+
+
+def run_scheduler(scheduler):
+    '''
+    Runs scheduler in a thread, returning the thread
+    '''
+    thread = threading.Thread(target=scheduler.run, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_for(condition):
+    '''
+    Waits up to a second for condition to hold
+    '''
+    for _ in range(100):
+        if condition():
+            return True
+        sleep(0.01)
+    return False
+
+
+def test_scheduler_mutation_trigger(snapshots, monkeypatch):
+    taken, _ = snapshots
+    monkeypatch.setattr(state, 'MUTATIONS_TO_UPDATE', 3)
+    scheduler = SnapshotScheduler()
+    thread = run_scheduler(scheduler)
+    scheduler.record(10)
+    scheduler.record(10)
+    sleep(0.05)
+    assert not taken
+    assert scheduler.stats()['pending_mutations'] == 2
+    scheduler.record(10)
+    assert wait_for(lambda: scheduler.stats()['snapshots'] == 1)
+
+    stats = scheduler.stats()
+    assert stats['last_size'] == 123
+    assert stats['last_duration'] >= 0
+    assert stats['pending_mutations'] == 0 and stats['pending_bytes'] == 0
+    scheduler.stop()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert len(taken) == 1
+
+
+def test_scheduler_coalesces_requests(snapshots):
+    taken, release = snapshots
+    scheduler = SnapshotScheduler()
+    release.clear()
+    thread = run_scheduler(scheduler)
+    scheduler.request()
+    assert wait_for(lambda: len(taken) == 1)
+    # requests made while a snapshot is written share the next one
+    for _ in range(5):
+        scheduler.request()
+        scheduler.record(10)
+    release.set()
+    assert wait_for(lambda: scheduler.stats()['snapshots'] == 2)
+    sleep(0.05)
+    scheduler.stop()
+    thread.join(1)
+    assert len(taken) == 2
+
+
+def test_scheduler_timer_skips_unchanged_store(snapshots, monkeypatch):
+    taken, _ = snapshots
+    monkeypatch.setattr(state, 'SECONDS_TO_UPDATE', 0.02)
+    scheduler = SnapshotScheduler()
+    thread = run_scheduler(scheduler)
+    sleep(0.1)
+    assert not taken
+    scheduler.record(10)
+    assert wait_for(lambda: len(taken) == 1)
+    scheduler.stop()
+    thread.join(1)
+
+
+def test_workspace_reset_requests_snapshot(snapshots, monkeypatch):
+    taken, _ = snapshots
+    scheduler = SnapshotScheduler()
+    monkeypatch.setattr(state, 'SCHEDULER', scheduler)
+    thread = run_scheduler(scheduler)
+    workspace_reset()
+    assert wait_for(lambda: len(taken) == 1)
+    scheduler.stop()
+    thread.join(1)
+
+
+def snapshot_files():
+    '''
+    Returns: the files in SNAPSHOT_DIR (set)
+    '''
+    return set(os.listdir(state.SNAPSHOT_DIR))
+
+
+def manifest_files(manifest):
+    '''
+    Returns: the files manifest lists, along with the manifest itself (set)
+    '''
+    files = set(manifest['stores'].values())
+    for segments in manifest['segments'].values():
+        files.update(segments.values())
+    return files | {state.SNAPSHOT_MANIFEST}
+
+
+def test_incremental_snapshot_round_trip(snapshot_dir, monkeypatch):
+    monkeypatch.setattr(state, 'SEGMENT_SIZE', 4)
+    close_wal()
+    store = state.get_store()
+    u_id, channel_id = fill(store)
+    for i in range(10):
+        store.add_message(u_id, channel_id, (f'more {i}', 200.0 + i))
+    assert state.update_database(background=False)
+    first = state.read_manifest()
+    assert first['segments']['messages'].keys() == {0, 1, 2, 3}
+
+    # only the segment of the edited message and the stores it touched are written again
+    store.messages.edit(9, 'edited again')
+    assert state.update_database(background=False)
+    second = state.read_manifest()
+    # reset codes are not tracked, so they are written every time
+    assert {name: file_name for name, file_name in second['stores'].items()
+            if name != 'codes'} == {name: file_name for name, file_name
+                                    in first['stores'].items() if name != 'codes'}
+    changed = {segment for segment, file_name in second['segments']['messages'].items()
+               if file_name != first['segments']['messages'][segment]}
+    assert changed == {2}
+    # files no manifest lists any more are deleted
+    assert snapshot_files() == manifest_files(second)
+
+    loaded = state.load_snapshot(second)
+    assert loaded.channel_messages(u_id, (channel_id, 0)) == \
+        store.channel_messages(u_id, (channel_id, 0))
+    assert loaded.users.all() == store.users.all()
+    assert loaded.messages.next_id() == store.messages.next_id()
+
+
+def test_failed_snapshot_restores_dirty_marks(snapshot_dir, monkeypatch):
+    close_wal()
+    store = state.get_store()
+    u_id, channel_id = fill(store)
+    assert state.update_database(background=False)
+    store.add_channel(u_id, ('random', True))
+    store.add_message(u_id, channel_id, ('late', 300.0))
+
+    write_file = state.write_file
+
+    def fail(path, data):
+        if 'manifest' in path:
+            raise OSError('disk full')
+        return write_file(path, data)
+    monkeypatch.setattr(state, 'write_file', fail)
+    with pytest.raises(OSError):
+        state.update_database(background=False)
+    assert 'channels' in state.DIRTY_STORES
+    segments = store.messages.take_dirty_segments()
+    assert segments == {0}
+    store.messages.restore_dirty_segments(segments)
+
+    monkeypatch.setattr(state, 'write_file', write_file)
+    assert state.update_database(background=False)
+    loaded = state.load_snapshot(state.read_manifest())
+    assert [channel['name'] for channel in loaded.channels.all()] == ['general', 'random']
+    assert loaded.channel_messages(u_id, (channel_id, 0)) == \
+        store.channel_messages(u_id, (channel_id, 0))
+    assert snapshot_files() == manifest_files(state.read_manifest())
+
+
+@pytest.mark.parametrize('incremental', [True, False])
+def test_workspace_reset_survives_restart(snapshot_dir, monkeypatch, incremental):
+    monkeypatch.setattr(state, 'INCREMENTAL_SNAPSHOTS', incremental)
+    monkeypatch.setattr(state, 'WAL_ENABLED', False)
+    close_wal()
+    fill(state.get_store())
+    assert state.update_database(background=False)
+
+    workspace_reset()
+    state.initialize_store()
+    assert state.get_store().users.all() == []
+    assert state.get_store().messages.next_id() == 1
+
+
+class Baseline():
+    '''
+    The fields of a store as the first version of state pickled them
+    '''
+
+    def __init__(self, cls, fields):
+        self.cls = cls
+        self.fields = fields
+
+
+class BaselinePickler(pickle.Pickler):
+    '''
+    Pickles each Baseline as an instance of its class with the old fields,
+    which loads as what the first version of state wrote to database.p does
+    '''
+
+    def reducer_override(self, obj):  # pylint: disable=missing-function-docstring
+        if isinstance(obj, Baseline):
+            return object.__new__, (obj.cls,), obj.fields
+        return NotImplemented
+
+
+def baseline_database():
+    '''
+    Returns a database.p in the first format of state, holding two users in a
+    channel with two messages, one pinned and reacted to, and a reset code
+    '''
+    def user(email, name_first, name_last, handle_str):
+        return {'email': email, 'name_first': name_first, 'name_last': name_last,
+                'password': 'hash', 'handle_str': handle_str, 'img_path': ""}
+
+    def message(message_id, body, time_created, is_pinned):
+        return {'message_id': message_id, 'message': body,
+                'time_created': time_created, 'is_pinned': is_pinned}
+
+    def link(message_id, u_id, u_ids):
+        return {'message_id': message_id, 'u_id': u_id, 'channel_id': 1,
+                'reacts': [{'react_id': 1, 'u_ids': u_ids}]}
+
+    hangman = {'bot_id': -1, 'bot_token': 'o', 'is_enabled': True,
+               'is_running': False, 'data': {}}
+    stores = {
+        'users': Baseline(state.Users, {
+            '_users': {1: user('max@gmail.com', 'Max', 'Smith', 'maxsmith'),
+                       3: user('kim@gmail.com', 'Kim', 'Lee', 'kimlee')},
+            '_num_users': 2, '_current_id': 3, '_img_dir': './images'}),
+        'admins': Baseline(state.Admins, {'_admins': [1], '_valid_permissions': [1, 2]}),
+        'channels': Baseline(state.Channels, {
+            '_channels': {1: {'name': 'General', 'is_public': True, 'hangman': hangman}},
+            '_num_channels': 1, '_current_id': 1}),
+        'codes': Baseline(Codes, {'_codes_dict': {'kim@gmail.com': 'A1B2C3D4'},
+                                  '_num_codes': 1}),
+        'messages': Baseline(Messages, {
+            '_messages': [message(1, 'hello world', 100.0, True),
+                          message(3, 'hello again', 102.0, False)],
+            '_num_messages': 2, '_current_id': 3}),
+        'user_message': Baseline(state.UserMessage, {
+            '_user_messages': [link(1, 1, [3]), link(3, 3, [])], '_react_ids': [1]}),
+        'user_channel': Baseline(state.UserChannel, {
+            '_user_channels': [(1, 1, True), (3, 1, False)]}),
+    }
+    out_file = io.BytesIO()
+    BaselinePickler(out_file).dump(Baseline(Database, stores))
+    return out_file.getvalue()
+
+
+def test_baseline_database_loads(snapshot_dir, monkeypatch):
+    monkeypatch.setattr(Codes, '_send_email', lambda self, email: None)
+    with open(state.DATABASE_FILE, 'wb') as out_file:
+        out_file.write(baseline_database())
+    state.initialize_store()
+    store = state.get_store()
+
+    assert store.wal_lsn == 0
+    assert store.users.email_used('kim@gmail.com')
+    assert store.users.find_u_id('kim@gmail.com') == 3
+    assert [user['handle_str'] for user in store.users.all()] == ['maxsmith', 'kimlee']
+    assert store.user_channel.is_owner(1, 1) and not store.user_channel.is_owner(3, 1)
+    assert store.user_channel.user_channels(3) == [1]
+    assert store.codes.find_email('A1B2C3D4') == ['kim@gmail.com']
+    assert [channel['channel_id'] for channel in store.channels.search('gen', 10, bool)] == [1]
+
+    messages, more = store.channel_messages(3, (1, 0))
+    assert not more
+    assert [msg['message_id'] for msg in messages] == [3, 1]
+    assert messages[1]['is_pinned']
+    assert messages[1]['reacts'][0]['u_ids'] == [3]
+    assert messages[1]['reacts'][0]['is_this_user_reacted']
+    assert [msg['message_id'] for msg in store.message_search(1, 'hello')] == [3, 1]
+
+    # the upgraded store keeps working, from the ids it had reached
+    assert store.add_user(('amy@gmail.com', 'hash', 'Amy', 'Wu', 'amywu')) == 4
+    assert store.add_message(1, 1, ('hello there', 103.0)) == 4
+    assert [msg['message_id'] for msg in store.message_search(1, 'hello', 1)] == [4]
@@ -50,5 +50,6 @@ SETHANDLE_URL = f"http://{HOSTNAME}:{PORT}/user/profile/sethandle"
 # other urls
 PERMISSION_CHANGE_URL = f"http://{HOSTNAME}:{PORT}/admin/userpermission/change"
 USER_REMOVE_URL = f"http://{HOSTNAME}:{PORT}/admin/user/remove"
+SNAPSHOT_STATS_URL = f"http://{HOSTNAME}:{PORT}/admin/snapshot/stats"
 USERS_ALL_URL = f"http://{HOSTNAME}:{PORT}/users/all"
 SEARCH_URL = f"http://{HOSTNAME}:{PORT}/search"